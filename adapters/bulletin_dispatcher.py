@@ -0,0 +1,154 @@
+import time
+import random
+import hashlib
+import logging
+from multiprocessing.dummy import Pool
+
+import redis
+
+from gov_delivery_policy import error_code, nothing_sent
+
+__all__ = ['BulletinDispatcher']
+
+logger = logging.getLogger(__name__)
+
+# GovDelivery's error when none of a bulletin's topics have subscribers
+NO_SUBSCRIBERS = 'GD-12004'
+
+
+class BulletinDispatcher(object):
+    """Sends a bulletin as several create_and_send_bulletin calls of at most
+    `chunk_size` topics each, `concurrency` of them at a time, or as a
+    single call if `chunk_size` is None or 0. GovDelivery only takes out
+    duplicate subscribers within a bulletin, so a subscriber to topics in
+    two chunks gets the email twice.
+
+    Chunks which fail with an error proving nothing was sent are sent
+    again, up to `retries` times; chunks which succeeded, or might have,
+    are never resent. Given a `record_ttl`, the topics each chunked
+    bulletin was delivered to are kept in Redis for that many seconds,
+    keyed by its GOV.UK request ID, subject and body, and skipped if it's
+    dispatched again."""
+    def __init__(self, client, redis_client=None, chunk_size=None, concurrency=4, retries=2,
+                 backoff=1, record_ttl=0, prefix='govuk_delivery:bulletin:'):
+        self.client = client
+        self.redis = redis_client
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.record_ttl = record_ttl
+        self.prefix = prefix
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _key(self, govuk_request_id, subject, body):
+        # Notifications sent with the same request ID but different content
+        # don't skip each other's topics
+        content = hashlib.sha256((u'%s\0%s' % (subject, body)).encode('utf-8')).hexdigest()
+        return '%s%s:%s:delivered' % (self.prefix, govuk_request_id, content)
+
+    def _recording(self, govuk_request_id):
+        # A bulletin sent in one call reaches every topic or none, so
+        # there's nothing to record
+        return bool(self.redis and self.record_ttl and govuk_request_id and self.chunk_size)
+
+    def delivered(self, govuk_request_id, subject, body):
+        """The topics a request's bulletin has already been delivered to."""
+        if not self._recording(govuk_request_id):
+            return set()
+        try:
+            return self.redis.smembers(self._key(govuk_request_id, subject, body))
+        except redis.RedisError as error:
+            logger.warning('Could not read topics delivered for request %s: %s', govuk_request_id, error)
+            return set()
+
+    def record(self, govuk_request_id, subject, body, topic_ids):
+        if not self._recording(govuk_request_id):
+            return
+        try:
+            key = self._key(govuk_request_id, subject, body)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.sadd(key, *topic_ids)
+            pipe.expire(key, self.record_ttl)
+            pipe.execute()
+        except redis.RedisError as error:
+            logger.warning('Could not record topics delivered for request %s: %s', govuk_request_id, error)
+
+    def can_resend(self, govuk_request_id):
+        """Whether dispatching a request's bulletin again after it failed
+        would skip the topics it reached: they're recorded, or it was sent
+        in one go, so nothing was sent if it failed."""
+        return self._recording(govuk_request_id) or not self.chunk_size
+
+    def chunks(self, topic_ids):
+        if not self.chunk_size:
+            return [topic_ids] if topic_ids else []
+        return [topic_ids[start:start + self.chunk_size] for start in range(0, len(topic_ids), self.chunk_size)]
+
+    def retryable(self, error):
+        # A bulletin which timed out or failed with a 5xx may well have been
+        # sent, so it isn't sent again in case everyone gets the email twice
+        return nothing_sent(error)
+
+    def _send(self, arguments):
+        """Sends one chunk, returning the error if it fails."""
+        chunk, subject, body, govuk_request_id = arguments
+        try:
+            self.client.create_and_send_bulletin(chunk, subject, body)
+        except Exception as error:
+            return error
+        self.record(govuk_request_id, subject, body, chunk)
+        return None
+
+    def _send_all(self, chunks, subject, body, govuk_request_id):
+        arguments = [(chunk, subject, body, govuk_request_id) for chunk in chunks]
+        if len(chunks) == 1:
+            return [self._send(arguments[0])]
+        pool = Pool(min(self.concurrency, len(chunks)))
+        try:
+            return pool.map(self._send, arguments)
+        finally:
+            pool.close()
+            pool.join()
+
+    def dispatch(self, topic_ids, subject, body, govuk_request_id=None):
+        """Sends the bulletin to every topic and returns the topics it was
+        sent to by this call.
+
+        Once every chunk has been tried, the error from the first chunk
+        which failed is raised, preferring one which may have been sent.
+        If no topic has any subscribers, GovDelivery's GD-12004 error is
+        raised."""
+        delivered = self.delivered(govuk_request_id, subject, body)
+        pending = self.chunks([topic_id for topic_id in topic_ids if topic_id not in delivered])
+        sent, no_subscribers, failures = [], [], []
+        attempt = 0
+        while pending:
+            retry = []
+            for chunk, error in zip(pending, self._send_all(pending, subject, body, govuk_request_id)):
+                if error is None:
+                    sent.extend(chunk)
+                elif error_code(error) == NO_SUBSCRIBERS:
+                    no_subscribers.append(error)
+                elif attempt < self.retries and self.retryable(error):
+                    retry.append(chunk)
+                else:
+                    failures.append((chunk, error))
+            if retry:
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.warning('Sending %d of %d bulletin chunks again in %.2fs', len(retry), len(pending), delay)
+                self.sleep(delay)
+            pending = retry
+            attempt += 1
+
+        failures.sort(key=lambda failure: nothing_sent(failure[1]))
+        for chunk, error in failures:
+            logger.error('Could not send bulletin for request %s to %d topics from %s: %s',
+                         govuk_request_id, len(chunk), chunk[0], error)
+        if failures:
+            raise failures[0][1]
+        if no_subscribers and not sent and not delivered:
+            raise no_subscribers[0]
+        return sent
@@ -0,0 +1,123 @@
+import socket
+import threading
+import unittest
+
+import redis
+import requests
+from mock import Mock, patch
+
+from bulletin_dispatcher import BulletinDispatcher
+from fake_redis import FakeRedis
+
+
+class FakeClient(object):
+    """Fails the first time it's sent each chunk listed in `failures`"""
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def create_and_send_bulletin(self, topic_ids, subject, body):
+        with self.lock:
+            error = self.failures.pop(topic_ids[0], None)
+            if error:
+                raise error
+            self.sent.append(list(topic_ids))
+
+
+@patch.object(BulletinDispatcher, 'sleep')
+class BulletinDispatcherTestCase(unittest.TestCase):
+    def test_sends_topics_in_chunks(self, sleep):
+        client = FakeClient()
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        sent = dispatcher.dispatch(['A', 'B', 'C', 'D', 'E'], 'Subject', 'Body')
+        self.assertEqual(['A', 'B', 'C', 'D', 'E'], sorted(sent))
+        self.assertEqual([['A', 'B'], ['C', 'D'], ['E']], sorted(client.sent))
+
+    def test_sends_every_topic_at_once_by_default(self, sleep):
+        client = FakeClient()
+        BulletinDispatcher(client).dispatch(['A', 'B', 'C'], 'Subject', 'Body')
+        self.assertEqual([['A', 'B', 'C']], client.sent)
+
+    def test_retries_only_failed_chunks(self, sleep):
+        client = FakeClient({'C': Exception('HTTP status: 429\nGD-00001\nToo many requests')})
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        dispatcher.dispatch(['A', 'B', 'C', 'D'], 'Subject', 'Body')
+        self.assertEqual([['A', 'B'], ['C', 'D']], sorted(client.sent))
+        self.assertEqual(1, sleep.call_count)
+
+    def test_retries_chunks_which_could_not_connect(self, sleep):
+        refused = Mock(reason=socket.error(111, 'Connection refused'))
+        client = FakeClient({'C': requests.exceptions.ConnectionError(refused)})
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        dispatcher.dispatch(['A', 'B', 'C', 'D'], 'Subject', 'Body')
+        self.assertEqual([['A', 'B'], ['C', 'D']], sorted(client.sent))
+
+    def test_does_not_resend_chunks_which_may_have_been_sent(self, sleep):
+        reset = Mock(reason=socket.error(104, 'Connection reset by peer'))
+        for error in [Exception('HTTP status: 503\nGD-00001\nUnavailable'), requests.exceptions.ConnectionError(reset)]:
+            client = FakeClient({'C': error})
+            dispatcher = BulletinDispatcher(client, chunk_size=2)
+            self.assertRaises(type(error), dispatcher.dispatch, ['A', 'B', 'C', 'D'], 'Subject', 'Body')
+            self.assertEqual([['A', 'B']], client.sent)
+
+    def test_does_not_resend_chunks_which_timed_out(self, sleep):
+        client = FakeClient({'C': requests.exceptions.Timeout('timed out')})
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        self.assertRaises(requests.exceptions.Timeout, dispatcher.dispatch, ['A', 'B', 'C', 'D'], 'Subject', 'Body')
+        self.assertEqual([['A', 'B']], client.sent)
+
+    def test_raises_no_subscribers_only_if_nothing_was_sent(self, sleep):
+        no_subscribers = Exception('HTTP status: 400\nGD-12004\nNo subscribers')
+        client = FakeClient({'A': no_subscribers})
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        self.assertEqual(['C'], dispatcher.dispatch(['A', 'B', 'C'], 'Subject', 'Body'))
+
+        client = FakeClient({'A': no_subscribers})
+        dispatcher = BulletinDispatcher(client, chunk_size=2)
+        self.assertRaises(Exception, dispatcher.dispatch, ['A', 'B'], 'Subject', 'Body')
+
+    def test_records_and_skips_delivered_topics(self, sleep):
+        fake_redis = FakeRedis()
+        client = FakeClient({'C': Exception('HTTP status: 404\nGD-14002\nTopic not found')})
+        dispatcher = BulletinDispatcher(client, fake_redis, chunk_size=2, record_ttl=60)
+        self.assertRaises(Exception, dispatcher.dispatch, ['A', 'B', 'C'], 'Subject', 'Body', 'REQUEST_ID')
+        self.assertEqual(set(['A', 'B']), dispatcher.delivered('REQUEST_ID', 'Subject', 'Body'))
+
+        self.assertEqual(['C'], dispatcher.dispatch(['A', 'B', 'C'], 'Subject', 'Body', 'REQUEST_ID'))
+        self.assertEqual([['A', 'B'], ['C']], client.sent)
+
+    def test_does_not_skip_topics_for_other_content_with_the_same_request_id(self, sleep):
+        client = FakeClient()
+        dispatcher = BulletinDispatcher(client, FakeRedis(), chunk_size=2, record_ttl=60)
+        dispatcher.dispatch(['A', 'B'], 'Subject', 'Body', 'REQUEST_ID')
+        self.assertEqual(['A', 'B'], dispatcher.dispatch(['A', 'B'], 'Subject', 'Other body', 'REQUEST_ID'))
+
+    def test_does_not_record_bulletins_sent_in_one_call(self, sleep):
+        fake_redis = FakeRedis()
+        BulletinDispatcher(FakeClient(), fake_redis, record_ttl=60).dispatch(['A', 'B'], 'Subject', 'Body', 'REQUEST_ID')
+        self.assertEqual({}, fake_redis.values)
+
+    def test_raises_the_failure_which_may_have_been_sent(self, sleep):
+        unavailable = Exception('HTTP status: 503\nGD-00001\nUnavailable')
+        client = FakeClient({'A': Exception('HTTP status: 429\nGD-00001\nToo many requests'), 'C': unavailable})
+        dispatcher = BulletinDispatcher(client, chunk_size=2, retries=0)
+        with self.assertRaises(Exception) as context:
+            dispatcher.dispatch(['A', 'B', 'C', 'D'], 'Subject', 'Body')
+        self.assertIs(unavailable, context.exception)
+
+    def test_can_resend_only_if_delivered_topics_would_be_skipped(self, sleep):
+        self.assertTrue(BulletinDispatcher(FakeClient()).can_resend('REQUEST_ID'))
+        self.assertFalse(BulletinDispatcher(FakeClient(), chunk_size=2).can_resend('REQUEST_ID'))
+        self.assertTrue(BulletinDispatcher(FakeClient(), FakeRedis(), chunk_size=2, record_ttl=60).can_resend('REQUEST_ID'))
+
+    def test_sends_without_redis(self, sleep):
+        broken_redis = Mock(**{'smembers.side_effect': redis.ConnectionError('down'),
+                               'pipeline.side_effect': redis.ConnectionError('down')})
+        client = FakeClient()
+        dispatcher = BulletinDispatcher(client, broken_redis, chunk_size=2, record_ttl=60)
+        self.assertEqual(['A'], dispatcher.dispatch(['A'], 'Subject', 'Body', 'REQUEST_ID'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import re
+
+from jinja2 import escape
+
+__all__ = ['BulletinTemplate', 'BulletinPayload']
+
+# Stand-ins rendered into the template so that the text around them can be
+# found. They must survive HTML escaping unchanged.
+SUBJECT = 'GOVUK_DELIVERY_SUBJECT_PLACEHOLDER'
+BODY = 'GOVUK_DELIVERY_BODY_PLACEHOLDER'
+TOPIC = 'GOVUK_DELIVERY_TOPIC_PLACEHOLDER'
+
+# Characters escaped by Jinja's |e filter
+ESCAPED_CHARACTERS = re.compile(r'[&<>"\']')
+
+
+def _utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _escape(text):
+    """Escapes text as Jinja's |e filter does, returning UTF-8. Plain byte
+    strings which need no escaping, like most topic codes, are returned as
+    they are."""
+    if isinstance(text, str) and not ESCAPED_CHARACTERS.search(text):
+        return text
+    return _utf8(escape(text))
+
+
+class BulletinPayload(object):
+    """A request body made of chunks which are sent one after another.
+
+    It has a length, so it's sent with a Content-Length rather than chunked
+    transfer encoding, and `read` so that httplib sends it a block at a time
+    without joining the chunks into one string."""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.length = sum(len(chunk) for chunk in chunks)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        blocks = []
+        while size > 0 and self._index < len(self.chunks):
+            chunk = self.chunks[self._index]
+            block = chunk[self._offset:self._offset + size]
+            blocks.append(block)
+            size -= len(block)
+            self._offset += len(block)
+            if self._offset >= len(chunk):
+                self._index += 1
+                self._offset = 0
+        return ''.join(blocks)
+
+
+class BulletinTemplate(object):
+    """create_and_send_bulletin.jinja split, once, into the constant UTF-8
+    text around its subject, body and topic codes.
+
+    Building a payload then only escapes the subject and topic codes; the
+    body and the footer are never copied into a larger string."""
+    def __init__(self, template, footer):
+        empty = template.render(subject=SUBJECT, body=BODY, footer=footer, topic_ids=[])
+        one_topic = template.render(subject=SUBJECT, body=BODY, footer=footer, topic_ids=[TOPIC])
+
+        # The topics loop is whatever the second render has that the first
+        # doesn't. Where it starts among the whitespace doesn't matter, as
+        # long as each topic renders the same text.
+        start = len(os.path.commonprefix([empty, one_topic]))
+        head, tail = empty[:start], empty[start:]
+        topic = one_topic[start:len(one_topic) - len(tail)]
+        assert one_topic.endswith(tail) and TOPIC in topic
+
+        before_subject, rest = head.split(SUBJECT)
+        before_body, after_body = rest.split(BODY)
+        topic_start, topic_end = topic.split(TOPIC)
+
+        self.before_subject = _utf8(before_subject)
+        self.before_body = _utf8(before_body)
+        self.after_body = _utf8(after_body)
+        self.topic_start = _utf8(topic_start)
+        self.topic_end = _utf8(topic_end)
+        self.tail = _utf8(tail)
+
+    def payload(self, topic_ids, subject, body):
+        """Returns the bulletin as a BulletinPayload, matching what the
+        template renders for the same arguments."""
+        topic_start, topic_end = self.topic_start, self.topic_end
+        topics = ''.join([topic_start + _escape(topic_id) + topic_end for topic_id in topic_ids])
+        return BulletinPayload([self.before_subject, _escape(subject), self.before_body,
+                                _utf8(body), self.after_body, topics, self.tail])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import xmltodict
+
+from gov_delivery import env, default_footer, bulletin_template
+
+
+class BulletinTemplateTestCase(unittest.TestCase):
+    def render(self, topic_ids, subject, body):
+        template = env.get_template('create_and_send_bulletin.jinja')
+        return template.render(topic_ids=topic_ids, subject=subject, body=body, footer=default_footer).encode('utf-8')
+
+    def assert_payload_matches_render(self, topic_ids, subject, body):
+        payload = bulletin_template.payload(topic_ids, subject, body)
+        rendered = self.render(topic_ids, subject, body)
+        streamed = payload.read()
+        self.assertEqual(xmltodict.parse(rendered), xmltodict.parse(streamed))
+        self.assertEqual(rendered, streamed)
+        self.assertEqual(len(rendered), len(payload))
+
+    def test_payload_matches_the_template(self):
+        self.assert_payload_matches_render(['TOPIC_1', 'TOPIC_2', 'TOPIC_3'], 'Subject', '<p>Body</p>')
+
+    def test_payload_with_one_topic(self):
+        self.assert_payload_matches_render(['TOPIC_1'], 'Subject', '<p>Body</p>')
+
+    def test_payload_with_no_topics(self):
+        self.assert_payload_matches_render([], 'Subject', '<p>Body</p>')
+
+    def test_payload_escapes_the_subject_and_topics(self):
+        self.assert_payload_matches_render(['TOPIC_<1>&'], u'Tom & Jerry <"\'>', '<p>Body</p>')
+
+    def test_payload_encodes_unicode_as_utf8(self):
+        self.assert_payload_matches_render([u'TOPIC_1'], u'Caf\xe9', u'<p>‘Body’</p>')
+
+
+class BulletinPayloadTestCase(unittest.TestCase):
+    def test_read_in_blocks(self):
+        payload = bulletin_template.payload(['TOPIC_%d' % n for n in range(100)], 'Subject', '<p>Body</p>' * 100)
+        expected = ''.join(payload)
+        blocks = []
+        block = payload.read(64)
+        while block:
+            self.assertTrue(len(block) <= 64)
+            blocks.append(block)
+            block = payload.read(64)
+        self.assertEqual(expected, ''.join(blocks))
+        self.assertEqual(len(expected), len(payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import time
+import uuid
+import datetime
+import logging
+
+__all__ = ['DeadLetterQueue']
+
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterQueue(object):
+    """Tasks which ran out of retries, kept in a Redis list oldest first so
+    that they can be looked at and sent again.
+
+    Each entry records the task's name, arguments, the error it last
+    failed with, its class and how many times it was tried.
+
+    Entries are only removed once they've been re-driven, so one is never
+    lost if the re-drive dies part way."""
+    def __init__(self, redis_client, key='govuk_delivery:dead_letters'):
+        self.redis = redis_client
+        self.key = key
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def add(self, task, args, kwargs, error, error_class, attempts):
+        entry = {
+            'id': uuid.uuid4().hex,
+            'task': task,
+            'args': args,
+            'kwargs': kwargs,
+            'error': str(error),
+            'error_class': error_class,
+            'attempts': attempts,
+            'failed_at': datetime.datetime.utcnow().isoformat(),
+        }
+        self.redis.rpush(self.key, json.dumps(entry))
+        return entry
+
+    def count(self):
+        return self.redis.llen(self.key)
+
+    def entries(self, start=0, limit=100):
+        """Returns up to `limit` entries, oldest first."""
+        return [json.loads(value) for value in self.redis.lrange(self.key, start, start + limit - 1)]
+
+    def redrive(self, send, limit=None, rate=None):
+        """Hands up to `limit` entries, oldest first, to `send`, at most
+        `rate` a second, removing each once it's been sent. An entry `send`
+        fails on is left in place and stops the run. Returns how many were
+        sent."""
+        sent = 0
+        while limit is None or sent < limit:
+            value = self.redis.lindex(self.key, 0)
+            if value is None:
+                break
+            entry = json.loads(value)
+            try:
+                send(entry)
+            except Exception as error:
+                logger.error('Could not re-drive dead letter %s: %s', entry['id'], error)
+                break
+            self.redis.lrem(self.key, 1, value)
+            sent += 1
+            if rate:
+                self.sleep(1.0 / rate)
+        return sent
@@ -0,0 +1,47 @@
+import unittest
+
+from mock import Mock
+
+from dead_letter import DeadLetterQueue
+from fake_redis import FakeRedis
+
+
+class DeadLetterQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = DeadLetterQueue(FakeRedis())
+        self.queue.sleep = Mock()
+        for request_id in ['1', '2', '3']:
+            self.queue.add('send-notification', [['http://example.com/feed'], 'Subject', '<p>Body</p>', {}, request_id],
+                           {}, Exception('HTTP status: 503'), 'transient', 6)
+
+    def test_records_the_task_and_why_it_failed(self):
+        entry = self.queue.entries()[0]
+        self.assertEqual('send-notification', entry['task'])
+        self.assertEqual('1', entry['args'][4])
+        self.assertEqual(('HTTP status: 503', 'transient', 6), (entry['error'], entry['error_class'], entry['attempts']))
+        self.assertEqual(3, self.queue.count())
+
+    def test_lists_entries_oldest_first(self):
+        self.assertEqual(['2', '3'], [entry['args'][4] for entry in self.queue.entries(start=1, limit=5)])
+
+    def test_redrives_entries_at_a_limited_rate(self):
+        sent = []
+        self.assertEqual(2, self.queue.redrive(sent.append, limit=2, rate=5))
+        self.assertEqual(['1', '2'], [entry['args'][4] for entry in sent])
+        self.assertEqual(1, self.queue.count())
+        self.queue.sleep.assert_called_with(0.2)
+
+    def test_entries_which_cannot_be_redriven_are_kept(self):
+        send = Mock(side_effect=[None, Exception('broker down')])
+        self.assertEqual(1, self.queue.redrive(send))
+        self.assertEqual(['2', '3'], [entry['args'][4] for entry in self.queue.entries()])
+
+    def test_entries_stay_queued_while_they_are_redriven(self):
+        counts = []
+        self.queue.redrive(lambda entry: counts.append(self.queue.count()), limit=1)
+        self.assertEqual([3], counts)
+        self.assertEqual(2, self.queue.count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import unittest
+
+import redis
+
+__all__ = ['FakeRedis', 'real_redis']
+
+
+class FakeLock(object):
+    def __init__(self):
+        self.acquired = False
+        self.released = False
+
+    def acquire(self, blocking=True):
+        self.acquired = True
+        return True
+
+    def release(self):
+        self.released = True
+
+
+class FakeScript(object):
+    """Stands in for the Script objects StrictRedis.register_script returns"""
+    def __init__(self, redis_client, script):
+        self.redis = redis_client
+        self.script = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        return (client or self.redis).eval(self.script, len(keys), *(list(keys) + list(args)))
+
+
+class FakePipeline(object):
+    """Queues commands and runs them in order on execute, returning their
+    results as a StrictRedis pipeline does"""
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakeRedis(object):
+    """The parts of StrictRedis the adapters use, kept in a dict for a
+    single client. TTLs are recorded but never expire anything.
+
+    Lua scripts aren't run, so that a test can't pass against a Python
+    copy of a script that has drifted from it. Tests of the scripts use
+    real_redis() instead."""
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+        self.published = []
+        self.locks = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        raise NotImplementedError('Lua scripts need a real Redis, see real_redis()')
+
+    def register_script(self, script):
+        return FakeScript(self, script)
+
+    def lock(self, name, timeout=None):
+        lock = FakeLock()
+        self.locks.append((name, lock))
+        return lock
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
+
+    def exists(self, name):
+        return name in self.values
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, name, value):
+        self.values[name] = value
+        return True
+
+    def setex(self, name, time, value):
+        self.values[name] = value
+        self.ttls[name] = time
+        return True
+
+    def setnx(self, name, value):
+        if name in self.values:
+            return False
+        self.values[name] = value
+        return True
+
+    def incr(self, name):
+        value = int(self.values.get(name, 0)) + 1
+        self.values[name] = str(value)
+        return value
+
+    def expire(self, name, time):
+        if name not in self.values:
+            return False
+        self.ttls[name] = time
+        return True
+
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            if self.values.pop(name, None) is not None:
+                deleted += 1
+            self.ttls.pop(name, None)
+        return deleted
+
+    def sadd(self, name, *values):
+        members = self.values.setdefault(name, set())
+        added = len(set(values) - members)
+        members.update(values)
+        return added
+
+    def smembers(self, name):
+        return set(self.values.get(name, set()))
+
+    def rpush(self, name, *values):
+        self.values.setdefault(name, []).extend(values)
+        return len(self.values[name])
+
+    def lpush(self, name, *values):
+        for value in values:
+            self.values.setdefault(name, []).insert(0, value)
+        return len(self.values[name])
+
+    def lindex(self, name, index):
+        values = self.values.get(name, [])
+        return values[index] if -len(values) <= index < len(values) else None
+
+    def lrem(self, name, count, value):
+        values = self.values.get(name, [])
+        removed = 0
+        while value in values and (not count or removed < count):
+            values.remove(value)
+            removed += 1
+        return removed
+
+    def llen(self, name):
+        return len(self.values.get(name, []))
+
+    def lrange(self, name, start, end):
+        values = self.values.get(name, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def hget(self, name, key):
+        return self.values.get(name, {}).get(key)
+
+    def hsetnx(self, name, key, value):
+        fields = self.values.setdefault(name, {})
+        if key in fields:
+            return 0
+        fields[key] = value
+        return 1
+
+    def hgetall(self, name):
+        return dict(self.values.get(name, {}))
+
+
+def real_redis():
+    """Returns a client for an emptied Redis database to run Lua scripts
+    against, or skips the test if Redis isn't running.
+
+    REDIS_TEST_HOST, REDIS_TEST_PORT and REDIS_TEST_DB choose the database,
+    which defaults to 15 on localhost so that development data in 0 is
+    left alone."""
+    client = redis.StrictRedis(host=os.getenv('REDIS_TEST_HOST', 'localhost'),
+                               port=int(os.getenv('REDIS_TEST_PORT', 6379)),
+                               db=int(os.getenv('REDIS_TEST_DB', 15)))
+    try:
+        client.flushdb()
+    except redis.ConnectionError:
+        raise unittest.SkipTest('Redis is not running')
+    return client
@@ -1,12 +1,17 @@
 import os
 import base64
+import hashlib
 import urllib
+from cStringIO import StringIO
+from xml.etree import cElementTree as ElementTree
 
-import requests
-from requests.auth import HTTPBasicAuth
 from jinja2 import Environment, FileSystemLoader
 import xmltodict
 
+from bulletin_payload import BulletinTemplate
+from http_transport import HTTPTransport
+from rate_limiter import operation_class
+
 __all__ = ['GovDeliveryClient']
 
 class GovDeliveryAPIClientException(Exception):
@@ -15,37 +20,72 @@ class GovDeliveryAPIClientException(Exception):
 with open(os.path.join(os.path.dirname(__file__), 'templates', 'default_footer.html'), 'r') as footer_file:
     default_footer = footer_file.read()
 
+# Templates are compiled once per process and shared by every client
+env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
+bulletin_template = BulletinTemplate(env.get_template('create_and_send_bulletin.jinja'), default_footer)
+
+def subscriber_key(kind, email):
+    """A cache key for something about a subscriber which doesn't reveal
+    their email address."""
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return '%s:%s' % (kind, hashlib.sha256(email.strip().lower()).hexdigest())
+
 # Error codes:
 # http://knowledge.govdelivery.com/display/API/Subscriber+Error+Codes
 
 class GovDeliveryClient(object):
-    def __init__(self, username, password, account_code, hostname='api.govdelivery.com'):
-        self.auth = HTTPBasicAuth(username, password)
+    def __init__(self, username, password, account_code, hostname='api.govdelivery.com',
+                 pool_size=10, timeout=30, transport=None, rate_limiter=None, subscriber_cache=None):
         self.hostname = hostname
         self.account_code = account_code
-        self.env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
+        self.rate_limiter = rate_limiter
+        # Remembers, briefly, which subscribers exist and their topics
+        self.subscriber_cache = subscriber_cache
+        self.env = env
+        # Clients for the same account share a connection pool
+        self.transport = transport or HTTPTransport.shared((hostname, username),
+                                                           pool_size=pool_size,
+                                                           timeout=timeout,
+                                                           username=username,
+                                                           password=password)
 
     def _api_url(self, path):
         url = 'https://%s/api/account/%s/%s.xml' % (self.hostname, self.account_code, path)
         return url
 
+    def _request(self, method, path, params=None):
+        if self.rate_limiter:
+            # Waits for the account's budget for this kind of call
+            self.rate_limiter.acquire(self.account_code, operation_class(path))
+        return self.transport.request(method, self._api_url(path), data=params, headers={'content-type': 'application/xml'})
+
     def _get(self, path):
-        response = requests.get(self._api_url(path), auth=self.auth, headers={'content-type': 'application/xml'})
+        response = self._request('GET', path)
         return self._parse_response(response)
 
     def _post(self, path, params):
-        response = requests.post(self._api_url(path), data=params, auth=self.auth, headers={'content-type': 'application/xml'})
+        response = self._request('POST', path, params)
         return self._parse_response(response)
 
     def _put(self, path, params):
-        response = requests.put(self._api_url(path), data=params, auth=self.auth, headers={'content-type': 'application/xml'})
+        response = self._request('PUT', path, params)
+        self._raise_for_unavailable(response)
         # TODO: are there any PUTs we won't want to do this?
         return response.status_code
 
     def _delete(self, path):
-        response = requests.delete(self._api_url(path), auth=self.auth, headers={'content-type': 'application/xml'})
+        response = self._request('DELETE', path)
+        self._raise_for_unavailable(response)
         return response
 
+    def _raise_for_unavailable(self, response):
+        """PUTs and DELETEs report other failures through their status code,
+        but raise when GovDelivery is down or throttling, so that the call
+        can be retried and counted by the circuit breaker."""
+        if response.status_code >= 500 or response.status_code in (408, 429):
+            raise Exception('HTTP status: %s' % response.status_code)
+
     def _parse_response(self, response):
         response_text = response.text
         if 'application/xml' in response.headers.get('content-type'):
@@ -58,9 +98,81 @@ class GovDeliveryClient(object):
         response.raise_for_status()
         return response_text
 
+    def _raise_errors(self, response):
+        document = ElementTree.fromstring(response.content)
+        errors = [error.text for error in document.findall('error')]
+        raise Exception("\n".join(['HTTP status: %s' % response.status_code, document.findtext('code', '')] + errors))
+
+    def _iter_fields(self, response, paths):
+        """Yields (path, text) for each element of a response whose path from
+        the root, like 'topics/topic/to-param', is in `paths`.
+
+        Unlike _parse_response this never builds the whole document. Error
+        responses are spotted from the root element, and every other element
+        is thrown away once it has been read, so long lists of topics are
+        parsed in constant memory."""
+        if 'application/xml' not in response.headers.get('content-type', ''):
+            response.raise_for_status()
+            return
+        paths = set(paths)
+        path = []
+        root = None
+        for event, element in ElementTree.iterparse(StringIO(response.content), events=('start', 'end')):
+            if event == 'start':
+                path.append(element.tag)
+                if root is None:
+                    root = element
+                    if element.tag == 'errors':
+                        self._raise_errors(response)
+                    response.raise_for_status()
+                continue
+            joined_path = '/'.join(path)
+            if joined_path in paths:
+                yield joined_path, element.text
+            path.pop()
+            element.clear()
+            if len(path) == 1:
+                # Drop the finished children of the root as well
+                root.clear()
+
+    def _parse_fields(self, response, paths):
+        """Returns the text of the first element at each of `paths`, nested
+        by tag name like parse_xml_content but without attributes:
+
+            {'topic': {'to-param': 'TOPIC_ID'}}
+
+        Parsing stops as soon as every path has been found."""
+        remaining = set(paths)
+        fields = {}
+        for path, text in self._iter_fields(response, remaining):
+            if path not in remaining:
+                continue
+            tags = path.split('/')
+            parent = fields
+            for tag in tags[:-1]:
+                parent = parent.setdefault(tag, {})
+            parent[tags[-1]] = text
+            remaining.discard(path)
+            if not remaining:
+                break
+        return fields
+
     def parse_xml_content(self, content):
         return xmltodict.parse(content)
 
+    def _cached(self, key):
+        if self.subscriber_cache is None:
+            return None
+        return self.subscriber_cache.get_many([key]).get(key)
+
+    def _cache(self, mapping):
+        if self.subscriber_cache is not None:
+            self.subscriber_cache.set_many(mapping)
+
+    def _uncache(self, keys):
+        if self.subscriber_cache is not None:
+            self.subscriber_cache.invalidate(keys)
+
     def _template(self, template_name, context):
         template = self.env.get_template('%s.jinja' % template_name)
         return template.render(**context).encode('utf-8')
@@ -74,6 +186,16 @@ class GovDeliveryClient(object):
         http://knowledge.govdelivery.com/display/API/Read+Topic"""
         return self._get('topics/%s' % urllib.quote(topic_id))
 
+    def read_topic_subscribers_count(self, topic_id):
+        """Read the number of subscribers to a topic.
+
+        Usage: client.read_topic_subscribers_count('TOPIC_ID')
+
+        http://knowledge.govdelivery.com/display/API/Read+Topic"""
+        response = self._request('GET', 'topics/%s' % urllib.quote(topic_id))
+        fields = self._parse_fields(response, ['topic/subscribers-count'])
+        return int(fields['topic']['subscribers-count'])
+
     def create_topic(self, params):
         """Create a topic.
 
@@ -81,7 +203,9 @@ class GovDeliveryClient(object):
 
         http://knowledge.govdelivery.com/display/API/Create+Topic"""
         post_data = self._template('create_topic', params)
-        return self._post('topics', post_data)
+        response = self._request('POST', 'topics', post_data)
+        # Only the topic code is used, so none of the rest is parsed
+        return self._parse_fields(response, ['topic/to-param'])
 
     def update_topic_categories(self, topic_id, categories):
         """Replace topic categories.
@@ -124,9 +248,20 @@ class GovDeliveryClient(object):
         except Exception as errors:
             if 'GD-15002' not in str(errors):
                 raise
-            subscriber = None
+            self._uncache([subscriber_key('exists', email), subscriber_key('topics', email)])
+            return None
+        self._cache({subscriber_key('exists', email): True})
         return subscriber
 
+    def subscriber_exists(self, email):
+        """Whether there's a subscriber with this email address, without
+        asking GovDelivery if the subscriber cache knows they exist.
+
+        Usage: client.subscriber_exists('me@example.com')"""
+        if self._cached(subscriber_key('exists', email)):
+            return True
+        return self.read_subscriber(email) is not None
+
     def create_subscriber(self, email, frequency='daily'):
         """Create a new subscriber.
 
@@ -142,6 +277,8 @@ class GovDeliveryClient(object):
             if 'GD-15004' not in str(errors):
                 raise
             subscriber = None
+        # Either way the subscriber now exists
+        self._cache({subscriber_key('exists', email): True})
         return subscriber
 
     def list_subscriber_topics(self, email):
@@ -150,14 +287,23 @@ class GovDeliveryClient(object):
         Usage: client.list_subscriber_topics('name@example.com')
 
         http://knowledge.govdelivery.com/display/API/List+Subscriber+Topics"""
-        response = self._get('subscribers/%s/topics' % urllib.quote(base64.b64encode(email)))
-        if response['topics'].get('topic'):
-            if not isinstance(response['topics']['topic'], list):
-                topics = [response['topics']['topic']]
-            else:
-                topics = response['topics']['topic']
-            return [element['to-param'] for element in topics]
-        return []
+        key = subscriber_key('topics', email)
+        topics = self._cached(key)
+        if topics is None:
+            topics = list(self.iter_subscriber_topics(email))
+            self._cache({key: topics, subscriber_key('exists', email): True})
+        return list(topics)
+
+    def iter_subscriber_topics(self, email):
+        """Read subscriber topics one at a time, without holding the whole
+        response in memory as parsed XML. The request is made straight away;
+        errors are raised once iteration starts.
+
+        Usage: for topic_id in client.iter_subscriber_topics('name@example.com'): ...
+
+        http://knowledge.govdelivery.com/display/API/List+Subscriber+Topics"""
+        response = self._request('GET', 'subscribers/%s/topics' % urllib.quote(base64.b64encode(email)))
+        return (topic_id for _, topic_id in self._iter_fields(response, ['topics/topic/to-param']))
 
     def merge_subscriber_topics(self, email, new_topics):
         """Merges two topic lists together.
@@ -190,7 +336,12 @@ class GovDeliveryClient(object):
         # perform some kind of merge over existing topics.
 
         post_data = self._template('update_subscriber_topics', {'topic_ids': topic_ids})
-        return self._put('subscribers/%s/topics' % urllib.quote(base64.b64encode(email)), post_data) == 200
+        updated = self._put('subscribers/%s/topics' % urllib.quote(base64.b64encode(email)), post_data) == 200
+        if updated:
+            self._cache({subscriber_key('topics', email): list(topic_ids), subscriber_key('exists', email): True})
+        else:
+            self._uncache([subscriber_key('topics', email)])
+        return updated
 
     def create_subscriber_and_add_subscriptions(self, email, topic_ids):
         """Creates a user and subscribes them to topic_ids in a single request.
@@ -200,7 +351,18 @@ class GovDeliveryClient(object):
         http://knowledge.govdelivery.com/display/API/Add+Subscriptions"""
 
         post_data = self._template('create_subscriber_and_add_subscriptions', {'email': email, 'topic_ids': topic_ids})
-        return self._post('subscribers/add_subscriptions', post_data)
+        try:
+            response = self._post('subscribers/add_subscriptions', post_data)
+        except Exception:
+            self._uncache([subscriber_key('topics', email)])
+            raise
+        updates = {subscriber_key('exists', email): True}
+        # The topics were added to the subscriber's others
+        topics = self._cached(subscriber_key('topics', email))
+        if topics is not None:
+            updates[subscriber_key('topics', email)] = sorted(set(topics) | set(topic_ids))
+        self._cache(updates)
+        return response
 
     def create_and_send_bulletin(self, topic_ids, subject, body):
         """Create and send a bulletin to TOPICS.
@@ -208,5 +370,7 @@ class GovDeliveryClient(object):
         Usage: client.create_and_send_bulletin([123, 456], 'My subject', '<p>This is HTML text</p>')
 
         http://knowledge.govdelivery.com/display/API/Create+and+Send+Bulletin"""
-        post_data = self._template('create_and_send_bulletin', {'topic_ids': topic_ids, 'subject': subject, 'body': body, 'footer': default_footer})
+        # Sent a block at a time rather than rendered into one string, as
+        # bulletins can have large bodies and thousands of topics
+        post_data = bulletin_template.payload(topic_ids, subject, body)
         return self._post('bulletins/send_now', post_data)
@@ -0,0 +1,51 @@
+try:
+    import gevent.pool
+except ImportError:
+    gevent = None
+
+from gov_delivery import GovDeliveryClient
+
+__all__ = ['AsyncGovDeliveryClient']
+
+
+class AsyncGovDeliveryClient(object):
+    """Makes GovDeliveryClient calls in greenlets, with at most
+    `concurrency` of them in flight at once.
+
+    It has the same methods as GovDeliveryClient, but each one returns a
+    greenlet straight away; call `get()` on it for the result. `map` runs
+    any function over many items in the same pool. The client's connection
+    pool grows to match, so each greenlet in flight has a connection.
+
+    Calls only run concurrently once sockets have been patched with
+    gevent.monkey.patch_all(), which must happen before anything else is
+    imported. Needs gevent; see `available`."""
+    def __init__(self, client=None, concurrency=200, **client_kwargs):
+        if not self.available():
+            raise RuntimeError('AsyncGovDeliveryClient needs gevent to be installed')
+        if client is None:
+            client_kwargs.setdefault('pool_size', concurrency)
+            client = GovDeliveryClient(**client_kwargs)
+        elif client.transport.pool_size < concurrency:
+            client.transport.resize(concurrency)
+        self.client = client
+        self.pool = gevent.pool.Pool(concurrency)
+
+    @staticmethod
+    def available():
+        return gevent is not None
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        return lambda *args, **kwargs: self.pool.spawn(method, *args, **kwargs)
+
+    def map(self, function, items):
+        """Returns [function(item) for item in items], in order, running up
+        to `concurrency` calls at once."""
+        return list(self.pool.imap(function, items))
+
+    def join(self):
+        """Waits for every call in flight to finish."""
+        self.pool.join()
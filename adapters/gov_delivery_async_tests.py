@@ -0,0 +1,27 @@
+import unittest
+
+from mock import Mock
+
+from gov_delivery_async import AsyncGovDeliveryClient
+
+
+@unittest.skipUnless(AsyncGovDeliveryClient.available(), 'gevent is not installed')
+class AsyncGovDeliveryClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock(**{'transport.pool_size': 10,
+                              'read_topic_subscribers_count.side_effect': lambda topic_id: len(topic_id)})
+        self.async_client = AsyncGovDeliveryClient(self.client, concurrency=50)
+
+    def test_methods_return_greenlets(self):
+        self.assertEqual(7, self.async_client.read_topic_subscribers_count('TOPIC_1').get())
+
+    def test_map_keeps_the_order_of_items(self):
+        results = self.async_client.map(self.async_client.client.read_topic_subscribers_count, ['A', 'BB', 'CCC'])
+        self.assertEqual([1, 2, 3], results)
+
+    def test_grows_the_client_connection_pool(self):
+        self.client.transport.resize.assert_called_once_with(50)
+
+
+if __name__ == '__main__':
+    unittest.main()
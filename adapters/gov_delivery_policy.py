@@ -0,0 +1,300 @@
+import re
+import time
+import errno
+import socket
+import random
+import logging
+import threading
+from collections import namedtuple
+
+import redis
+import requests
+
+from gov_delivery import GovDeliveryAPIClientException
+from rate_limiter import RateLimitExceeded
+
+__all__ = ['CallPolicy', 'CircuitBreaker', 'CircuitOpenError', 'GovDeliveryPolicyClient',
+           'call_policies', 'classify_error', 'classify_task_error', 'nothing_sent', 'not_applied']
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(GovDeliveryAPIClientException):
+    pass
+
+
+# Errors worth retrying, which also count towards opening the circuit
+TRANSIENT = 'transient'
+# Errors in the request itself. Retrying won't help, and GovDelivery
+# answering at all shows it's up.
+PERMANENT = 'permanent'
+# Calls held back by the rate limiter or circuit breaker, which are worth
+# trying again later
+DEFERRED = 'deferred'
+
+TRANSIENT_STATUSES = (408, 429)
+
+# GovDelivery error codes which decide the class whatever the HTTP status
+# they came with: no subscribers on the topics (GD-12004), no such
+# subscriber (GD-15002) and subscriber already exists (GD-15004).
+ERROR_CODE_CLASSES = {
+    'GD-12004': PERMANENT,
+    'GD-15002': PERMANENT,
+    'GD-15004': PERMANENT,
+}
+
+STATUS_PATTERN = re.compile(r'^HTTP status: (\d+)')
+CODE_PATTERN = re.compile(r'\b(GD-\d+)\b')
+
+
+def error_status(error):
+    """The HTTP status of a failed GovDelivery call, or None."""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code
+    match = STATUS_PATTERN.match(str(error))
+    return int(match.group(1)) if match else None
+
+
+def error_code(error):
+    """The GD-xxxxx code of a failed GovDelivery call, or None."""
+    match = CODE_PATTERN.search(str(error))
+    return match.group(1) if match else None
+
+
+# Socket errors which can only happen while connecting, before any of a
+# request has been sent
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def nothing_sent(error):
+    """Whether an error proves GovDelivery never received the request: the
+    connection couldn't be made, or it was turned away with a 429."""
+    if error_status(error) == 429:
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # requests 1.1 wraps urllib3's MaxRetryError, which keeps the
+        # socket error as its reason
+        reason = getattr(error.args[0], 'reason', None)
+        return isinstance(reason, socket.gaierror) or getattr(reason, 'errno', None) in CONNECT_ERRNOS
+    return False
+
+
+def not_applied(error):
+    """Whether an error proves a GovDelivery call changed nothing: it was
+    never made, never received, or turned down."""
+    if isinstance(error, (GovDeliveryAPIClientException, RateLimitExceeded)) or nothing_sent(error):
+        return True
+    status = error_status(error)
+    return status is not None and 400 <= status < 500 and status not in TRANSIENT_STATUSES
+
+
+def classify_error(error):
+    """Returns TRANSIENT or PERMANENT for an error raised by GovDeliveryClient."""
+    if isinstance(error, CircuitOpenError):
+        return PERMANENT
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return TRANSIENT
+    code = error_code(error)
+    if code in ERROR_CODE_CLASSES:
+        return ERROR_CODE_CLASSES[code]
+    status = error_status(error)
+    if status is not None and (status >= 500 or status in TRANSIENT_STATUSES):
+        return TRANSIENT
+    return PERMANENT
+
+
+def classify_task_error(error):
+    """Returns TRANSIENT, DEFERRED or PERMANENT for an error which failed a
+    task sending a bulletin. A bulletin which timed out or failed with a 5xx
+    may well have been sent, so only errors proving it wasn't are worth
+    sending again automatically."""
+    if isinstance(error, (RateLimitExceeded, CircuitOpenError)):
+        return DEFERRED
+    if nothing_sent(error):
+        return TRANSIENT
+    return PERMANENT
+
+
+# How many times a call is retried after a transient error, and the base
+# and largest delay in seconds between attempts
+CallPolicy = namedtuple('CallPolicy', ['retries', 'backoff', 'max_backoff'])
+
+DEFAULT_POLICY = CallPolicy(retries=0, backoff=0.5, max_backoff=5)
+
+# Only calls which can safely be repeated are retried by default. Creating
+# topics, subscribers and above all bulletins is never repeated, so that
+# nobody is sent the same email twice.
+DEFAULT_POLICIES = {
+    'read_topic': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'read_topic_subscribers_count': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'read_subscriber': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'subscriber_exists': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'list_subscriber_topics': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    # Adding subscriptions which already exist changes nothing
+    'create_subscriber_and_add_subscriptions': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'merge_subscriber_topics': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'update_topic': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'update_topic_categories': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'update_subscriber_frequency': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'update_subscriber_topics': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+    'delete_topic': CallPolicy(retries=2, backoff=0.5, max_backoff=5),
+}
+
+
+def call_policies(overrides=None):
+    """Returns the policy for each client method, with the fields in
+    `overrides`, a dict like {'read_topic': {'retries': 5}}, replaced."""
+    policies = dict(DEFAULT_POLICIES)
+    for name, fields in (overrides or {}).items():
+        policies[name] = policies.get(name, DEFAULT_POLICY)._replace(**fields)
+    return policies
+
+
+CLAIM_PROBE_SCRIPT = """
+if redis.call('setnx', KEYS[1], 1) == 1 then
+    redis.call('expire', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class CircuitBreaker(object):
+    """Counts transient GovDelivery failures in Redis, so that every web
+    and worker process sees the same state.
+
+    After `threshold` failures within `window` seconds the circuit opens
+    and calls fail straight away with CircuitOpenError. After
+    `reset_timeout` seconds one call at a time is let through: if it
+    succeeds the circuit closes, if it fails the circuit opens again.
+
+    If Redis can't be reached every call is allowed."""
+    def __init__(self, redis_client, name, threshold=5, window=60, reset_timeout=30,
+                 prefix='govuk_delivery:circuit:'):
+        self.redis = redis_client
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        key = prefix + name
+        self.failures_key = key + ':failures'
+        self.open_key = key + ':open'
+        self.half_open_key = key + ':half_open'
+        self.probe_key = key + ':probe'
+        # Outlives the open key long enough for a probe to be let through,
+        # so a circuit whose probe never reports back closes on its own
+        self.half_open_ttl = 3 * reset_timeout
+        # Whether this thread's call is the one testing a half-open circuit
+        self.local = threading.local()
+
+    def state(self):
+        is_open, half_open = self.redis.mget([self.open_key, self.half_open_key])
+        if is_open:
+            return 'open'
+        if half_open:
+            return 'half_open'
+        return 'closed'
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may go ahead."""
+        self.local.probing = False
+        try:
+            state = self.state()
+            if state == 'open':
+                raise CircuitOpenError('GovDelivery circuit %s is open' % self.name)
+            if state == 'half_open':
+                if not self.claim_probe():
+                    raise CircuitOpenError('GovDelivery circuit %s is half open and already being tested' % self.name)
+                self.local.probing = True
+        except redis.RedisError as error:
+            logger.warning('Could not check GovDelivery circuit %s, allowing the call: %s', self.name, error)
+
+    def claim_probe(self):
+        """Sets the probe key if nobody holds it, expiring it so that
+        another caller can test the circuit if this one never reports back.
+        The key is set and given its expiry in one step, as redis-py 2.7
+        has no SET NX EX."""
+        return bool(self.redis.eval(CLAIM_PROBE_SCRIPT, 1, self.probe_key, self.reset_timeout))
+
+    def record_success(self):
+        if not getattr(self.local, 'probing', False):
+            return
+        self.local.probing = False
+        try:
+            self.redis.delete(self.half_open_key, self.probe_key, self.failures_key)
+            logger.info('Closed GovDelivery circuit %s', self.name)
+        except redis.RedisError as error:
+            logger.warning('Could not close GovDelivery circuit %s: %s', self.name, error)
+
+    def record_failure(self):
+        probing = getattr(self.local, 'probing', False)
+        self.local.probing = False
+        try:
+            failures = self.redis.incr(self.failures_key)
+            if failures == 1:
+                self.redis.expire(self.failures_key, self.window)
+            if probing or failures >= self.threshold:
+                self.trip()
+        except redis.RedisError as error:
+            logger.warning('Could not record failure on GovDelivery circuit %s: %s', self.name, error)
+
+    def trip(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.setex(self.open_key, self.reset_timeout, 1)
+        pipe.setex(self.half_open_key, self.half_open_ttl, 1)
+        pipe.delete(self.failures_key, self.probe_key)
+        pipe.execute()
+        logger.warning('Opened GovDelivery circuit %s for %ss', self.name, self.reset_timeout)
+
+
+class GovDeliveryPolicyClient(object):
+    """Wraps a GovDeliveryClient, retrying transient errors as each method's
+    CallPolicy allows and failing fast while the circuit breaker is open.
+
+    Other attributes are passed through to the client. Errors raised while
+    iterating over a generator, like iter_subscriber_topics, are neither
+    retried nor counted."""
+    def __init__(self, client, policies=None, breaker=None):
+        self.client = client
+        self.policies = call_policies() if policies is None else policies
+        self.breaker = breaker
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.call(name, attribute, *args, **kwargs)
+
+    def call(self, name, method, *args, **kwargs):
+        policy = self.policies.get(name, DEFAULT_POLICY)
+        attempt = 0
+        while True:
+            if self.breaker:
+                self.breaker.before_call()
+            try:
+                result = method(*args, **kwargs)
+            except Exception as error:
+                transient = classify_error(error) == TRANSIENT
+                # Errors raised before a request was made say nothing about
+                # whether GovDelivery is up
+                local_error = isinstance(error, (GovDeliveryAPIClientException, RateLimitExceeded))
+                if self.breaker and not local_error:
+                    if transient:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                if not transient or attempt >= policy.retries:
+                    raise
+                # Full jitter, so that retrying workers don't move in step
+                delay = random.uniform(0, min(policy.max_backoff, policy.backoff * 2 ** attempt))
+                logger.warning('GovDelivery %s failed, retrying in %.2fs: %s', name, delay, error)
+                self.sleep(delay)
+                attempt += 1
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                return result
@@ -0,0 +1,194 @@
+import unittest
+
+import redis
+import requests
+from mock import Mock, patch
+
+from gov_delivery_policy import (GovDeliveryPolicyClient, CircuitBreaker, CircuitOpenError, CallPolicy,
+                                 call_policies, classify_error, classify_task_error, not_applied, TRANSIENT,
+                                 PERMANENT, DEFERRED)
+from rate_limiter import RateLimitExceeded
+from fake_redis import FakeRedis, real_redis
+
+
+class FakeClient(object):
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def read_topic(self, topic_id):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    create_and_send_bulletin = read_topic
+
+
+class ClassifyErrorTestCase(unittest.TestCase):
+    def test_server_errors_are_transient(self):
+        self.assertEqual(TRANSIENT, classify_error(Exception('HTTP status: 503\nGD-00001\nUnavailable')))
+
+    def test_connection_errors_are_transient(self):
+        self.assertEqual(TRANSIENT, classify_error(requests.exceptions.ConnectionError('refused')))
+        self.assertEqual(TRANSIENT, classify_error(requests.exceptions.Timeout('timed out')))
+
+    def test_http_errors_use_the_response_status(self):
+        error = requests.exceptions.HTTPError('429 Client Error')
+        error.response = Mock(status_code=429)
+        self.assertEqual(TRANSIENT, classify_error(error))
+
+    def test_client_errors_are_permanent(self):
+        self.assertEqual(PERMANENT, classify_error(Exception('HTTP status: 404\nGD-14002\nTopic not found')))
+        self.assertEqual(PERMANENT, classify_error(Exception('Something else')))
+
+    def test_known_error_codes_override_the_status(self):
+        self.assertEqual(PERMANENT, classify_error(Exception('HTTP status: 500\nGD-12004\nNo subscribers')))
+        self.assertEqual(PERMANENT, classify_error(Exception('HTTP status: 503\nGD-15002\nSubscriber not found')))
+
+
+class NotAppliedTestCase(unittest.TestCase):
+    def test_rejected_and_throttled_calls_were_not_applied(self):
+        self.assertTrue(not_applied(Exception('HTTP status: 400\nGD-15001\nInvalid')))
+        self.assertTrue(not_applied(Exception('HTTP status: 429\nGD-00001\nToo many requests')))
+        self.assertTrue(not_applied(RateLimitExceeded('over the limit')))
+
+    def test_calls_which_failed_after_being_sent_may_have_been_applied(self):
+        self.assertFalse(not_applied(Exception('HTTP status: 503\nGD-00001\nUnavailable')))
+        self.assertFalse(not_applied(requests.exceptions.Timeout('timed out')))
+
+
+class ClassifyTaskErrorTestCase(unittest.TestCase):
+    def test_held_back_calls_are_deferred(self):
+        self.assertEqual(DEFERRED, classify_task_error(RateLimitExceeded('over the limit')))
+        self.assertEqual(DEFERRED, classify_task_error(CircuitOpenError('open')))
+
+    def test_timeouts_are_permanent(self):
+        self.assertEqual(PERMANENT, classify_task_error(requests.exceptions.Timeout('timed out')))
+
+    def test_bulletins_which_may_have_been_sent_are_permanent(self):
+        self.assertEqual(PERMANENT, classify_task_error(Exception('HTTP status: 503\nGD-00001\nUnavailable')))
+        self.assertEqual(PERMANENT, classify_task_error(requests.exceptions.ConnectionError('reset')))
+
+    def test_bulletins_which_were_not_sent_are_transient(self):
+        self.assertEqual(TRANSIENT, classify_task_error(Exception('HTTP status: 429\nGD-00001\nToo many requests')))
+
+
+class CallPoliciesTestCase(unittest.TestCase):
+    def test_overrides_fields_of_the_defaults(self):
+        policies = call_policies({'read_topic': {'retries': 5}, 'create_topic': {'retries': 1}})
+        self.assertEqual(5, policies['read_topic'].retries)
+        self.assertEqual(0.5, policies['read_topic'].backoff)
+        self.assertEqual(1, policies['create_topic'].retries)
+
+    def test_bulletins_are_never_retried_by_default(self):
+        self.assertTrue('create_and_send_bulletin' not in call_policies())
+
+
+@patch.object(GovDeliveryPolicyClient, 'sleep')
+class GovDeliveryPolicyClientTestCase(unittest.TestCase):
+    def test_retries_transient_errors(self, sleep):
+        client = FakeClient(Exception('HTTP status: 503\nGD-00001\nUnavailable'), {'topic': {}})
+        policy_client = GovDeliveryPolicyClient(client, {'read_topic': CallPolicy(2, 0.5, 5)})
+        self.assertEqual({'topic': {}}, policy_client.read_topic('TOPIC_ID'))
+        self.assertEqual(2, client.calls)
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(0 <= sleep.call_args[0][0] <= 0.5)
+
+    def test_gives_up_after_the_last_retry(self, sleep):
+        error = requests.exceptions.ConnectionError('refused')
+        client = FakeClient(error, error, error)
+        policy_client = GovDeliveryPolicyClient(client, {'read_topic': CallPolicy(2, 0.5, 5)})
+        self.assertRaises(requests.exceptions.ConnectionError, policy_client.read_topic, 'TOPIC_ID')
+        self.assertEqual(3, client.calls)
+
+    def test_does_not_retry_permanent_errors(self, sleep):
+        client = FakeClient(Exception('HTTP status: 404\nGD-14002\nTopic not found'))
+        policy_client = GovDeliveryPolicyClient(client, {'read_topic': CallPolicy(2, 0.5, 5)})
+        self.assertRaises(Exception, policy_client.read_topic, 'TOPIC_ID')
+        self.assertEqual(1, client.calls)
+
+    def test_does_not_retry_calls_without_a_policy(self, sleep):
+        client = FakeClient(requests.exceptions.ConnectionError('refused'))
+        policy_client = GovDeliveryPolicyClient(client)
+        self.assertRaises(requests.exceptions.ConnectionError, policy_client.create_and_send_bulletin, 'TOPIC_ID')
+        self.assertEqual(1, client.calls)
+
+    def test_fails_fast_while_the_circuit_is_open(self, sleep):
+        fake_redis = FakeRedis()
+        breaker = CircuitBreaker(fake_redis, 'TEST', threshold=2)
+        error = requests.exceptions.ConnectionError('refused')
+        client = FakeClient(error, error, {'topic': {}})
+        policy_client = GovDeliveryPolicyClient(client, {'read_topic': CallPolicy(5, 0.5, 5)}, breaker)
+        self.assertRaises(CircuitOpenError, policy_client.read_topic, 'TOPIC_ID')
+        self.assertEqual(2, client.calls)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.breaker = CircuitBreaker(self.redis, 'TEST', threshold=2)
+
+    def test_opens_after_threshold_failures(self):
+        self.breaker.record_failure()
+        self.assertEqual('closed', self.breaker.state())
+        self.breaker.record_failure()
+        self.assertEqual('open', self.breaker.state())
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+    def test_half_open_key_expires(self):
+        self.breaker.trip()
+        self.assertEqual(self.breaker.half_open_ttl, self.redis.ttls[self.breaker.half_open_key])
+
+    def test_refuses_calls_while_half_open_and_being_tested(self):
+        self.breaker.trip()
+        # The open key has expired
+        self.redis.delete(self.breaker.open_key)
+        with patch.object(CircuitBreaker, 'claim_probe', return_value=False):
+            self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+    @patch.object(CircuitBreaker, 'claim_probe', return_value=True)
+    def test_closes_when_the_test_call_succeeds(self, fake_claim_probe):
+        self.breaker.trip()
+        self.redis.delete(self.breaker.open_key)
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual('closed', self.breaker.state())
+
+    @patch.object(CircuitBreaker, 'claim_probe', return_value=True)
+    def test_opens_again_when_the_test_call_fails(self, fake_claim_probe):
+        self.breaker.trip()
+        self.redis.delete(self.breaker.open_key)
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual('open', self.breaker.state())
+
+    def test_allows_calls_when_redis_is_down(self):
+        broken_redis = Mock(**{'mget.side_effect': redis.ConnectionError('down'),
+                               'incr.side_effect': redis.ConnectionError('down')})
+        breaker = CircuitBreaker(broken_redis, 'TEST', threshold=1)
+        breaker.record_failure()
+        breaker.before_call()
+
+
+class CircuitBreakerProbeTestCase(unittest.TestCase):
+    """Runs CLAIM_PROBE_SCRIPT against a real Redis"""
+    def setUp(self):
+        self.redis = real_redis()
+        self.breaker = CircuitBreaker(self.redis, 'TEST', threshold=2)
+        self.breaker.trip()
+        self.redis.delete(self.breaker.open_key)
+
+    def test_lets_one_call_through_once_half_open(self):
+        self.breaker.before_call()
+        other_breaker = CircuitBreaker(self.redis, 'TEST', threshold=2)
+        self.assertRaises(CircuitOpenError, other_breaker.before_call)
+
+    def test_probe_key_expires(self):
+        self.breaker.before_call()
+        self.assertTrue(0 < self.redis.ttl(self.breaker.probe_key) <= self.breaker.reset_timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,11 @@ import unittest
 
 from httpretty import HTTPretty
 from mock import Mock
+import xmltodict
 
-from gov_delivery import GovDeliveryClient
+from gov_delivery import GovDeliveryClient, subscriber_key
+from partner_id_cache import LRUCache
+from http_transport import HTTPTransport
 
 
 class GovDeliveryClientHTTPTests(unittest.TestCase):
@@ -18,6 +21,36 @@ class GovDeliveryClientHTTPTests(unittest.TestCase):
         return 'https://test.example.com/api/account/TESTCODE/%s.xml' % path
 
 
+class GovDeliveryClientTransportTests(GovDeliveryClientHTTPTests):
+    def test_sends_basic_auth_header(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('topics/TOPIC_ID')
+        )
+        self.client.read_topic('TOPIC_ID')
+        assert HTTPretty.last_request.headers['Authorization'] == 'Basic dGVzdDp0ZXN0'
+
+    def test_clients_for_the_same_account_share_a_transport(self):
+        other_client = GovDeliveryClient('test', 'test', 'TESTCODE', hostname='test.example.com')
+        assert other_client.transport is self.client.transport
+
+    def test_waits_for_the_rate_limiter(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('topics/TOPIC_ID')
+        )
+        rate_limiter = Mock()
+        client = GovDeliveryClient('test', 'test', 'TESTCODE', hostname='test.example.com', rate_limiter=rate_limiter)
+        client.read_topic('TOPIC_ID')
+        rate_limiter.acquire.assert_called_once_with('TESTCODE', 'topic')
+
+    def test_shared_transport_grows_its_pool(self):
+        transport = HTTPTransport.shared('pool-test', pool_size=5)
+        self.assertEqual(HTTPTransport.shared('pool-test', pool_size=40).pool_size, 40)
+        self.assertEqual(HTTPTransport.shared('pool-test', pool_size=10), transport)
+        self.assertEqual(transport.pool_size, 40)
+
+
 class GovDeliveryClientTopicTests(GovDeliveryClientHTTPTests):
     def test_read_topic_makes_get_request(self):
         HTTPretty.register_uri(
@@ -46,6 +79,39 @@ class GovDeliveryClientTopicTests(GovDeliveryClientHTTPTests):
         body = self.client.read_topic('TOPIC_ID')
         assert {} == body
 
+    def test_read_topic_subscribers_count_parses_only_the_count(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('topics/TOPIC_ID'),
+            body='<topic><code>TOPIC_ID</code><subscribers-count type="integer">3</subscribers-count></topic>',
+            content_type='application/xml'
+        )
+        self.client.parse_xml_content = Mock()
+        self.assertEqual(3, self.client.read_topic_subscribers_count('TOPIC_ID'))
+        assert not self.client.parse_xml_content.called
+
+    def test_read_topic_subscribers_count_raises_errors_with_the_status(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('topics/TOPIC_ID'),
+            body='<errors><code>GD-14002</code><error>Topic not found</error></errors>',
+            content_type='application/xml',
+            status=404
+        )
+        with self.assertRaises(Exception) as context:
+            self.client.read_topic_subscribers_count('TOPIC_ID')
+        self.assertEqual('HTTP status: 404\nGD-14002\nTopic not found', context.exception.message)
+
+    def test_create_topic_returns_the_topic_code(self):
+        HTTPretty.register_uri(
+            HTTPretty.POST,
+            self._api_url('topics'),
+            body='<topic><to-param>TOPIC_ID</to-param><topic-uri>/api/account/TESTCODE/topics/TOPIC_ID.xml</topic-uri></topic>',
+            content_type='application/xml'
+        )
+        response = self.client.create_topic({'name': 'Name', 'short_name': 'Short', 'visibility': 'Unlisted'})
+        self.assertEqual({'topic': {'to-param': 'TOPIC_ID'}}, response)
+
     def test_update_topic_categories_makes_put_request(self):
         HTTPretty.register_uri(
             HTTPretty.PUT,
@@ -55,6 +121,24 @@ class GovDeliveryClientTopicTests(GovDeliveryClientHTTPTests):
         self.client.update_topic_categories('TOPIC_ID', ['CATEGORY_ID'])
         assert HTTPretty.last_request.method == 'PUT'
 
+    def test_puts_raise_when_gov_delivery_is_unavailable(self):
+        HTTPretty.register_uri(
+            HTTPretty.PUT,
+            self._api_url('topics/TOPIC_ID/categories'),
+            status=503
+        )
+        with self.assertRaises(Exception) as context:
+            self.client.update_topic_categories('TOPIC_ID', ['CATEGORY_ID'])
+        self.assertEqual('HTTP status: 503', context.exception.message)
+
+    def test_deletes_report_other_failures_by_status(self):
+        HTTPretty.register_uri(
+            HTTPretty.DELETE,
+            self._api_url('topics/TOPIC_ID'),
+            status=404
+        )
+        self.assertFalse(self.client.delete_topic('TOPIC_ID'))
+
 
 class GovDeliveryClientSubscriberTests(GovDeliveryClientHTTPTests):
     def test_read_subcriber_makes_get_request(self):
@@ -73,6 +157,97 @@ class GovDeliveryClientSubscriberTests(GovDeliveryClientHTTPTests):
         self.client.create_subscriber('me@example.com')
         assert HTTPretty.last_request.method == 'POST'
 
+    def test_list_subscriber_topics_returns_every_topic_code(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D/topics'),
+            body='<topics type="array">'
+                 '<topic><code>TOPIC_1</code><to-param>TOPIC_1</to-param></topic>'
+                 '<topic><code>TOPIC_2</code><to-param>TOPIC_2</to-param></topic>'
+                 '</topics>',
+            content_type='application/xml'
+        )
+        self.assertEqual(['TOPIC_1', 'TOPIC_2'], self.client.list_subscriber_topics('me@example.com'))
+
+    def test_list_subscriber_topics_with_no_topics(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D/topics'),
+            body='<topics type="array"></topics>',
+            content_type='application/xml'
+        )
+        self.assertEqual([], self.client.list_subscriber_topics('me@example.com'))
+
+    def test_read_subscriber_returns_none_when_not_found(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D'),
+            body='<errors><code>GD-15002</code><error>Subscriber not found</error></errors>',
+            content_type='application/xml',
+            status=404
+        )
+        self.assertEqual(None, self.client.read_subscriber('me@example.com'))
+
+
+class GovDeliveryClientSubscriberCacheTests(GovDeliveryClientHTTPTests):
+    def setUp(self):
+        super(GovDeliveryClientSubscriberCacheTests, self).setUp()
+        self.client = GovDeliveryClient('test', 'test', 'TESTCODE', hostname='test.example.com',
+                                        subscriber_cache=LRUCache(10, 30))
+
+    def test_remembers_subscribers_which_exist(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D'),
+            body='<subscriber><email>me@example.com</email></subscriber>',
+            content_type='application/xml'
+        )
+        self.assertTrue(self.client.subscriber_exists('me@example.com'))
+        HTTPretty.disable()
+        self.assertTrue(self.client.subscriber_exists('me@example.com'))
+
+    def test_does_not_remember_missing_subscribers(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D'),
+            body='<errors><code>GD-15002</code><error>Subscriber not found</error></errors>',
+            content_type='application/xml',
+            status=404
+        )
+        self.assertFalse(self.client.subscriber_exists('me@example.com'))
+        self.assertEqual(0, self.client.subscriber_cache.stats()['size'])
+
+    def test_updating_topics_updates_the_cache(self):
+        HTTPretty.register_uri(
+            HTTPretty.PUT,
+            self._api_url('subscribers/bWVAZXhhbXBsZS5jb20%3D/topics'),
+            content_type='application/xml'
+        )
+        self.client.update_subscriber_topics('me@example.com', ['TOPIC_1'])
+        HTTPretty.disable()
+        self.assertEqual(['TOPIC_1'], self.client.list_subscriber_topics('me@example.com'))
+        self.assertTrue(self.client.subscriber_exists('me@example.com'))
+
+    def test_keys_do_not_contain_the_email_address(self):
+        key = subscriber_key('exists', 'Me@Example.com ')
+        self.assertEqual(key, subscriber_key('exists', 'me@example.com'))
+        self.assertTrue('example' not in key)
+
+
+class GovDeliveryClientBulletinTests(GovDeliveryClientHTTPTests):
+    def test_create_and_send_bulletin_sends_the_whole_payload(self):
+        HTTPretty.register_uri(
+            HTTPretty.POST,
+            self._api_url('bulletins/send_now'),
+            body='<bulletin><to-param>BULLETIN_ID</to-param></bulletin>',
+            content_type='application/xml'
+        )
+        self.client.create_and_send_bulletin(['TOPIC_1', 'TOPIC_2'], 'Subject', '<p>Body</p>')
+        request = HTTPretty.last_request
+        self.assertEqual(str(len(request.body)), request.headers['Content-Length'])
+        self.assertEqual(['TOPIC_1', 'TOPIC_2'],
+                         [topic['code'] for topic in xmltodict.parse(request.body)['bulletin']['topics']['topic']])
+
 
 if __name__ == '__main__':
     unittest.main()
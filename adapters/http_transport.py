@@ -0,0 +1,72 @@
+import os
+import base64
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ['HTTPTransport']
+
+
+class HTTPTransport(object):
+    """Sends requests through a pooled, keep-alive requests Session.
+
+    The session is created lazily and again in any forked child process,
+    so connections are never shared across a fork. It's safe to share a
+    transport between threads; size the pool to the number of threads.
+
+    Transports are shared through `HTTPTransport.shared` so that every
+    client talking to the same host in a process reuses its connections
+    instead of opening a new TCP and TLS connection per call."""
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, pool_size=10, timeout=30, username=None, password=None):
+        self.pool_size = pool_size
+        # requests 1.1 applies a single timeout to connecting and to each
+        # read from the socket.
+        self.timeout = timeout
+        self.headers = {}
+        if username is not None:
+            # Worked out once rather than by HTTPBasicAuth on every request
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode('%s:%s' % (username, password))
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, **kwargs):
+        """Returns the transport for `key` in this process, creating it
+        with kwargs the first time it's asked for. The pool grows if a
+        later caller asks for a bigger one."""
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(**kwargs)
+            transport = cls._shared[key]
+            if kwargs.get('pool_size', 0) > transport.pool_size:
+                transport.resize(kwargs['pool_size'])
+            return transport
+
+    def resize(self, pool_size):
+        with self._lock:
+            self.pool_size = pool_size
+            # Rebuilt with the new pool size on the next request
+            self._session_pid = None
+
+    @property
+    def session(self):
+        if self._session_pid != os.getpid():
+            with self._lock:
+                if self._session_pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
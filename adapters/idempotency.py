@@ -0,0 +1,85 @@
+import json
+import hashlib
+import logging
+
+import redis
+
+__all__ = ['IdempotencyStore', 'IN_FLIGHT', 'SENT']
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT = 'in_flight'
+SENT = 'sent'
+
+# Records a notification as in flight and gives the record its expiry in
+# one step, as redis-py 2.7 has no SET NX EX. Returns nothing if it was
+# recorded, or else the existing record.
+BEGIN_SCRIPT = """
+if redis.call('setnx', KEYS[1], ARGV[1]) == 1 then
+    redis.call('expire', KEYS[1], ARGV[2])
+    return false
+end
+return redis.call('get', KEYS[1])
+"""
+
+
+class IdempotencyStore(object):
+    """Records notifications being sent, and the response to each one
+    which was, in Redis, so that a notification POSTed again is answered
+    from the record rather than sent twice.
+
+    A record stays in flight for at most `in_flight_ttl` seconds, in case
+    the process sending it dies, and a response is kept for `ttl` seconds.
+    If Redis can't be reached every notification is sent."""
+    def __init__(self, redis_client, ttl, in_flight_ttl=300, prefix='govuk_delivery:notification:'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.in_flight_ttl = in_flight_ttl
+        self.prefix = prefix
+        self.duplicates = 0
+
+    def key(self, govuk_request_id, logging_params, feed_urls, subject):
+        """The key a notification is recorded under: its content item's ID
+        and update time if given, else the GOV.UK request ID, along with
+        its feed URLs and subject. None if it has neither ID."""
+        content_id = logging_params.get('content_id')
+        public_updated_at = logging_params.get('public_updated_at')
+        if content_id and public_updated_at:
+            identity = u'content:%s:%s' % (content_id, public_updated_at)
+        elif govuk_request_id:
+            identity = u'request:%s' % govuk_request_id
+        else:
+            return None
+        # One publish may notify several sets of feeds, each with its own subject
+        identity = u'\0'.join([identity, subject] + sorted(feed_urls))
+        return self.prefix + hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def begin(self, key):
+        """Marks a notification as in flight. Returns None if it should be
+        sent, or the existing record if it's a duplicate."""
+        try:
+            value = self.redis.eval(BEGIN_SCRIPT, 1, key, json.dumps({'state': IN_FLIGHT}), self.in_flight_ttl)
+        except redis.RedisError as error:
+            logger.warning('Could not check for a duplicate notification, sending it: %s', error)
+            return None
+        if value is None:
+            return None
+        self.duplicates += 1
+        return json.loads(value)
+
+    def complete(self, key, status, response):
+        """Records the response to a notification which was sent."""
+        try:
+            self.redis.setex(key, self.ttl, json.dumps({'state': SENT, 'status': status, 'response': response}))
+        except redis.RedisError as error:
+            logger.warning('Could not record a sent notification: %s', error)
+
+    def release(self, key):
+        """Forgets a notification which couldn't be sent, so it can be tried again."""
+        try:
+            self.redis.delete(key)
+        except redis.RedisError as error:
+            logger.warning('Could not release a notification which failed: %s', error)
+
+    def stats(self):
+        return {'duplicates': self.duplicates}
@@ -0,0 +1,65 @@
+import unittest
+
+import redis
+from mock import Mock
+
+from idempotency import IdempotencyStore, IN_FLIGHT, SENT
+from fake_redis import FakeRedis, real_redis
+
+
+class IdempotencyKeyTests(unittest.TestCase):
+    def setUp(self):
+        self.store = IdempotencyStore(FakeRedis(), ttl=3600)
+
+    def test_keys_prefer_the_content_item(self):
+        logging_params = {'content_id': 'abc', 'public_updated_at': '2017-02-28'}
+        self.assertEqual(self.store.key('request-1', logging_params, ['http://a.com/'], 'Subject'),
+                         self.store.key('request-2', logging_params, ['http://a.com/'], 'Subject'))
+        self.assertNotEqual(self.store.key('request-1', {}, ['http://a.com/'], 'Subject'),
+                            self.store.key('request-2', {}, ['http://a.com/'], 'Subject'))
+
+    def test_keys_depend_on_the_feeds_and_subject(self):
+        logging_params = {'content_id': 'abc', 'public_updated_at': '2017-02-28'}
+        key = self.store.key('request-1', logging_params, ['http://a.com/', 'http://b.com/'], 'Subject')
+        self.assertEqual(key, self.store.key('request-1', logging_params, ['http://b.com/', 'http://a.com/'], 'Subject'))
+        self.assertNotEqual(key, self.store.key('request-1', logging_params, ['http://a.com/'], 'Subject'))
+        self.assertNotEqual(key, self.store.key('request-1', logging_params, ['http://a.com/', 'http://b.com/'], 'Other'))
+
+    def test_notifications_without_an_identity_have_no_key(self):
+        self.assertEqual(None, self.store.key('', {'content_id': 'abc'}, ['http://a.com/'], 'Subject'))
+
+    def test_notifications_are_sent_when_redis_is_down(self):
+        self.store.redis = Mock(**{'eval.side_effect': redis.ConnectionError('down')})
+        self.assertEqual(None, self.store.begin(self.store.key('request-1', {}, ['http://a.com/'], 'Subject')))
+
+
+class IdempotencyStoreTests(unittest.TestCase):
+    """Runs BEGIN_SCRIPT against a real Redis"""
+    def setUp(self):
+        self.redis = real_redis()
+        self.store = IdempotencyStore(self.redis, ttl=3600, in_flight_ttl=60)
+        self.key = self.store.key('request-1', {}, ['http://a.com/'], 'Subject')
+
+    def test_the_first_notification_is_sent(self):
+        self.assertEqual(None, self.store.begin(self.key))
+        self.assertTrue(0 < self.redis.ttl(self.key) <= 60)
+
+    def test_duplicates_in_flight_are_reported(self):
+        self.store.begin(self.key)
+        self.assertEqual({'state': IN_FLIGHT}, self.store.begin(self.key))
+        self.assertEqual({'duplicates': 1}, self.store.stats())
+
+    def test_duplicates_of_sent_notifications_get_the_response(self):
+        self.store.begin(self.key)
+        self.store.complete(self.key, 201, {'success': True})
+        self.assertEqual({'state': SENT, 'status': 201, 'response': {'success': True}}, self.store.begin(self.key))
+        self.assertTrue(60 < self.redis.ttl(self.key) <= 3600)
+
+    def test_released_notifications_can_be_sent_again(self):
+        self.store.begin(self.key)
+        self.store.release(self.key)
+        self.assertEqual(None, self.store.begin(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
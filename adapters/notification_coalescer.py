@@ -0,0 +1,100 @@
+import hashlib
+import logging
+from collections import namedtuple
+
+__all__ = ['NotificationCoalescer', 'CoalescedNotification']
+
+logger = logging.getLogger(__name__)
+
+CoalescedNotification = namedtuple('CoalescedNotification', ['topic_ids', 'subject', 'body', 'body_ref', 'govuk_request_ids'])
+
+# Sets a key and its expiry in one step, as redis-py 2.7 has no SET NX EX
+SCHEDULE_SCRIPT = """
+if redis.call('setnx', KEYS[1], 1) == 1 then
+    redis.call('expire', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Removes the requests and topics which were sent from a group, and the
+# whole group if nothing was added to it meanwhile. Returns the number of
+# topics left.
+REMOVE_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('srem', KEYS[1], ARGV[i])
+end
+redis.call('ltrim', KEYS[2], ARGV[1], -1)
+local left = redis.call('scard', KEYS[1])
+if left == 0 then
+    redis.call('del', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+end
+return left
+"""
+
+
+class NotificationCoalescer(object):
+    """Buffers notifications in Redis for `window` seconds, so that those
+    with the same subject and body, like a document published to several
+    feeds at once, go out as one bulletin to all of their topics.
+
+    `add` returns a group the first time it's added to, and the caller
+    then arranges for the group to be sent once the window is over: it's
+    read with `peek`, and only removed with `remove` once it's been sent."""
+    def __init__(self, redis_client, window, prefix='govuk_delivery:coalesce:'):
+        self.redis = redis_client
+        self.window = window
+        self.prefix = prefix
+        # Groups which are never sent expire
+        self.ttl = window * 10 + 60
+        # If a group's flush is lost, the next notification added to it
+        # once this has passed schedules it again
+        self.schedule_ttl = window * 2 + 60
+
+    def group(self, subject, body=None, body_ref=None):
+        content = u'%s\0%s' % (subject, body_ref or body)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _keys(self, group):
+        key = self.prefix + group
+        return key + ':topics', key + ':requests', key + ':payload', key + ':scheduled'
+
+    def add(self, topic_ids, subject, body, govuk_request_id, body_ref=None):
+        """Buffers a notification. Returns its group if it's the first in
+        it, or else None. Raises RedisError if it couldn't be buffered."""
+        group = self.group(subject, body, body_ref)
+        topics, requests, payload, scheduled = self._keys(group)
+        pipe = self.redis.pipeline()
+        pipe.sadd(topics, *topic_ids)
+        pipe.rpush(requests, govuk_request_id)
+        pipe.hsetnx(payload, 'subject', subject)
+        pipe.hsetnx(payload, 'body_ref' if body_ref else 'body', body_ref or body)
+        for key in (topics, requests, payload):
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+        if self.redis.eval(SCHEDULE_SCRIPT, 1, scheduled, self.schedule_ttl):
+            return group
+        return None
+
+    def peek(self, group):
+        """Returns the CoalescedNotification to send for a group, or None
+        if it's empty, leaving the group in place."""
+        topics, requests, payload, scheduled = self._keys(group)
+        pipe = self.redis.pipeline()
+        pipe.smembers(topics)
+        pipe.lrange(requests, 0, -1)
+        pipe.hgetall(payload)
+        topic_ids, govuk_request_ids, fields = pipe.execute()
+        if not topic_ids:
+            return None
+        return CoalescedNotification(sorted(topic_ids), fields.get('subject'), fields.get('body'),
+                                     fields.get('body_ref'), govuk_request_ids)
+
+    def remove(self, group, notification):
+        """Removes a notification returned by `peek` from its group once
+        it's been sent. Returns the number of topics added to the group
+        since, which still need sending; if there are none the group is
+        emptied, so the next notification added schedules it again."""
+        keys = list(self._keys(group))
+        arguments = [len(notification.govuk_request_ids)] + list(notification.topic_ids)
+        return self.redis.eval(REMOVE_SCRIPT, len(keys), *(keys + arguments))
@@ -0,0 +1,64 @@
+import unittest
+
+from fake_redis import real_redis
+from notification_coalescer import NotificationCoalescer
+
+
+class NotificationCoalescerTests(unittest.TestCase):
+    """Runs against a real Redis, as scheduling and removing groups are
+    done by Lua scripts"""
+    def setUp(self):
+        self.redis = real_redis()
+        self.coalescer = NotificationCoalescer(self.redis, window=5)
+
+    def test_the_first_notification_in_a_group_schedules_it(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        self.assertEqual(self.coalescer.group('Subject', '<p>Body</p>'), group)
+        self.assertEqual(None, self.coalescer.add(['TOPIC_2'], 'Subject', '<p>Body</p>', 'request-2'))
+
+    def test_a_lost_schedule_expires_so_the_group_is_scheduled_again(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        scheduled = self.coalescer._keys(group)[3]
+        self.assertTrue(0 < self.redis.ttl(scheduled) <= self.coalescer.schedule_ttl)
+        self.redis.delete(scheduled)
+        self.assertEqual(group, self.coalescer.add(['TOPIC_2'], 'Subject', '<p>Body</p>', 'request-2'))
+
+    def test_notifications_with_the_same_content_are_sent_together(self):
+        group = self.coalescer.add(['TOPIC_1', 'TOPIC_2'], 'Subject', '<p>Body</p>', 'request-1')
+        self.coalescer.add(['TOPIC_2', 'TOPIC_3'], 'Subject', '<p>Body</p>', 'request-2')
+        notification = self.coalescer.peek(group)
+        self.assertEqual(['TOPIC_1', 'TOPIC_2', 'TOPIC_3'], notification.topic_ids)
+        self.assertEqual(('Subject', '<p>Body</p>', None), (notification.subject, notification.body, notification.body_ref))
+        self.assertEqual(['request-1', 'request-2'], notification.govuk_request_ids)
+
+    def test_notifications_with_different_content_are_kept_apart(self):
+        first = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        second = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Other</p>', 'request-2')
+        self.assertNotEqual(first, second)
+        self.assertEqual(['request-1'], self.coalescer.peek(first).govuk_request_ids)
+
+    def test_bodies_by_reference_are_kept_as_references(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', None, 'request-1', body_ref='sha256:abc')
+        self.assertEqual('sha256:abc', self.coalescer.peek(group).body_ref)
+
+    def test_peeking_leaves_the_group_in_place(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        self.assertEqual(self.coalescer.peek(group), self.coalescer.peek(group))
+
+    def test_removing_a_sent_group_empties_it_and_allows_another(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        self.assertEqual(0, self.coalescer.remove(group, self.coalescer.peek(group)))
+        self.assertEqual(None, self.coalescer.peek(group))
+        self.assertEqual(group, self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-2'))
+
+    def test_removing_keeps_notifications_added_while_sending(self):
+        group = self.coalescer.add(['TOPIC_1'], 'Subject', '<p>Body</p>', 'request-1')
+        notification = self.coalescer.peek(group)
+        self.coalescer.add(['TOPIC_1', 'TOPIC_2'], 'Subject', '<p>Body</p>', 'request-2')
+        self.assertEqual(1, self.coalescer.remove(group, notification))
+        left = self.coalescer.peek(group)
+        self.assertEqual((['TOPIC_2'], ['request-2']), (left.topic_ids, left.govuk_request_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,149 @@
-import requests
+import os
 import json
+import time
+import atexit
+import Queue
+import logging
+import threading
+
+from http_transport import HTTPTransport
+from notification_spool import is_rejected
+
+logger = logging.getLogger(__name__)
 
 class NotificationLog(object):
-    def __init__(self, hostname='email-alert-api.dev.gov.uk', protocol='http'):
+    """Posts notification log entries to email-alert-api.
+
+    Given a `batch_size`, entries are queued and posted from a background
+    thread whenever that many are waiting or `flush_interval` seconds have
+    passed, so callers never wait on email-alert-api. email-alert-api takes
+    one entry per request, so a batch is posted over one kept-alive
+    connection. Entries which can't be posted are handed to `failed`; if
+    more than `max_queue_size` are waiting new ones are dropped.
+
+    Given a NotificationSpool, entries which can't be posted, except those
+    email-alert-api rejects, are kept there to be replayed later."""
+    def __init__(self, hostname='email-alert-api.dev.gov.uk', protocol='http', timeout=5,
+                 batch_size=None, flush_interval=0.5, max_queue_size=10000, transport=None,
+                 spool=None):
         self.hostname = hostname
         self.protocol = protocol
+        self.transport = transport or HTTPTransport.shared(('notification_log', protocol, hostname),
+                                                           pool_size=1, timeout=timeout)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.queue = Queue.Queue(max_queue_size)
+        self.lock = threading.Lock()
+        self._thread_pid = None
 
     def _api_url(self):
         url = '%s://%s/notification_logs.json' % (self.protocol, self.hostname)
         return url
 
     def _post(self, params):
-        response = requests.post(self._api_url(), data=json.dumps(params), headers={'content-type': 'application/json'})
+        response = self.transport.request('POST', self._api_url(), data=json.dumps(params), headers={'content-type': 'application/json'})
         return self._parse_response(response)
 
     def _parse_response(self, response):
         response.raise_for_status()
         return response.json()
 
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked child which doesn't inherit it
+        if self._thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self._thread_pid != os.getpid():
+                thread = threading.Thread(target=self._ship_continuously, name='notification-log')
+                thread.daemon = True
+                thread.start()
+                if self._thread_pid is None:
+                    atexit.register(self.flush)
+                self._thread_pid = os.getpid()
+
+    def _next_batch(self):
+        """Waits for an entry, then for the rest of a batch for up to
+        flush_interval seconds."""
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _ship_continuously(self):
+        while True:
+            self.ship(self._next_batch())
+
+    def replay(self, params):
+        """Posts an entry taken from the spool."""
+        return self._post(params)
+
+    def ship(self, batch):
+        for params in batch:
+            try:
+                self._post(params)
+            except Exception as error:
+                self.failed(params, error)
+        if self.spool:
+            self.spool.sync()
+
+    def _spool(self, params, error):
+        if not self.spool or is_rejected(error):
+            return False
+        try:
+            self.spool.append(params)
+        except (IOError, OSError) as spool_error:
+            logger.error('Could not spool notification log for request id %s: %s',
+                         params.get('govuk_request_id'), spool_error)
+            return False
+        return True
+
+    def failed(self, params, error):
+        spooled = self._spool(params, error)
+        logger.warning('Could not create notification log for request id %s, content id %s%s: %s',
+                       params.get('govuk_request_id'), params.get('content_id'),
+                       ', spooled it' if spooled else '', error)
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return batch
+
+    def flush(self):
+        """Posts every queued entry from the calling thread."""
+        self.ship(self._drain())
+
+    def close(self):
+        """Empties the queue before the process exits. Queued entries are
+        spooled to be replayed later, as there may not be time to post
+        them, or posted if there's no spool.
+
+        Celery's prefork children leave with os._exit, so this is called
+        from the worker_process_shutdown signal rather than atexit."""
+        batch = self._drain()
+        if not self.spool:
+            return self.ship(batch)
+        for params in batch:
+            self._spool(params, 'the process is exiting')
+        self.spool.close()
+
+    def enqueue(self, params):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(params)
+        except Queue.Full:
+            self.failed(params, 'the queue is full')
+
     def create_notification_log(self, enabled_gov_delivery_ids, disabled_gov_delivery_ids, content_id, public_updated_at, govuk_request_id):
         post_data = {
             'gov_delivery_ids': enabled_gov_delivery_ids + disabled_gov_delivery_ids, # kept for backwards compatibility with EmailAlertApi
@@ -29,4 +155,11 @@ class NotificationLog(object):
             'emailing_app': 'gov_uk_delivery',
             'publishing_app': 'whitehall'
         }
-        return self._post(post_data)
+        if self.batch_size:
+            return self.enqueue(post_data)
+        try:
+            return self._post(post_data)
+        except Exception as error:
+            if self._spool(post_data, error):
+                self.spool.sync()
+            raise
@@ -1,10 +1,12 @@
 import unittest
 
 from httpretty import HTTPretty
+from mock import patch, Mock
 
 from notification_log import NotificationLog
 import requests
 import json
+import time
 
 class NotificationLogTests(unittest.TestCase):
     def setUp(self):
@@ -71,5 +73,72 @@ class NotificationLogTests(unittest.TestCase):
         self.assertRaises(requests.HTTPError, self.client.create_notification_log, ['ENABLED_TOPIC_ID'], ['DISABLED_TOPIC_ID'], 'content_id', 'updated_at', 'request_id')
 
 
+class BatchedNotificationLogTests(unittest.TestCase):
+    def setUp(self):
+        self.client = NotificationLog(hostname='test.example.com', protocol='http', batch_size=2)
+
+    @patch.object(NotificationLog, '_ensure_thread')
+    @patch.object(NotificationLog, '_post')
+    def test_queues_entries_instead_of_posting_them(self, mock_post, mock_thread):
+        self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', 'request_id')
+        assert not mock_post.called
+        self.assertEqual(1, self.client.queue.qsize())
+
+    @patch.object(NotificationLog, '_ensure_thread')
+    @patch.object(NotificationLog, '_post')
+    def test_batches_are_limited_in_size(self, mock_post, mock_thread):
+        for request_id in ['1', '2', '3']:
+            self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', request_id)
+        self.assertEqual(['1', '2'], [params['govuk_request_id'] for params in self.client._next_batch()])
+
+    @patch.object(NotificationLog, '_ensure_thread')
+    @patch.object(NotificationLog, '_post', side_effect=requests.ConnectionError('down'))
+    @patch.object(NotificationLog, 'failed')
+    def test_failed_entries_are_handed_on(self, mock_failed, mock_post, mock_thread):
+        self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', 'request_id')
+        self.client.flush()
+        self.assertEqual(1, mock_failed.call_count)
+        self.assertEqual('request_id', mock_failed.call_args[0][0]['govuk_request_id'])
+
+    @patch.object(NotificationLog, '_post')
+    def test_background_thread_posts_queued_entries(self, mock_post):
+        self.client.flush_interval = 0.01
+        self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', 'request_id')
+        for _ in range(100):
+            if mock_post.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, mock_post.call_count)
+
+
+class SpooledNotificationLogTests(unittest.TestCase):
+    def setUp(self):
+        self.spool = Mock()
+        self.client = NotificationLog(hostname='test.example.com', protocol='http', spool=self.spool)
+
+    @patch.object(NotificationLog, '_post', side_effect=requests.ConnectionError('down'))
+    def test_spools_entries_which_could_not_be_posted(self, mock_post):
+        with self.assertRaises(requests.ConnectionError):
+            self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', 'request_id')
+        self.assertEqual('request_id', self.spool.append.call_args[0][0]['govuk_request_id'])
+        self.spool.sync.assert_called_once_with()
+
+    @patch.object(NotificationLog, '_ensure_thread')
+    @patch.object(NotificationLog, '_post')
+    def test_spools_queued_entries_on_close(self, mock_post, mock_thread):
+        self.client.batch_size = 2
+        self.client.create_notification_log(['TOPIC_1'], [], 'content_id', 'updated_at', 'request_id')
+        self.client.close()
+        assert not mock_post.called
+        self.assertEqual('request_id', self.spool.append.call_args[0][0]['govuk_request_id'])
+        self.spool.close.assert_called_once_with()
+
+    def test_does_not_spool_rejected_entries(self):
+        error = requests.HTTPError('422')
+        error.response = Mock(status_code=422)
+        self.client.failed({'govuk_request_id': 'request_id'}, error)
+        assert not self.spool.append.called
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import errno
+import atexit
+import logging
+import threading
+
+import requests
+
+__all__ = ['NotificationSpool', 'SpoolReplayer', 'is_rejected']
+
+logger = logging.getLogger(__name__)
+
+# A segment being written, one which is finished and one being replayed
+OPEN = '.open'
+SEALED = '.spool'
+CLAIMED = '.replaying'
+
+
+def is_rejected(error):
+    """Whether email-alert-api turned an entry down, so that posting it
+    again won't help."""
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None and 400 <= response.status_code < 500
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+class NotificationSpool(object):
+    """Keeps notification log entries which couldn't be posted in
+    append-only segment files in `directory`, one JSON entry a line.
+
+    Each process writes its own segment, which is sealed once it's
+    `segment_size` bytes or `segment_age` seconds old. Entries are written
+    straight through, so they survive the process dying, and fsynced every
+    `fsync_every` entries or `fsync_interval` seconds, on `sync` and when a
+    segment is sealed, so they survive the host going down. Segment names
+    start with the time they were opened, so sorted names give the order
+    entries were spooled in."""
+    def __init__(self, directory, segment_size=1024 * 1024, segment_age=60, fsync_every=100, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_pid = None
+        self.appended = 0
+        self.exit_registered = False
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    def current_time(self):
+        return time.time()
+
+    def _open_segment(self):
+        now = self.current_time()
+        stem = '%016d-%d' % (now * 1000000, os.getpid())
+        self.path = os.path.join(self.directory, stem + OPEN)
+        self.file = open(self.path, 'ab')
+        self.file_pid = os.getpid()
+        self.opened = self.synced = now
+        self.unsynced = 0
+        if not self.exit_registered:
+            atexit.register(self.close)
+            self.exit_registered = True
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced = self.current_time()
+
+    def _seal(self):
+        self._sync()
+        self.file.close()
+        self.file = None
+        try:
+            os.rename(self.path, self.path[:-len(OPEN)] + SEALED)
+        except OSError as error:
+            # A replayer took it for abandoned, and has it already
+            logger.warning('Could not seal notification log spool segment %s: %s', self.path, error)
+
+    def append(self, params):
+        line = json.dumps(params) + '\n'
+        with self.lock:
+            if self.file_pid != os.getpid():
+                # A forked child starts its own segment rather than write to
+                # its parent's. Nothing is left buffered to be written twice.
+                self.file = None
+            now = self.current_time()
+            if self.file is None:
+                self._open_segment()
+            elif self.file.tell() >= self.segment_size or now - self.opened >= self.segment_age:
+                self._seal()
+                self._open_segment()
+            self.file.write(line)
+            self.file.flush()
+            self.appended += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every or now - self.synced >= self.fsync_interval:
+                self._sync()
+
+    def sync(self):
+        """fsyncs any entries written since the last time."""
+        with self.lock:
+            if self.file is not None and self.file_pid == os.getpid() and self.unsynced:
+                self._sync()
+
+    def close(self):
+        """Seals this process's segment, so it can be replayed straight away."""
+        with self.lock:
+            if self.file is not None and self.file_pid == os.getpid():
+                self._seal()
+
+    def _ready(self, name, now):
+        if not name.endswith((OPEN, SEALED, CLAIMED)):
+            return False
+        parts = name.split('.')
+        writer_pid = int(parts[0].split('-')[1])
+        if name.endswith(SEALED):
+            return True
+        if name.endswith(OPEN):
+            if not process_alive(writer_pid):
+                return True
+            # Its writer would seal it before writing to it again
+            try:
+                return now - os.path.getmtime(os.path.join(self.directory, name)) >= 2 * self.segment_age
+            except OSError:
+                return False
+        if name.endswith(CLAIMED):
+            # Left by a replayer which died
+            return not process_alive(int(parts[1]))
+
+    def segments(self):
+        """The segments ready to be replayed, oldest first: sealed ones and
+        open ones whose writer has died or stopped writing to them."""
+        now = time.time()
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if self._ready(name, now)]
+
+    def stats(self):
+        """Entries spooled by this process, and the segments and bytes
+        waiting to be replayed, counting those still being written."""
+        segments, size = 0, 0
+        for name in os.listdir(self.directory):
+            if name.endswith((OPEN, SEALED, CLAIMED)):
+                try:
+                    size += os.path.getsize(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                segments += 1
+        return {'appended': self.appended, 'segments': segments, 'bytes': size}
+
+
+class SpoolReplayer(object):
+    """Posts spooled entries with `post`, oldest first and at most `rate`
+    a second.
+
+    Each segment is renamed while it's replayed, so two replayers never
+    post the same entries. If posting fails the rest of the segment is put
+    back and the run stops, to be tried again later. Entries rejected
+    outright are dropped, as posting them again won't help."""
+    def __init__(self, spool, post, rate=10):
+        self.spool = spool
+        self.post = post
+        self.rate = rate
+        self.replayed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.started = None
+        self.next_post = 0
+
+    def current_time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def throttle(self):
+        now = self.current_time()
+        if self.next_post > now:
+            self.sleep(self.next_post - now)
+            now = self.next_post
+        self.next_post = now + 1.0 / self.rate
+
+    def _put_back(self, claimed, stem, lines):
+        temporary = claimed + '.tmp'
+        with open(temporary, 'wb') as segment:
+            segment.writelines(lines)
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.rename(temporary, os.path.join(self.spool.directory, stem + SEALED))
+        os.remove(claimed)
+
+    def replay_segment(self, path):
+        """Replays one segment, returning False if posting failed."""
+        stem = os.path.basename(path).split('.')[0]
+        claimed = os.path.join(self.spool.directory, '%s.%d%s' % (stem, os.getpid(), CLAIMED))
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            # Another replayer got there first
+            return True
+        with open(claimed, 'rb') as segment:
+            lines = segment.readlines()
+
+        for index, line in enumerate(lines):
+            try:
+                params = json.loads(line)
+            except ValueError:
+                # Most likely the last line of a segment whose writer died
+                logger.warning('Dropping unreadable notification log entry from %s', claimed)
+                self.dropped += 1
+                continue
+            self.throttle()
+            try:
+                self.post(params)
+            except Exception as error:
+                if is_rejected(error):
+                    logger.warning('Dropping notification log entry for request id %s: %s', params.get('govuk_request_id'), error)
+                    self.dropped += 1
+                    continue
+                logger.warning('Could not replay notification log entries, %d left in %s: %s', len(lines) - index, stem, error)
+                self.failed += 1
+                self._put_back(claimed, stem, lines[index:])
+                return False
+            self.replayed += 1
+        os.remove(claimed)
+        return True
+
+    def run(self):
+        """Replays every segment which is ready, stopping at the first
+        entry which can't be posted. Returns whether the spool was drained."""
+        if self.started is None:
+            self.started = self.current_time()
+        for path in self.spool.segments():
+            if not self.replay_segment(path):
+                return False
+        return True
+
+    def stats(self):
+        elapsed = self.current_time() - self.started if self.started is not None else 0
+        stats = {
+            'replayed': self.replayed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'per_second': self.replayed / elapsed if elapsed else 0.0,
+        }
+        stats['backlog'] = self.spool.stats()
+        return stats
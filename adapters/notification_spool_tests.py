@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import requests
+from mock import Mock, patch
+
+import notification_spool
+from notification_spool import NotificationSpool, SpoolReplayer, is_rejected
+
+
+def http_error(status_code):
+    error = requests.HTTPError('HTTP %d' % status_code)
+    error.response = Mock(status_code=status_code)
+    return error
+
+
+class NotificationSpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = NotificationSpool(os.path.join(self.directory, 'spool'), segment_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        entries = []
+        for path in self.spool.segments():
+            with open(path) as segment:
+                entries.extend(json.loads(line) for line in segment)
+        return entries
+
+    def test_open_segments_are_not_ready_to_replay(self):
+        self.spool.append({'govuk_request_id': '1'})
+        self.assertEqual([], self.spool.segments())
+
+    def test_closed_segments_are_ready_to_replay(self):
+        self.spool.append({'govuk_request_id': '1'})
+        self.spool.close()
+        self.assertEqual([{'govuk_request_id': '1'}], self.entries())
+
+    def test_full_segments_are_sealed(self):
+        for request_id in range(5):
+            self.spool.append({'govuk_request_id': str(request_id), 'padding': 'x' * 40})
+        self.spool.close()
+        self.assertEqual(['0', '1', '2', '3', '4'], [entry['govuk_request_id'] for entry in self.entries()])
+        self.assertTrue(len(self.spool.segments()) > 1)
+
+    @patch.object(notification_spool.os, 'fsync')
+    def test_fsyncs_are_batched(self, mock_fsync):
+        self.spool.fsync_every = 3
+        self.spool.fsync_interval = 60
+        for request_id in range(4):
+            self.spool.append({'govuk_request_id': str(request_id)})
+        self.assertEqual(1, mock_fsync.call_count)
+        self.spool.sync()
+        self.assertEqual(2, mock_fsync.call_count)
+
+    @patch.object(notification_spool, 'process_alive', return_value=False)
+    def test_segments_of_dead_writers_are_ready_to_replay(self, mock_alive):
+        self.spool.append({'govuk_request_id': '1'})
+        self.assertEqual([{'govuk_request_id': '1'}], self.entries())
+
+    def test_stats_count_the_backlog(self):
+        self.spool.append({'govuk_request_id': '1'})
+        stats = self.spool.stats()
+        self.assertEqual(1, stats['appended'])
+        self.assertEqual(1, stats['segments'])
+        self.assertTrue(stats['bytes'] > 0)
+
+
+class SpoolReplayerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = NotificationSpool(self.directory)
+        for request_id in ['1', '2', '3']:
+            self.spool.append({'govuk_request_id': request_id})
+        self.spool.close()
+        self.posted = []
+        self.replayer = SpoolReplayer(self.spool, self.posted.append, rate=1000)
+        self.replayer.sleep = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replays_every_entry_in_order_and_empties_the_spool(self):
+        self.assertTrue(self.replayer.run())
+        self.assertEqual(['1', '2', '3'], [params['govuk_request_id'] for params in self.posted])
+        self.assertEqual([], self.spool.segments())
+        self.assertEqual(3, self.replayer.stats()['replayed'])
+
+    def test_puts_back_what_is_left_when_posting_fails(self):
+        self.replayer.post = Mock(side_effect=[None, requests.ConnectionError('down')])
+        self.assertFalse(self.replayer.run())
+
+        self.replayer.post = self.posted.append
+        self.assertTrue(self.replayer.run())
+        self.assertEqual(['2', '3'], [params['govuk_request_id'] for params in self.posted])
+
+    def test_drops_rejected_entries(self):
+        self.replayer.post = Mock(side_effect=[http_error(422), None, None])
+        self.assertTrue(self.replayer.run())
+        self.assertEqual(1, self.replayer.stats()['dropped'])
+        self.assertEqual(2, self.replayer.stats()['replayed'])
+
+    def test_limits_the_rate(self):
+        self.replayer.rate = 2
+        self.replayer.current_time = Mock(return_value=100.0)
+        self.replayer.run()
+        self.assertEqual(2, self.replayer.sleep.call_count)
+        self.assertAlmostEqual(0.5, self.replayer.sleep.call_args_list[0][0][0])
+
+
+class IsRejectedTests(unittest.TestCase):
+    def test_client_errors_are_rejections(self):
+        assert is_rejected(http_error(422))
+
+    def test_server_and_connection_errors_are_not(self):
+        assert not is_rejected(http_error(503))
+        assert not is_rejected(requests.ConnectionError('down'))
+
+
+if __name__ == '__main__':
+    unittest.main()
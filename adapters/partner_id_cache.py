@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+import redis
+
+__all__ = ['LRUCache', 'RedisCache', 'TieredCache']
+
+logger = logging.getLogger(__name__)
+
+# Seconds to remember how many times a shared cache key was invalidated.
+# It only has to outlast a lookup between reading a key's generation and
+# storing what it found.
+GENERATION_TTL = 24 * 60 * 60
+
+# Stores each value only if its key hasn't been invalidated since the
+# caller read its generation. KEYS are value and generation key pairs,
+# ARGV the TTL followed by value and generation pairs. Returns 1 for each
+# value stored and 0 for each skipped.
+SET_IF_GENERATION_SCRIPT = """
+local stored = {}
+for i = 1, #KEYS, 2 do
+    if (redis.call('get', KEYS[i + 1]) or '0') == ARGV[i + 2] then
+        redis.call('setex', KEYS[i], ARGV[1], ARGV[i + 1])
+        stored[#stored + 1] = 1
+    else
+        stored[#stored + 1] = 0
+    end
+end
+return stored
+"""
+
+
+class LRUCache(object):
+    """A bounded, thread-safe least-recently-used cache.
+
+    Entries expire `ttl` seconds after they were stored. Hit, miss and
+    eviction counts are kept so the cache can be sized against real load.
+
+    Every cache counts how many times each key was invalidated. A caller
+    reads those `generations` before looking values up elsewhere and hands
+    them to `set_many`, which skips keys invalidated in the meantime, so a
+    value read before a write is never cached after it."""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.invalidations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def current_time(self):
+        return time.time()
+
+    def get_many(self, keys):
+        """Returns a dict of the keys found in the cache."""
+        now = self.current_time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is None or entry[0] < now:
+                    self.misses += 1
+                    continue
+                # Re-insert to mark as most recently used
+                self.entries[key] = entry
+                found[key] = entry[1]
+                self.hits += 1
+        return found
+
+    def generations(self, keys):
+        with self.lock:
+            return dict((key, self.invalidations.get(key, 0)) for key in keys)
+
+    def set_many(self, mapping, generations=None):
+        """Stores values, skipping any whose generation has changed if
+        `generations` is given. Returns the keys stored."""
+        expires = self.current_time() + self.ttl
+        stored = []
+        with self.lock:
+            for key, value in mapping.items():
+                if generations is not None and generations.get(key) != self.invalidations.get(key, 0):
+                    continue
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+                stored.append(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return stored
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.invalidations[key] = self.invalidations.get(key, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RedisCache(object):
+    """A cache shared by every process, stored as JSON in Redis.
+
+    Redis errors are logged and treated as misses so that lookups fall
+    back to the repository rather than failing."""
+    def __init__(self, redis_client, ttl, prefix='govuk_delivery:partner_id:'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key):
+        return '%s%s' % (self.prefix, key)
+
+    def _generation_key(self, key):
+        return '%sgeneration:%s' % (self.prefix, key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = self.redis.mget([self._key(key) for key in keys])
+        except redis.RedisError as error:
+            self.errors += 1
+            logger.warning('Could not read from the shared cache: %s', error)
+            return {}
+
+        found = dict((key, json.loads(value)) for key, value in zip(keys, values) if value is not None)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def generations(self, keys):
+        """Returns the generation of each key, or none of them if Redis
+        can't be reached, so that nothing is stored."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = self.redis.mget([self._generation_key(key) for key in keys])
+        except redis.RedisError as error:
+            self.errors += 1
+            logger.warning('Could not read from the shared cache: %s', error)
+            return {}
+        return dict((key, value or '0') for key, value in zip(keys, values))
+
+    def set_many(self, mapping, generations=None):
+        """Stores values, skipping any whose generation has changed if
+        `generations` is given. Returns the keys stored."""
+        if generations is not None:
+            mapping = dict((key, value) for key, value in mapping.items() if key in generations)
+        if not mapping:
+            return []
+        keys = list(mapping)
+        try:
+            if generations is None:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in keys:
+                    pipe.setex(self._key(key), self.ttl, json.dumps(mapping[key]))
+                pipe.execute()
+                return keys
+            script_keys, script_args = [], [self.ttl]
+            for key in keys:
+                script_keys.extend([self._key(key), self._generation_key(key)])
+                script_args.extend([json.dumps(mapping[key]), generations[key]])
+            stored = self.redis.eval(SET_IF_GENERATION_SCRIPT, len(script_keys), *(script_keys + script_args))
+            return [key for key, was_stored in zip(keys, stored) if was_stored]
+        except redis.RedisError as error:
+            self.errors += 1
+            logger.warning('Could not write to the shared cache: %s', error)
+            return []
+
+    def invalidate(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(*[self._key(key) for key in keys])
+            for key in keys:
+                pipe.incr(self._generation_key(key))
+                pipe.expire(self._generation_key(key), GENERATION_TTL)
+            pipe.execute()
+        except redis.RedisError as error:
+            self.errors += 1
+            logger.warning('Could not invalidate the shared cache: %s', error)
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+        }
+
+
+class TieredCache(object):
+    """An in-process cache backed by a cache shared between processes.
+
+    Invalidations are published on a Redis channel. Every process listens
+    on that channel from a background thread and drops the keys from its
+    own local cache, so a write in one process is seen by all of them."""
+    def __init__(self, local, shared, redis_client, channel='govuk_delivery:partner_id:invalidate'):
+        self.local = local
+        self.shared = shared
+        self.redis = redis_client
+        self.channel = channel
+        self.listener_pid = None
+        self.listener_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # The listener thread is started lazily so that it's created in
+        # each worker after forking, not in the parent process.
+        if self.listener_pid == os.getpid():
+            return
+        with self.listener_lock:
+            if self.listener_pid != os.getpid():
+                self.local.clear()
+                thread = threading.Thread(target=self._listen, name='partner-id-cache-invalidation')
+                thread.daemon = True
+                thread.start()
+                self.listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(self.channel)
+                # Anything published while we weren't subscribed has been
+                # missed, so start again from an empty local cache.
+                self.local.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.local.invalidate(json.loads(message['data']))
+            except Exception as error:
+                logger.warning('Lost the shared cache invalidation channel: %s', error)
+            self.local.clear()
+            time.sleep(1)
+
+    def get_many(self, keys):
+        self._ensure_listener()
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            # An invalidation which arrives while the shared cache is read
+            # stops the value being kept locally
+            generations = self.local.generations(missing)
+            shared = self.shared.get_many(missing)
+            self.local.set_many(shared, generations)
+            found.update(shared)
+        return found
+
+    def generations(self, keys):
+        return self.local.generations(keys), self.shared.generations(keys)
+
+    def set_many(self, mapping, generations=None):
+        if generations is None:
+            self.local.set_many(mapping)
+            return self.shared.set_many(mapping)
+        local_generations, shared_generations = generations
+        stored = self.shared.set_many(mapping, shared_generations)
+        # Values another process's write kept out of the shared cache are
+        # kept out of this one too
+        self.local.set_many(dict((key, mapping[key]) for key in stored), local_generations)
+        return stored
+
+    def invalidate(self, keys):
+        keys = list(keys)
+        self.local.invalidate(keys)
+        self.shared.invalidate(keys)
+        try:
+            self.redis.publish(self.channel, json.dumps(keys))
+        except redis.RedisError as error:
+            logger.warning('Could not publish a shared cache invalidation: %s', error)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return {
+            'local': self.local.stats(),
+            'shared': self.shared.stats(),
+        }
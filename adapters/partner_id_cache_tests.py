@@ -0,0 +1,144 @@
+import json
+import unittest
+
+import redis
+from mock import patch
+
+from fake_redis import FakeRedis, real_redis
+from partner_id_cache import LRUCache, RedisCache, SET_IF_GENERATION_SCRIPT, TieredCache
+
+
+@patch.object(LRUCache, 'current_time', return_value=1000)
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(max_size=2, ttl=60)
+
+    def test_returns_stored_values(self, fake_time):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+
+    def test_counts_hits_and_misses(self, fake_time):
+        self.cache.set_many({'a': 1})
+        self.cache.get_many(['a', 'b'])
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_evicts_least_recently_used_entry(self, fake_time):
+        self.cache.set_many({'a': 1})
+        self.cache.set_many({'b': 2})
+        self.cache.get_many(['a'])
+        self.cache.set_many({'c': 3})
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expires_entries_after_ttl(self, fake_time):
+        self.cache.set_many({'a': 1})
+        fake_time.return_value = 1061
+        self.assertEqual(self.cache.get_many(['a']), {})
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_invalidates_entries(self, fake_time):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.cache.get_many(['a', 'b']), {'b': 2})
+
+    def test_does_not_store_values_invalidated_since_their_generation_was_read(self, fake_time):
+        generations = self.cache.generations(['a', 'b'])
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.cache.set_many({'a': 1, 'b': 2}, generations), ['b'])
+        self.assertEqual(self.cache.get_many(['a', 'b']), {'b': 2})
+
+
+class RedisCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.cache = RedisCache(self.redis, ttl=60, prefix='test:')
+
+    def test_stores_values_as_json(self):
+        self.cache.set_many({'a': ['TOPIC_1', False]})
+        self.assertEqual(self.redis.values, {'test:a': '["TOPIC_1", false]'})
+        self.assertEqual(self.cache.get_many(['a', 'b']), {'a': ['TOPIC_1', False]})
+
+    def test_invalidates_entries(self):
+        self.cache.set_many({'a': 1})
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.cache.get_many(['a']), {})
+
+    def test_invalidating_moves_the_generation_on(self):
+        self.assertEqual(self.cache.generations(['a']), {'a': '0'})
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.cache.generations(['a']), {'a': '1'})
+
+    @patch.object(FakeRedis, 'eval', return_value=[0])
+    def test_stores_values_only_if_their_generation_is_unchanged(self, fake_eval):
+        self.assertEqual(self.cache.set_many({'a': 1}, {'a': '0'}), [])
+        fake_eval.assert_called_once_with(SET_IF_GENERATION_SCRIPT, 2, 'test:a', 'test:generation:a', 60, '1', '0')
+
+    @patch.object(FakeRedis, 'mget', side_effect=redis.ConnectionError('down'))
+    def test_stores_nothing_when_generations_cannot_be_read(self, fake_mget):
+        self.assertEqual(self.cache.set_many({'a': 1}, self.cache.generations(['a'])), [])
+        self.assertEqual(self.redis.values, {})
+
+    @patch.object(FakeRedis, 'mget', side_effect=redis.ConnectionError('down'))
+    def test_treats_redis_errors_as_misses(self, fake_mget):
+        self.assertEqual(self.cache.get_many(['a']), {})
+        self.assertEqual(self.cache.stats()['errors'], 1)
+
+
+class RedisCacheGenerationTestCase(unittest.TestCase):
+    """Runs SET_IF_GENERATION_SCRIPT against a real Redis"""
+    def setUp(self):
+        self.redis = real_redis()
+        self.cache = RedisCache(self.redis, ttl=60, prefix='test:')
+
+    def test_stores_values_whose_generation_is_unchanged(self):
+        generations = self.cache.generations(['a', 'b'])
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.cache.set_many({'a': 1, 'b': 2}, generations), ['b'])
+        self.assertEqual(self.cache.get_many(['a', 'b']), {'b': 2})
+        self.assertTrue(0 < self.redis.ttl('test:b') <= 60)
+
+
+@patch.object(TieredCache, '_ensure_listener')
+class TieredCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.local = LRUCache(max_size=10, ttl=60)
+        self.shared = RedisCache(self.redis, ttl=60)
+        self.cache = TieredCache(self.local, self.shared, self.redis, channel='invalidate')
+
+    def test_fills_the_local_cache_from_the_shared_cache(self, fake_listener):
+        self.shared.set_many({'a': 1})
+        self.assertEqual(self.cache.get_many(['a']), {'a': 1})
+        self.assertEqual(self.local.get_many(['a']), {'a': 1})
+
+    def test_invalidation_is_published_to_other_processes(self, fake_listener):
+        self.cache.set_many({'a': 1})
+        self.cache.invalidate(['a'])
+        self.assertEqual(self.local.get_many(['a']), {})
+        self.assertEqual(self.shared.get_many(['a']), {})
+        self.assertEqual(self.redis.published, [('invalidate', json.dumps(['a']))])
+
+    def test_values_read_before_an_invalidation_are_not_kept_locally(self, fake_listener):
+        self.shared.set_many({'a': 1})
+        original_get_many = self.shared.get_many
+
+        def invalidated_while_reading(keys):
+            found = original_get_many(keys)
+            self.local.invalidate(keys)
+            return found
+
+        with patch.object(self.shared, 'get_many', side_effect=invalidated_while_reading):
+            self.assertEqual(self.cache.get_many(['a']), {'a': 1})
+        self.assertEqual(self.local.get_many(['a']), {})
+
+    @patch.object(RedisCache, 'set_many', return_value=['b'])
+    def test_only_values_stored_in_the_shared_cache_are_kept_locally(self, fake_set_many, fake_listener):
+        generations = self.cache.generations(['a', 'b'])
+        self.assertEqual(self.cache.set_many({'a': 1, 'b': 2}, generations), ['b'])
+        self.assertEqual(self.local.get_many(['a', 'b']), {'b': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import datetime
 
 from collections import OrderedDict, namedtuple
 
+from topic_storage import TopicStorage, MongoTopicStorage, Index, IndexReport, INDEXES
+
 FindResponse = namedtuple('Response', ['topic_id', 'disabled'])
 
 def sort_url_query(url):
@@ -21,30 +23,132 @@ def sort_url_query(url):
 
 
 class PartnerIdRepository(object):
-    def __init__(self, db_collection):
-        self.collection = db_collection
+    def __init__(self, storage, cache=None, index=None, max_index_staleness=300):
+        # A pymongo collection can be passed in place of a TopicStorage
+        if not isinstance(storage, TopicStorage):
+            storage = MongoTopicStorage(storage)
+        self.storage = storage
+        self.cache = cache
+        self.index = index
+        self.max_index_staleness = max_index_staleness
 
     def current_timestamp(self):
         return datetime.datetime.utcnow()
 
-    def find_partner_id_for_url(self, feed_url):
-        query = {'_id': sort_url_query(feed_url)}
-        result = self.collection.find_one(query)
+    def _find_response(self, result):
         if result:
             return FindResponse(result.get('topic_id'), True if result.get('disabled') else False)
         return FindResponse(None, None)
 
+    def _index_is_usable(self):
+        return self.index is not None and self.index.is_fresh(self.max_index_staleness)
+
+    def _cached_responses(self, sorted_urls):
+        if self.cache is None:
+            return {}
+        # Shared caches hand back plain lists rather than FindResponses
+        return dict((url, FindResponse(*value)) for url, value in self.cache.get_many(sorted_urls).items())
+
+    def _cache_generations(self, sorted_urls):
+        # Read before storage, so a write made meanwhile keeps what storage
+        # returned out of the cache
+        return self.cache.generations(sorted_urls) if self.cache is not None else None
+
+    def _cache_responses(self, responses, generations):
+        # Only mappings that exist are cached, so a newly stored topic is
+        # never hidden behind a cached miss.
+        if self.cache is not None:
+            self.cache.set_many(dict((url, response) for url, response in responses.items() if response.topic_id is not None),
+                                generations)
+
+    def _invalidate(self, sorted_urls):
+        if self.cache is not None:
+            self.cache.invalidate(sorted_urls)
+
+    def find_partner_id_for_url(self, feed_url):
+        sorted_url = sort_url_query(feed_url)
+        if self._index_is_usable():
+            indexed = self.index.get_many([sorted_url])
+            if sorted_url in indexed:
+                return indexed[sorted_url]
+
+        cached = self._cached_responses([sorted_url])
+        if sorted_url in cached:
+            return cached[sorted_url]
+
+        generations = self._cache_generations([sorted_url])
+        response = self._find_response(self.storage.find_one(sorted_url))
+        self._cache_responses({sorted_url: response}, generations)
+        return response
+
+    def find_partner_ids_for_urls(self, feed_urls):
+        """Looks up several feed URLs with a single query.
+
+        Returns a list of FindResponse tuples in the same order as feed_urls.
+        When a fresh topic index is loaded only URLs it doesn't know are
+        queried."""
+        sorted_urls = [sort_url_query(feed_url) for feed_url in feed_urls]
+        responses = self.index.get_many(sorted_urls) if self._index_is_usable() else {}
+
+        responses.update(self._cached_responses(list(set(sorted_urls) - set(responses))))
+
+        missing_urls = list(set(sorted_urls) - set(responses))
+        if missing_urls:
+            generations = self._cache_generations(missing_urls)
+            results = self.storage.find_many(missing_urls)
+            found = dict((url, self._find_response(results.get(url))) for url in missing_urls)
+            self._cache_responses(found, generations)
+            responses.update(found)
+
+        return [responses[sorted_url] for sorted_url in sorted_urls]
+
     def store_partner_id_for_url(self, feed_url, partner_id):
-        return self.collection.insert({
-            '_id'      : sort_url_query(feed_url),
+        sorted_url = sort_url_query(feed_url)
+        timestamp = self.current_timestamp()
+        result = self.storage.insert({
+            '_id'      : sorted_url,
             'topic_id' : partner_id,
-            'created'  : self.current_timestamp()
+            'created'  : timestamp,
+            'modified' : timestamp
         })
+        self._invalidate([sorted_url])
+        return result
 
     def update(self, gov_delivery_id, disabled):
-        query = {'topic_id': gov_delivery_id}
-        self.collection.update(
-            query,
-            {"$set": {'disabled': disabled}}
-        )
-        return self.collection.find_one(query)
+        """Sets disabled on the topic and returns the updated document, or
+        None if there's no such topic."""
+        result = self.storage.update(gov_delivery_id, {'disabled': disabled, 'modified': self.current_timestamp()})
+        if result:
+            self._invalidate([result['_id']])
+        return result
+
+    def update_many(self, gov_delivery_ids, disabled):
+        """Sets disabled on many topics with a single write.
+
+        Returns a dict of each ID to its updated document, or None if
+        there's no such topic."""
+        results = self.storage.update_many(list(set(gov_delivery_ids)), {'disabled': disabled, 'modified': self.current_timestamp()})
+        self._invalidate(results.keys())
+        by_topic = dict((result['topic_id'], result) for result in results.values())
+        return dict((gov_delivery_id, by_topic.get(gov_delivery_id)) for gov_delivery_id in gov_delivery_ids)
+
+    def delete(self, gov_delivery_id):
+        """Deletes every mapping to a topic and returns the feed URLs which
+        were mapped to it."""
+        sorted_urls = self.storage.delete(gov_delivery_id)
+        self._invalidate(sorted_urls)
+        return sorted_urls
+
+    def find_all(self, modified_since=None):
+        return self.storage.find_all(modified_since)
+
+    def ensure_indexes(self, skip=()):
+        """Creates any missing indexes, except those named in `skip`.
+        Returns the indexes that were created."""
+        return self.storage.ensure_indexes(skip)
+
+    def index_report(self):
+        return self.storage.index_report()
+
+    def duplicate_topic_ids(self):
+        return self.storage.duplicate_topic_ids()
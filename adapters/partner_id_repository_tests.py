@@ -1,20 +1,42 @@
+import datetime
 import unittest
 
 from mock import patch
+from pymongo.errors import OperationFailure
 
-from partner_id_repository import PartnerIdRepository, sort_url_query
+from partner_id_repository import PartnerIdRepository, FindResponse, INDEXES, sort_url_query
+from partner_id_cache import LRUCache
+from topic_storage import MongoTopicStorage
 
 
 class FakeMongoCollection(object):
     def find_one(self, *args):
         pass
 
+    def find(self, *args):
+        return []
+
     def insert(self, document):
         pass
 
-    def update(self, *args):
+    def update(self, *args, **kwargs):
+        pass
+
+    def find_and_modify(self, *args, **kwargs):
         pass
 
+    def index_information(self):
+        return {'_id_': {'key': [('_id', 1)]}}
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def remove(self, *args):
+        pass
+
+    def aggregate(self, *args):
+        return {'result': [], 'ok': 1}
+
 
 class PartnerIdRepositoryTestCase(unittest.TestCase):
     def setUp(self):
@@ -24,7 +46,7 @@ class PartnerIdRepositoryTestCase(unittest.TestCase):
     @patch.object(PartnerIdRepository, 'current_timestamp', return_value='1234')
     def test_can_store_an_id(self, fake_datetime, fake_write):
         self.instance.store_partner_id_for_url('http://test1.com/', 'i_am_an_id')
-        fake_write.assert_called_once_with({'_id': 'http://test1.com/', 'topic_id': 'i_am_an_id', 'created':'1234'})
+        fake_write.assert_called_once_with({'_id': 'http://test1.com/', 'topic_id': 'i_am_an_id', 'created':'1234', 'modified': '1234'})
 
     @patch.object(FakeMongoCollection, 'find_one', return_value={'topic_id': 'i_am_an_id'})
     def test_when_disabled_is_not_set(self, fake_read):
@@ -53,25 +75,196 @@ class PartnerIdRepositoryTestCase(unittest.TestCase):
         self.assertEqual(response.topic_id, None)
         self.assertFalse(response.disabled)
 
+    @patch.object(FakeMongoCollection, 'find', return_value=[
+        {'_id': 'http://test.com/?a=1&b=2', 'topic_id': 'TOPIC_1'},
+        {'_id': 'http://test.com/disabled', 'topic_id': 'TOPIC_2', 'disabled': True},
+    ])
+    def test_finds_many_urls_with_a_single_query(self, fake_find):
+        responses = self.instance.find_partner_ids_for_urls([
+            'http://test.com/disabled',
+            'http://test.com/missing',
+            'http://test.com/?b=2&a=1',
+        ])
+        self.assertEqual(fake_find.call_count, 1)
+        query, fields = fake_find.call_args[0]
+        self.assertItemsEqual(query['_id']['$in'], ['http://test.com/disabled', 'http://test.com/missing', 'http://test.com/?a=1&b=2'])
+        self.assertEqual(fields, {'topic_id': 1, 'disabled': 1})
+        self.assertEqual(responses, [('TOPIC_2', True), (None, None), ('TOPIC_1', False)])
+
+    @patch.object(FakeMongoCollection, 'find')
+    def test_finding_no_urls_does_not_query(self, fake_find):
+        self.assertEqual(self.instance.find_partner_ids_for_urls([]), [])
+        self.assertFalse(fake_find.called)
+
     def test_url_sorting(self):
         original_url = 'http://example.com/?b=1&c=2&a=3'
         sorted_url = 'http://example.com/?a=3&b=1&c=2'
         assert sort_url_query(original_url) == sorted_url
 
-    @patch.object(FakeMongoCollection, 'find_one', return_value=None)
-    @patch.object(FakeMongoCollection, 'update', return_value=None)
-    def test_update_when_disable_is_true(self, fake_update, fake_read):
+    @patch.object(FakeMongoCollection, 'find_and_modify', return_value=None)
+    @patch.object(PartnerIdRepository, 'current_timestamp', return_value='1234')
+    def test_update_when_disable_is_true(self, fake_datetime, fake_find_and_modify):
         self.instance.update('TOPIC_111', disabled=True)
-        fake_update.assert_called_once_with({'topic_id': 'TOPIC_111'}, {'$set': {'disabled': True}})
-        fake_read.assert_called_once_with({'topic_id': 'TOPIC_111'})
+        fake_find_and_modify.assert_called_once_with({'topic_id': 'TOPIC_111'}, {'$set': {'disabled': True, 'modified': '1234'}}, new=True)
 
 
-    @patch.object(FakeMongoCollection, 'find_one', return_value=None)
-    @patch.object(FakeMongoCollection, 'update', return_value=None)
-    def test_update_when_disable_is_none(self, fake_update, fake_read):
+    @patch.object(FakeMongoCollection, 'find_and_modify', return_value=None)
+    @patch.object(PartnerIdRepository, 'current_timestamp', return_value='1234')
+    def test_update_when_disable_is_none(self, fake_datetime, fake_find_and_modify):
         self.instance.update('TOPIC_111', disabled=None)
-        fake_update.assert_called_once_with({'topic_id': 'TOPIC_111'}, {'$set': {'disabled': None}})
-        fake_read.assert_called_once_with({'topic_id': 'TOPIC_111'})
+        fake_find_and_modify.assert_called_once_with({'topic_id': 'TOPIC_111'}, {'$set': {'disabled': None, 'modified': '1234'}}, new=True)
+
+    @patch.object(FakeMongoCollection, 'find_and_modify', return_value={'_id': 'http://test.com/', 'topic_id': 'TOPIC_111', 'disabled': True})
+    def test_update_returns_the_updated_document(self, fake_find_and_modify):
+        result = self.instance.update('TOPIC_111', disabled=True)
+        self.assertEqual(result, {'_id': 'http://test.com/', 'topic_id': 'TOPIC_111', 'disabled': True})
+
+    @patch.object(FakeMongoCollection, 'find', return_value=[{'_id': 'http://test.com/', 'topic_id': 'TOPIC_1', 'disabled': True}])
+    @patch.object(FakeMongoCollection, 'update', return_value=None)
+    @patch.object(PartnerIdRepository, 'current_timestamp', return_value='1234')
+    def test_update_many_uses_a_single_write(self, fake_datetime, fake_update, fake_find):
+        results = self.instance.update_many(['TOPIC_1', 'TOPIC_2'], disabled=True)
+        self.assertItemsEqual(fake_find.call_args[0][0]['topic_id']['$in'], ['TOPIC_1', 'TOPIC_2'])
+        self.assertEqual(fake_update.call_args[0][0], {'_id': {'$in': ['http://test.com/']}})
+        self.assertEqual(fake_update.call_args[0][1], {'$set': {'disabled': True, 'modified': '1234'}})
+        self.assertEqual(fake_update.call_args[1], {'multi': True})
+        self.assertEqual(results, {
+            'TOPIC_1': {'_id': 'http://test.com/', 'topic_id': 'TOPIC_1', 'disabled': True, 'modified': '1234'},
+            'TOPIC_2': None,
+        })
+
+    @patch.object(FakeMongoCollection, 'find', return_value=[{'_id': 'http://test.com/', 'topic_id': 'TOPIC_1', 'disabled': False}])
+    @patch.object(FakeMongoCollection, 'update', return_value=None)
+    def test_update_many_invalidates_the_documents_it_changed(self, fake_update, fake_find):
+        cache = LRUCache(max_size=10, ttl=60)
+        cache.set_many({'http://test.com/': FindResponse('TOPIC_1', False)})
+        PartnerIdRepository(FakeMongoCollection(), cache).update_many(['TOPIC_1'], disabled=True)
+        self.assertEqual(cache.get_many(['http://test.com/']), {})
+
+    @patch.object(FakeMongoCollection, 'update')
+    def test_update_many_does_not_write_when_no_topics_exist(self, fake_update):
+        self.assertEqual(self.instance.update_many(['TOPIC_1'], disabled=True), {'TOPIC_1': None})
+        self.assertFalse(fake_update.called)
+
+
+class PartnerIdRepositoryIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instance = PartnerIdRepository(FakeMongoCollection())
+
+    @patch.object(FakeMongoCollection, 'ensure_index')
+    def test_creates_missing_indexes_in_the_background(self, fake_ensure_index):
+        created = self.instance.ensure_indexes()
+        self.assertEqual(created, INDEXES)
+        fake_ensure_index.assert_any_call([('topic_id', 1)], name='topic_id_unique', background=True, unique=True, sparse=True)
+        fake_ensure_index.assert_any_call([('created', 1)], name='created', background=True)
+        fake_ensure_index.assert_any_call([('disabled', 1), ('topic_id', 1)], name='disabled_topic_id', background=True)
+        fake_ensure_index.assert_any_call([('modified', 1)], name='modified', background=True)
+
+    @patch.object(FakeMongoCollection, 'index_information', return_value={
+        '_id_': {'key': [('_id', 1)]},
+        'topic_id_1': {'key': [('topic_id', 1)], 'unique': True},
+        'created': {'key': [('created', 1)]},
+        'disabled_topic_id': {'key': [('disabled', 1), ('topic_id', 1)]},
+        'modified': {'key': [('modified', 1)]},
+    })
+    @patch.object(FakeMongoCollection, 'ensure_index')
+    def test_does_not_recreate_indexes_with_matching_keys(self, fake_ensure_index, fake_info):
+        self.assertEqual(self.instance.ensure_indexes(), [])
+        self.assertFalse(fake_ensure_index.called)
+
+    @patch.object(FakeMongoCollection, 'index_information', return_value={
+        '_id_': {'key': [('_id', 1)]},
+        'created': {'key': [('created', 1)]},
+        'old_index': {'key': [('name', 1)]},
+    })
+    @patch.object(FakeMongoCollection, 'aggregate', return_value={'ok': 1, 'result': [
+        {'name': '_id_', 'accesses': {'ops': 0, 'since': datetime.datetime(2017, 3, 1)}},
+        {'name': 'created', 'accesses': {'ops': 0, 'since': datetime.datetime(2017, 3, 1)}},
+        {'name': 'old_index', 'accesses': {'ops': 12, 'since': datetime.datetime(2017, 3, 1)}},
+    ]})
+    @patch.object(MongoTopicStorage, 'current_time', return_value=datetime.datetime(2017, 3, 27))
+    def test_reports_missing_undeclared_and_unused_indexes(self, fake_time, fake_aggregate, fake_info):
+        report = self.instance.index_report()
+        self.assertEqual(report.missing, ['topic_id_unique', 'disabled_topic_id', 'modified'])
+        self.assertEqual(report.undeclared, ['old_index'])
+        self.assertEqual(report.unused, ['created'])
+
+    @patch.object(FakeMongoCollection, 'aggregate', return_value={'ok': 1, 'result': [
+        {'name': 'created', 'accesses': {'ops': 0, 'since': datetime.datetime(2017, 3, 26)}},
+    ]})
+    @patch.object(MongoTopicStorage, 'current_time', return_value=datetime.datetime(2017, 3, 27))
+    def test_indexes_are_not_reported_unused_soon_after_a_restart(self, fake_time, fake_aggregate):
+        self.assertEqual(self.instance.index_report().unused, [])
+
+    @patch.object(FakeMongoCollection, 'aggregate', side_effect=OperationFailure('unrecognized pipeline stage'))
+    def test_usage_is_not_reported_by_older_servers(self, fake_aggregate):
+        self.assertEqual(self.instance.index_report().unused, [])
+
+    @patch.object(FakeMongoCollection, 'ensure_index')
+    def test_skips_indexes_it_is_told_to(self, fake_ensure_index):
+        created = self.instance.ensure_indexes(skip=['topic_id_unique'])
+        self.assertEqual([index.name for index in created], ['created', 'disabled_topic_id', 'modified'])
+
+    @patch.object(FakeMongoCollection, 'aggregate', return_value={'ok': 1, 'result': [
+        {'_id': 'TOPIC_1', 'urls': ['http://a.com/', 'http://b.com/'], 'count': 2},
+    ]})
+    def test_finds_duplicated_topic_ids(self, fake_aggregate):
+        self.assertEqual(self.instance.duplicate_topic_ids(), {'TOPIC_1': ['http://a.com/', 'http://b.com/']})
+
+
+class CachedPartnerIdRepositoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(max_size=10, ttl=60)
+        self.instance = PartnerIdRepository(FakeMongoCollection(), self.cache)
+
+    @patch.object(FakeMongoCollection, 'find_one', return_value={'topic_id': 'i_am_an_id'})
+    def test_repeated_lookups_are_served_from_the_cache(self, fake_read):
+        self.instance.find_partner_id_for_url('http://test.com/')
+        response = self.instance.find_partner_id_for_url('http://test.com/')
+        self.assertEqual(fake_read.call_count, 1)
+        self.assertEqual(response, FindResponse('i_am_an_id', False))
+
+    @patch.object(FakeMongoCollection, 'find_one', return_value=None)
+    def test_missing_urls_are_not_cached(self, fake_read):
+        self.instance.find_partner_id_for_url('http://test.com/')
+        self.instance.find_partner_id_for_url('http://test.com/')
+        self.assertEqual(fake_read.call_count, 2)
+
+    @patch.object(FakeMongoCollection, 'find', return_value=[{'_id': 'http://test.com/two', 'topic_id': 'TOPIC_2'}])
+    def test_batch_lookups_only_query_uncached_urls(self, fake_find):
+        self.cache.set_many({'http://test.com/one': FindResponse('TOPIC_1', False)})
+        responses = self.instance.find_partner_ids_for_urls(['http://test.com/one', 'http://test.com/two'])
+        self.assertEqual(fake_find.call_args[0][0], {'_id': {'$in': ['http://test.com/two']}})
+        self.assertEqual(responses, [('TOPIC_1', False), ('TOPIC_2', False)])
+
+    def test_storing_an_id_invalidates_the_cache(self):
+        self.cache.set_many({'http://test.com/?a=1&b=2': FindResponse('OLD', False)})
+        self.instance.store_partner_id_for_url('http://test.com/?b=2&a=1', 'NEW')
+        self.assertEqual(self.cache.get_many(['http://test.com/?a=1&b=2']), {})
+
+    @patch.object(FakeMongoCollection, 'find_and_modify', return_value={'_id': 'http://test.com/', 'topic_id': 'TOPIC_111', 'disabled': True})
+    def test_updating_invalidates_the_cache(self, fake_find_and_modify):
+        self.cache.set_many({'http://test.com/': FindResponse('TOPIC_111', False)})
+        self.instance.update('TOPIC_111', disabled=True)
+        self.assertEqual(self.cache.get_many(['http://test.com/']), {})
+
+    @patch.object(FakeMongoCollection, 'remove')
+    @patch.object(FakeMongoCollection, 'find', return_value=[{'_id': 'http://test.com/'}])
+    def test_deleting_invalidates_the_cache(self, fake_find, fake_remove):
+        self.cache.set_many({'http://test.com/': FindResponse('TOPIC_111', False)})
+        self.assertEqual(self.instance.delete('TOPIC_111'), ['http://test.com/'])
+        fake_remove.assert_called_once_with({'topic_id': 'TOPIC_111'})
+        self.assertEqual(self.cache.get_many(['http://test.com/']), {})
+
+    def test_lookups_overtaken_by_a_write_are_not_cached(self):
+        def written_while_reading(sorted_url):
+            self.instance.update('TOPIC_111', disabled=True)
+            return {'topic_id': 'TOPIC_111'}
+
+        with patch.object(FakeMongoCollection, 'find_and_modify', return_value={'_id': 'http://test.com/', 'topic_id': 'TOPIC_111'}):
+            with patch.object(self.instance.storage, 'find_one', side_effect=written_while_reading):
+                self.instance.find_partner_id_for_url('http://test.com/')
+        self.assertEqual(self.cache.get_many(['http://test.com/']), {})
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import zlib
+import hashlib
+import logging
+
+__all__ = ['PayloadStore', 'PayloadNotFound']
+
+logger = logging.getLogger(__name__)
+
+# The first byte of each stored value says how the rest is encoded
+RAW = 'r'
+COMPRESSED = 'z'
+
+
+class PayloadNotFound(Exception):
+    pass
+
+
+class PayloadStore(object):
+    """Keeps bulletin bodies in Redis under the SHA-256 of their content,
+    so that a Celery task carries a short reference rather than the body.
+
+    Identical bodies are stored once, and storing one again only renews
+    its `ttl`. Bodies of at least `compress_min_size` bytes are stored
+    zlib compressed; None stores everything as it is."""
+    def __init__(self, redis_client, ttl, compress_min_size=None, prefix='govuk_delivery:payload:'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.compress_min_size = compress_min_size
+        self.prefix = prefix
+        self.stored = 0
+        self.deduplicated = 0
+
+    def _key(self, ref):
+        return '%s%s' % (self.prefix, ref)
+
+    def _encode(self, data):
+        if self.compress_min_size is not None and len(data) >= self.compress_min_size:
+            return COMPRESSED + zlib.compress(data)
+        return RAW + data
+
+    def put(self, body):
+        """Stores a body and returns its reference. Raises RedisError if it
+        can't be stored."""
+        data = body.encode('utf-8')
+        ref = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+        key = self._key(ref)
+        # Renewing a body which is already there saves sending it again
+        if self.redis.expire(key, self.ttl):
+            self.deduplicated += 1
+            return ref
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.setnx(key, self._encode(data))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        self.stored += 1
+        return ref
+
+    def get(self, ref):
+        """Returns the body for a reference, or raises PayloadNotFound if it
+        has expired."""
+        value = self.redis.get(self._key(ref))
+        if value is None:
+            raise PayloadNotFound('No payload stored for %s' % ref)
+        encoding, data = value[:1], value[1:]
+        if encoding == COMPRESSED:
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    def stats(self):
+        return {'stored': self.stored, 'deduplicated': self.deduplicated}
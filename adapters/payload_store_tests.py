@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from payload_store import PayloadStore, PayloadNotFound
+from fake_redis import FakeRedis
+
+
+class PayloadStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.store = PayloadStore(self.redis, ttl=3600)
+
+    def test_returns_the_stored_body(self):
+        ref = self.store.put(u'<p>Caf\xe9</p>')
+        self.assertEqual(u'<p>Caf\xe9</p>', self.store.get(ref))
+
+    def test_references_are_content_addressed(self):
+        self.assertEqual(self.store.put(u'<p>Body</p>'), self.store.put(u'<p>Body</p>'))
+        self.assertNotEqual(self.store.put(u'<p>Body</p>'), self.store.put(u'<p>Other</p>'))
+
+    def test_identical_bodies_are_stored_once(self):
+        self.store.put(u'<p>Body</p>')
+        self.store.put(u'<p>Body</p>')
+        self.assertEqual({'stored': 1, 'deduplicated': 1}, self.store.stats())
+        self.assertEqual(1, len(self.redis.values))
+
+    def test_bodies_expire(self):
+        ref = self.store.put(u'<p>Body</p>')
+        self.assertEqual(3600, self.redis.ttls[self.store._key(ref)])
+
+    def test_large_bodies_are_compressed(self):
+        self.store.compress_min_size = 100
+        body = u'<p>Body</p>' * 100
+        ref = self.store.put(body)
+        stored = self.redis.values[self.store._key(ref)]
+        self.assertTrue(len(stored) < len(body))
+        self.assertEqual(body, self.store.get(ref))
+
+    def test_missing_bodies_raise(self):
+        with self.assertRaises(PayloadNotFound):
+            self.store.get('sha256:missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import time
+import random
+import logging
+import threading
+
+import redis
+
+__all__ = ['RateLimiter', 'RateLimitExceeded', 'operation_class']
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+# Takes `requested` tokens from the bucket in KEYS[1], which refills at
+# `rate` tokens a second up to `capacity`. Returns whether they were taken,
+# the seconds to wait until they could be and the tokens left. Floats are
+# returned as strings, as Redis would truncate them to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1])
+local updated = tonumber(bucket[2])
+if tokens == nil or updated == nil then
+  tokens = capacity
+  updated = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+  tokens = tokens - requested
+  allowed = 1
+else
+  wait = (requested - tokens) / rate
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait), tostring(tokens)}
+"""
+
+OPERATION_CLASSES = {
+    'bulletins': 'bulletin',
+    'subscribers': 'subscriber',
+    'topics': 'topic',
+}
+
+
+def operation_class(path):
+    """The class of GovDelivery API call a path belongs to, used to pick
+    its rate limit: 'bulletin', 'subscriber', 'topic' or 'other'."""
+    return OPERATION_CLASSES.get(path.split('/', 1)[0], 'other')
+
+
+class RateLimiter(object):
+    """Token buckets in Redis, one for each account and operation class,
+    shared by every process calling GovDelivery.
+
+    `limits` maps an operation class to a (rate, burst) pair: tokens added
+    a second and the most the bucket holds. Classes without a limit aren't
+    limited. Callers wait for a token for up to `max_wait` seconds and then
+    get RateLimitExceeded.
+
+    If Redis can't be reached calls aren't limited."""
+    def __init__(self, redis_client, limits, max_wait=30, prefix='govuk_delivery:rate_limit:'):
+        self.redis = redis_client
+        self.limits = limits
+        self.max_wait = max_wait
+        self.prefix = prefix
+        self.script = None
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def current_time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _key(self, account_code, operation):
+        return '%s%s:%s' % (self.prefix, account_code, operation)
+
+    def _count(self, operation, name, value=1):
+        with self.lock:
+            counts = self.counts.setdefault(operation, {'acquired': 0, 'waited': 0, 'wait_time': 0.0,
+                                                        'rejected': 0, 'unlimited': 0})
+            counts[name] += value
+
+    def _take(self, key, rate, capacity):
+        if self.script is None:
+            self.script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+        allowed, wait, tokens = self.script(keys=[key], args=[rate, capacity, self.current_time(), 1])
+        return bool(allowed), float(wait)
+
+    def acquire(self, account_code, operation):
+        """Blocks until a call of the operation class may be made."""
+        if operation not in self.limits:
+            return
+        rate, capacity = self.limits[operation]
+        key = self._key(account_code, operation)
+        started = self.current_time()
+        waited = False
+        while True:
+            try:
+                allowed, wait = self._take(key, rate, capacity)
+            except redis.RedisError as error:
+                logger.warning('Could not check GovDelivery rate limit for %s, allowing the call: %s', operation, error)
+                self._count(operation, 'unlimited')
+                return
+            if allowed:
+                break
+            waited_so_far = self.current_time() - started
+            if waited_so_far + wait > self.max_wait:
+                self._count(operation, 'rejected')
+                raise RateLimitExceeded('Over the GovDelivery rate limit for %s calls after waiting %.1fs' % (operation, waited_so_far))
+            waited = True
+            # A little extra so that waiting callers don't all retry at once
+            self.sleep(wait * random.uniform(1, 1.2))
+
+        self._count(operation, 'acquired')
+        if waited:
+            self._count(operation, 'waited')
+            self._count(operation, 'wait_time', self.current_time() - started)
+
+    def stats(self, account_code=None):
+        """Counts of calls in this process for each operation class and,
+        given an account, the tokens left in its shared buckets."""
+        with self.lock:
+            stats = dict((operation, dict(counts)) for operation, counts in self.counts.items())
+        tokens = self.tokens(account_code) if account_code is not None else {}
+        for operation, (rate, capacity) in self.limits.items():
+            operation_stats = stats.setdefault(operation, {})
+            operation_stats.update(rate=rate, burst=capacity)
+            if operation in tokens:
+                operation_stats['tokens'] = tokens[operation]
+        return stats
+
+    def tokens(self, account_code):
+        """The tokens left in each of an account's buckets, or None for
+        buckets which are full or can't be read."""
+        tokens = {}
+        for operation in self.limits:
+            try:
+                value = self.redis.hget(self._key(account_code, operation), 'tokens')
+            except redis.RedisError:
+                value = None
+            tokens[operation] = float(value) if value is not None else None
+        return tokens
@@ -0,0 +1,75 @@
+import unittest
+
+import redis
+from mock import Mock, patch
+
+from fake_redis import real_redis
+from rate_limiter import RateLimiter, RateLimitExceeded, operation_class
+
+
+class OperationClassTestCase(unittest.TestCase):
+    def test_classifies_paths_by_their_first_segment(self):
+        self.assertEqual('bulletin', operation_class('bulletins/send_now'))
+        self.assertEqual('subscriber', operation_class('subscribers/abc/topics'))
+        self.assertEqual('topic', operation_class('topics'))
+        self.assertEqual('other', operation_class('categories/abc'))
+
+
+@patch.object(RateLimiter, 'sleep')
+@patch.object(RateLimiter, 'current_time', return_value=1000.0)
+class RateLimiterTestCase(unittest.TestCase):
+    """Runs TOKEN_BUCKET_SCRIPT against a real Redis"""
+    def setUp(self):
+        self.redis = real_redis()
+        self.limiter = RateLimiter(self.redis, {'bulletin': (1, 2)}, max_wait=5)
+
+    def test_allows_a_burst_without_waiting(self, fake_time, sleep):
+        self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.assertEqual(0, sleep.call_count)
+        self.assertEqual(2, self.limiter.stats()['bulletin']['acquired'])
+
+    def test_waits_for_a_token_when_over_budget(self, fake_time, sleep):
+        def advance(seconds):
+            fake_time.return_value += seconds
+        sleep.side_effect = advance
+        for _ in range(3):
+            self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(1 <= sleep.call_args[0][0] <= 1.2)
+        self.assertEqual(1, self.limiter.stats()['bulletin']['waited'])
+
+    def test_gives_up_after_max_wait(self, fake_time, sleep):
+        limiter = RateLimiter(self.redis, {'bulletin': (0.1, 1)}, max_wait=5)
+        limiter.acquire('ACCOUNT', 'bulletin')
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'ACCOUNT', 'bulletin')
+        self.assertEqual(1, limiter.stats()['bulletin']['rejected'])
+
+    def test_buckets_are_kept_per_account(self, fake_time, sleep):
+        self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.limiter.acquire('OTHER', 'bulletin')
+        self.assertEqual(0, sleep.call_count)
+        self.assertEqual(1.0, self.limiter.stats('OTHER')['bulletin']['tokens'])
+
+    def test_does_not_limit_other_operations(self, fake_time, sleep):
+        for _ in range(10):
+            self.limiter.acquire('ACCOUNT', 'topic')
+        self.assertEqual(0, sleep.call_count)
+        self.assertEqual(None, self.limiter.stats().get('topic'))
+
+    def test_buckets_expire_once_they_would_be_full(self, fake_time, sleep):
+        self.limiter.acquire('ACCOUNT', 'bulletin')
+        self.assertEqual(3, self.redis.ttl(self.limiter._key('ACCOUNT', 'bulletin')))
+
+
+class RedisDownTestCase(unittest.TestCase):
+    def test_allows_calls_when_redis_is_down(self):
+        broken_redis = Mock(**{'register_script.side_effect': redis.ConnectionError('down')})
+        limiter = RateLimiter(broken_redis, {'bulletin': (1, 1)})
+        limiter.acquire('ACCOUNT', 'bulletin')
+        self.assertEqual(1, limiter.stats()['bulletin']['unlimited'])
+
+
+if __name__ == '__main__':
+    unittest.main()
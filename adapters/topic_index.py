@@ -0,0 +1,140 @@
+import sys
+import time
+import datetime
+import logging
+import threading
+
+from partner_id_repository import FindResponse
+from topic_storage import TopicStorage, MongoTopicStorage
+
+__all__ = ['TopicIndex']
+
+logger = logging.getLogger(__name__)
+
+
+class TopicIndex(object):
+    """The whole topics collection held in memory, keyed by sorted feed URL.
+
+    After the initial load only documents whose `modified` timestamp has
+    moved on are fetched. Deletes, and documents written without
+    `modified`, aren't visible to those refreshes, so each one also counts
+    the documents stored and reloads the index in full if the count
+    doesn't match. It's reloaded in full every `full_reload_interval`
+    seconds regardless.
+
+    `modified` is stamped by whichever process wrote the document, so each
+    refresh goes back `refresh_interval` seconds before the last timestamp
+    seen, to pick up writers whose clocks are behind. Lookups never touch
+    the database; URLs the index doesn't know are left to the caller."""
+    def __init__(self, storage, refresh_interval=30, full_reload_interval=3600):
+        # A pymongo collection can be passed in place of a TopicStorage
+        if not isinstance(storage, TopicStorage):
+            storage = MongoTopicStorage(storage)
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.modified_overlap = datetime.timedelta(seconds=refresh_interval)
+        self.topics = {}
+        self.last_modified = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def current_time(self):
+        return time.time()
+
+    def _fetch(self, modified_since=None):
+        topics = {}
+        last_modified = None
+        for result in self.storage.find_all(modified_since):
+            topics[result['_id']] = FindResponse(result.get('topic_id'), True if result.get('disabled') else False)
+            modified = result.get('modified')
+            if modified is not None and (last_modified is None or modified > last_modified):
+                last_modified = modified
+        return topics, last_modified
+
+    def load(self):
+        topics, last_modified = self._fetch()
+        now = self.current_time()
+        with self.lock:
+            self.topics = topics
+            self.last_modified = last_modified
+            self.loaded_at = now
+            self.refreshed_at = now
+        logger.info('Loaded topic index: %r', self.stats())
+
+    def refresh(self):
+        """Fetches documents modified since the last load or refresh."""
+        if self.loaded_at is None or self.last_modified is None:
+            return self.load()
+
+        # Documents modified shortly before the last timestamp we saw are
+        # fetched again so none written in the same instant, or stamped by
+        # a clock running behind, are missed. Re-applying them is harmless.
+        started_at = self.current_time()
+        topics, last_modified = self._fetch(self.last_modified - self.modified_overlap)
+        with self.lock:
+            self.topics.update(topics)
+            size = len(self.topics)
+
+        stored = self.storage.count()
+        if stored != size:
+            logger.info('Reloading topic index, it has %d topics but %d are stored', size, stored)
+            return self.load()
+
+        with self.lock:
+            if last_modified is not None and last_modified > self.last_modified:
+                self.last_modified = last_modified
+            self.refreshed_at = started_at
+
+    def _refresh_continuously(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                if self.current_time() - self.loaded_at >= self.full_reload_interval:
+                    self.load()
+                else:
+                    self.refresh()
+            except Exception as error:
+                logger.warning('Could not refresh topic index, it is %.0fs stale: %s', self.staleness(), error)
+
+    def start(self):
+        """Loads the index and keeps it refreshed from a background thread."""
+        self.load()
+        thread = threading.Thread(target=self._refresh_continuously, name='topic-index-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def staleness(self):
+        """Seconds since the index was last brought up to date."""
+        if self.refreshed_at is None:
+            return None
+        return self.current_time() - self.refreshed_at
+
+    def is_fresh(self, max_staleness):
+        staleness = self.staleness()
+        return staleness is not None and staleness <= max_staleness
+
+    def get_many(self, sorted_urls):
+        """Returns FindResponses for the URLs in the index. Others may have
+        been stored since it was last refreshed."""
+        topics = self.topics
+        return dict((url, topics[url]) for url in sorted_urls if url in topics)
+
+    def memory_usage(self):
+        """An estimate, in bytes, of the memory held by the index."""
+        with self.lock:
+            topics = self.topics.items()
+        size = sys.getsizeof(self.topics)
+        for url, response in topics:
+            size += sys.getsizeof(url) + sys.getsizeof(response) + sys.getsizeof(response.topic_id)
+        return size
+
+    def stats(self):
+        return {
+            'size': len(self.topics),
+            'memory_usage': self.memory_usage(),
+            'staleness': self.staleness(),
+            'refresh_interval': self.refresh_interval,
+            'full_reload_interval': self.full_reload_interval,
+        }
@@ -0,0 +1,117 @@
+import datetime
+import unittest
+
+from mock import patch
+
+from topic_index import TopicIndex
+from partner_id_repository import PartnerIdRepository, FindResponse
+
+
+class FakeMongoCollection(object):
+    def find(self, *args):
+        return []
+
+    def find_one(self, *args):
+        pass
+
+    def count(self):
+        return 0
+
+
+def minutes(minute):
+    return datetime.datetime(2017, 3, 27, 12, minute)
+
+
+@patch.object(TopicIndex, 'current_time', return_value=1000)
+class TopicIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.collection = FakeMongoCollection()
+        self.index = TopicIndex(self.collection, refresh_interval=30)
+
+    @patch.object(FakeMongoCollection, 'find', return_value=[
+        {'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'modified': minutes(5)},
+        {'_id': 'http://test.com/two', 'topic_id': 'TOPIC_2', 'disabled': True, 'modified': minutes(7)},
+        {'_id': 'http://test.com/old', 'topic_id': 'TOPIC_3'},
+    ])
+    def test_loads_the_whole_collection(self, fake_find, fake_time):
+        self.index.load()
+        fake_find.assert_called_once_with({}, {'topic_id': 1, 'disabled': 1, 'modified': 1})
+        self.assertEqual(self.index.get_many(['http://test.com/one', 'http://test.com/two', 'http://test.com/missing']), {
+            'http://test.com/one': FindResponse('TOPIC_1', False),
+            'http://test.com/two': FindResponse('TOPIC_2', True),
+        })
+        self.assertEqual(self.index.last_modified, minutes(7))
+
+    @patch.object(FakeMongoCollection, 'count', return_value=1)
+    @patch.object(FakeMongoCollection, 'find', return_value=[
+        {'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'modified': minutes(5)},
+    ])
+    def test_refreshes_documents_modified_since_shortly_before_the_last_load(self, fake_find, fake_count, fake_time):
+        self.index.load()
+        fake_find.return_value = [{'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'disabled': True, 'modified': minutes(9)}]
+        fake_time.return_value = 1030
+        self.index.refresh()
+        fake_find.assert_called_with({'modified': {'$gte': minutes(5) - datetime.timedelta(seconds=30)}}, {'topic_id': 1, 'disabled': 1, 'modified': 1})
+        self.assertEqual(self.index.get_many(['http://test.com/one'])['http://test.com/one'], FindResponse('TOPIC_1', True))
+        self.assertEqual(self.index.last_modified, minutes(9))
+        self.assertEqual(self.index.staleness(), 0)
+
+    @patch.object(FakeMongoCollection, 'count', return_value=1)
+    @patch.object(FakeMongoCollection, 'find', return_value=[
+        {'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'modified': minutes(5)},
+        {'_id': 'http://test.com/two', 'topic_id': 'TOPIC_2', 'modified': minutes(5)},
+    ])
+    def test_reloads_when_topics_have_been_deleted(self, fake_find, fake_count, fake_time):
+        self.index.load()
+        fake_find.return_value = [{'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'modified': minutes(5)}]
+        self.index.refresh()
+        fake_find.assert_called_with({}, {'topic_id': 1, 'disabled': 1, 'modified': 1})
+        self.assertEqual(self.index.get_many(['http://test.com/two']), {})
+
+    def test_reports_staleness(self, fake_time):
+        self.assertFalse(self.index.is_fresh(60))
+        self.index.load()
+        fake_time.return_value = 1100
+        self.assertEqual(self.index.stats()['staleness'], 100)
+        self.assertFalse(self.index.is_fresh(60))
+        self.assertTrue(self.index.is_fresh(120))
+
+
+class PartnerIdRepositoryWithTopicIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.collection = FakeMongoCollection()
+        self.index = TopicIndex(self.collection)
+        self.instance = PartnerIdRepository(self.collection, None, self.index, 300)
+
+    @patch.object(TopicIndex, 'is_fresh', return_value=True)
+    @patch.object(FakeMongoCollection, 'find')
+    def test_fresh_index_is_used_without_querying(self, fake_find, fake_is_fresh):
+        self.index.topics = {'http://test.com/?a=1&b=2': FindResponse('TOPIC_1', False)}
+        responses = self.instance.find_partner_ids_for_urls(['http://test.com/?b=2&a=1'])
+        self.assertEqual(responses, [('TOPIC_1', False)])
+        self.assertFalse(fake_find.called)
+
+    @patch.object(TopicIndex, 'is_fresh', return_value=True)
+    @patch.object(FakeMongoCollection, 'find', return_value=[{'_id': 'http://test.com/new', 'topic_id': 'TOPIC_2'}])
+    def test_urls_missing_from_a_fresh_index_are_queried(self, fake_find, fake_is_fresh):
+        self.index.topics = {'http://test.com/one': FindResponse('TOPIC_1', False)}
+        responses = self.instance.find_partner_ids_for_urls(['http://test.com/one', 'http://test.com/new', 'http://test.com/missing'])
+        self.assertEqual(responses, [('TOPIC_1', False), ('TOPIC_2', False), (None, None)])
+        self.assertItemsEqual(fake_find.call_args[0][0]['_id']['$in'], ['http://test.com/new', 'http://test.com/missing'])
+
+    @patch.object(TopicIndex, 'is_fresh', return_value=True)
+    @patch.object(FakeMongoCollection, 'find_one', return_value={'topic_id': 'TOPIC_2'})
+    def test_a_url_missing_from_a_fresh_index_is_queried(self, fake_find_one, fake_is_fresh):
+        self.assertEqual(self.instance.find_partner_id_for_url('http://test.com/new'), FindResponse('TOPIC_2', False))
+        fake_find_one.assert_called_once_with({'_id': 'http://test.com/new'})
+
+    @patch.object(TopicIndex, 'is_fresh', return_value=False)
+    @patch.object(FakeMongoCollection, 'find_one', return_value={'topic_id': 'TOPIC_1'})
+    def test_stale_index_falls_back_to_the_database(self, fake_find_one, fake_is_fresh):
+        response = self.instance.find_partner_id_for_url('http://test.com/')
+        self.assertEqual(response, FindResponse('TOPIC_1', False))
+        fake_is_fresh.assert_called_once_with(300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+import os
+import abc
+import copy
+import sqlite3
+import datetime
+import threading
+
+from collections import namedtuple
+
+import pymongo
+from pymongo.errors import OperationFailure
+
+__all__ = ['TopicStorage', 'MongoTopicStorage', 'InMemoryTopicStorage', 'SQLiteTopicStorage']
+
+Index = namedtuple('Index', ['name', 'keys', 'options'])
+IndexReport = namedtuple('IndexReport', ['missing', 'undeclared', 'unused'])
+
+# Index usage counters restart with mongod, so an index is only reported
+# unused once they have been counting for this long.
+INDEX_USAGE_MIN_AGE = datetime.timedelta(days=7)
+
+# Indexes the topics collection needs. `update` queries by topic_id,
+# scripts/topic_deleter.py by created, enabled topics are looked up by
+# disabled and topic_id, and the in-memory TopicIndex refreshes by modified.
+# topic_id_unique is sparse so that documents without a topic ID don't
+# collide with each other.
+INDEXES = [
+    Index('topic_id_unique', [('topic_id', pymongo.ASCENDING)], {'unique': True, 'sparse': True}),
+    Index('created', [('created', pymongo.ASCENDING)], {}),
+    Index('disabled_topic_id', [('disabled', pymongo.ASCENDING), ('topic_id', pymongo.ASCENDING)], {}),
+    Index('modified', [('modified', pymongo.ASCENDING)], {}),
+]
+
+
+class TopicStorage(object):
+    """Stores topic documents keyed by sorted feed URL.
+
+    Documents are dicts with `_id` (the sorted feed URL), `topic_id`,
+    `created`, `modified` and, once it has been set, `disabled`. Backends
+    must implement the abstract methods; indexes are optional."""
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def find_one(self, sorted_url):
+        """Returns the document for a URL, or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_many(self, sorted_urls):
+        """Returns a dict of URL to document for the URLs which exist."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert(self, document):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, gov_delivery_id, fields):
+        """Sets fields on the document for a topic and returns the updated
+        document, or None if there's no such topic."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_many(self, gov_delivery_ids, fields):
+        """Sets fields on the document for each of many topics, as `update`
+        does for one. Returns a dict of sorted URL to updated document."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, gov_delivery_id):
+        """Deletes the documents for a topic and returns their URLs."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_all(self, modified_since=None):
+        """Iterates over every document, or those modified at or after
+        `modified_since`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self):
+        """The number of documents stored."""
+        raise NotImplementedError
+
+    def ensure_indexes(self, skip=()):
+        return []
+
+    def index_report(self):
+        return IndexReport([], [], [])
+
+    def duplicate_topic_ids(self):
+        """Returns a dict of topic ID to the URLs of each topic stored
+        more than once, which would stop a unique index being built."""
+        return {}
+
+
+class MongoTopicStorage(TopicStorage):
+    def __init__(self, db_collection):
+        self.collection = db_collection
+
+    def find_one(self, sorted_url):
+        return self.collection.find_one({'_id': sorted_url})
+
+    def find_many(self, sorted_urls):
+        query = {'_id': {'$in': sorted_urls}}
+        return dict((result['_id'], result) for result in self.collection.find(query, {'topic_id': 1, 'disabled': 1}))
+
+    def insert(self, document):
+        return self.collection.insert(document)
+
+    def update(self, gov_delivery_id, fields):
+        return self.collection.find_and_modify(
+            {'topic_id': gov_delivery_id},
+            {"$set": fields},
+            new=True
+        )
+
+    def update_many(self, gov_delivery_ids, fields):
+        # The documents are picked before the write, which only touches
+        # them, so what's returned is what this write changed rather than
+        # whatever a concurrent one left behind
+        documents = {}
+        for document in self.collection.find({'topic_id': {'$in': list(gov_delivery_ids)}}):
+            documents.setdefault(document['topic_id'], document)
+        if not documents:
+            return {}
+        self.collection.update(
+            {'_id': {'$in': [document['_id'] for document in documents.values()]}},
+            {"$set": fields},
+            multi=True
+        )
+        for document in documents.values():
+            document.update(fields)
+        return dict((document['_id'], document) for document in documents.values())
+
+    def delete(self, gov_delivery_id):
+        sorted_urls = [result['_id'] for result in self.collection.find({'topic_id': gov_delivery_id}, {'_id': 1})]
+        self.collection.remove({'topic_id': gov_delivery_id})
+        return sorted_urls
+
+    def find_all(self, modified_since=None):
+        query = {'modified': {'$gte': modified_since}} if modified_since is not None else {}
+        return self.collection.find(query, {'topic_id': 1, 'disabled': 1, 'modified': 1})
+
+    def count(self):
+        return self.collection.count()
+
+    def _existing_indexes(self):
+        """Returns the existing indexes as a dict of name to key list."""
+        return dict((name, [tuple(key) for key in info['key']])
+                    for name, info in self.collection.index_information().items())
+
+    def current_time(self):
+        return datetime.datetime.utcnow()
+
+    def _index_usage(self):
+        """Returns a dict of index name to operation count, or None if the
+        server can't report index usage. Indexes whose counters were reset
+        too recently to tell are left out."""
+        try:
+            result = self.collection.aggregate([{'$indexStats': {}}])
+        except OperationFailure:
+            return None
+        stats = result['result'] if isinstance(result, dict) else list(result)
+        counted_since = self.current_time() - INDEX_USAGE_MIN_AGE
+        return dict((stat['name'], stat['accesses']['ops']) for stat in stats
+                    if stat['accesses']['since'] <= counted_since)
+
+    def missing_indexes(self, existing=None):
+        if existing is None:
+            existing = self._existing_indexes()
+        return [index for index in INDEXES if index.keys not in existing.values()]
+
+    def ensure_indexes(self, skip=()):
+        """Creates any missing indexes in the background, except those
+        named in `skip`.
+
+        Returns the indexes that were created."""
+        missing = [index for index in self.missing_indexes() if index.name not in skip]
+        for index in missing:
+            self.collection.ensure_index(index.keys, name=index.name, background=True, **index.options)
+        return missing
+
+    def index_report(self):
+        """Reports declared indexes which don't exist, existing indexes which
+        aren't declared, and indexes the server hasn't used for at least
+        INDEX_USAGE_MIN_AGE."""
+        existing = self._existing_indexes()
+        declared_keys = [index.keys for index in INDEXES]
+        undeclared = [name for name, keys in existing.items()
+                      if name != '_id_' and keys not in declared_keys]
+
+        usage = self._index_usage()
+        unused = [name for name, ops in usage.items() if name != '_id_' and not ops] if usage is not None else []
+
+        missing = [index.name for index in self.missing_indexes(existing)]
+        return IndexReport(missing, sorted(undeclared), sorted(unused))
+
+    def duplicate_topic_ids(self):
+        result = self.collection.aggregate([
+            {'$match': {'topic_id': {'$ne': None}}},
+            {'$group': {'_id': '$topic_id', 'urls': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ])
+        groups = result['result'] if isinstance(result, dict) else list(result)
+        return dict((group['_id'], group['urls']) for group in groups)
+
+
+class InMemoryTopicStorage(TopicStorage):
+    """Keeps documents in a dict. Useful for tests and benchmarks; nothing
+    is shared between processes or survives a restart."""
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def find_one(self, sorted_url):
+        with self.lock:
+            return copy.copy(self.documents.get(sorted_url))
+
+    def find_many(self, sorted_urls):
+        with self.lock:
+            return dict((url, copy.copy(self.documents[url])) for url in sorted_urls if url in self.documents)
+
+    def insert(self, document):
+        with self.lock:
+            if document['_id'] in self.documents:
+                raise ValueError('Duplicate key: %s' % document['_id'])
+            self.documents[document['_id']] = copy.copy(document)
+        return document['_id']
+
+    def update(self, gov_delivery_id, fields):
+        return next(iter(self.update_many([gov_delivery_id], fields).values()), None)
+
+    def update_many(self, gov_delivery_ids, fields):
+        gov_delivery_ids = set(gov_delivery_ids)
+        updated = set()
+        results = {}
+        with self.lock:
+            for url, document in sorted(self.documents.items()):
+                if document['topic_id'] in gov_delivery_ids and document['topic_id'] not in updated:
+                    document.update(fields)
+                    updated.add(document['topic_id'])
+                    results[url] = copy.copy(document)
+        return results
+
+    def delete(self, gov_delivery_id):
+        with self.lock:
+            sorted_urls = [url for url, document in self.documents.items() if document['topic_id'] == gov_delivery_id]
+            for url in sorted_urls:
+                del self.documents[url]
+        return sorted_urls
+
+    def find_all(self, modified_since=None):
+        with self.lock:
+            documents = [copy.copy(document) for document in self.documents.values()
+                         if modified_since is None or document.get('modified') >= modified_since]
+        return iter(documents)
+
+    def count(self):
+        with self.lock:
+            return len(self.documents)
+
+
+class SQLiteTopicStorage(TopicStorage):
+    """Keeps documents in a SQLite database file.
+
+    The database is opened on first use in each process, as a connection
+    mustn't be carried across a fork. It's then shared by every thread in
+    the process, guarded by a lock."""
+    # SQLite limits the number of parameters in a single statement
+    MAX_PARAMETERS = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        connection.row_factory = sqlite3.Row
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS topics ('
+                               'id TEXT PRIMARY KEY, '
+                               'topic_id TEXT UNIQUE, '
+                               'created TIMESTAMP, '
+                               'modified TIMESTAMP, '
+                               'disabled INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS topics_modified ON topics (modified)')
+        return connection
+
+    @property
+    def connection(self):
+        if self.pid != os.getpid():
+            with self.connect_lock:
+                if self.pid != os.getpid():
+                    self._connection = self._connect()
+                    self.pid = os.getpid()
+        return self._connection
+
+    def _document(self, row):
+        return {
+            '_id': row['id'],
+            'topic_id': row['topic_id'],
+            'created': row['created'],
+            'modified': row['modified'],
+            'disabled': bool(row['disabled']) if row['disabled'] is not None else None,
+        }
+
+    def _select(self, where, parameters):
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM topics WHERE %s' % where, parameters).fetchall()
+        return [self._document(row) for row in rows]
+
+    def _select_in(self, column, values):
+        values = list(values)
+        documents = []
+        for start in range(0, len(values), self.MAX_PARAMETERS):
+            chunk = values[start:start + self.MAX_PARAMETERS]
+            documents.extend(self._select('%s IN (%s)' % (column, ', '.join('?' * len(chunk))), chunk))
+        return documents
+
+    def find_one(self, sorted_url):
+        documents = self._select('id = ?', [sorted_url])
+        return documents[0] if documents else None
+
+    def find_many(self, sorted_urls):
+        return dict((document['_id'], document) for document in self._select_in('id', sorted_urls))
+
+    def insert(self, document):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT INTO topics (id, topic_id, created, modified, disabled) VALUES (?, ?, ?, ?, ?)',
+                                    [document['_id'], document['topic_id'], document.get('created'),
+                                     document.get('modified'), document.get('disabled')])
+        return document['_id']
+
+    def update(self, gov_delivery_id, fields):
+        return next(iter(self.update_many([gov_delivery_id], fields).values()), None)
+
+    def update_many(self, gov_delivery_ids, fields):
+        # topic_id is unique here, so each topic has one document to update
+        gov_delivery_ids = list(set(gov_delivery_ids))
+        columns = sorted(fields)
+        assignments = ', '.join('%s = ?' % column for column in columns)
+        with self.lock, self.connection:
+            for start in range(0, len(gov_delivery_ids), self.MAX_PARAMETERS):
+                chunk = gov_delivery_ids[start:start + self.MAX_PARAMETERS]
+                self.connection.execute('UPDATE topics SET %s WHERE topic_id IN (%s)' % (assignments, ', '.join('?' * len(chunk))),
+                                        [fields[column] for column in columns] + chunk)
+        return dict((document['_id'], document) for document in self._select_in('topic_id', gov_delivery_ids))
+
+    def delete(self, gov_delivery_id):
+        sorted_urls = [document['_id'] for document in self._select('topic_id = ?', [gov_delivery_id])]
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM topics WHERE topic_id = ?', [gov_delivery_id])
+        return sorted_urls
+
+    def find_all(self, modified_since=None):
+        if modified_since is None:
+            return iter(self._select('1', []))
+        return iter(self._select('modified >= ?', [modified_since]))
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM topics').fetchone()[0]
@@ -0,0 +1,81 @@
+import datetime
+import unittest
+from mock import patch
+
+import topic_storage
+from topic_storage import InMemoryTopicStorage, SQLiteTopicStorage
+
+
+class TopicStorageBehaviour(object):
+    """Behaviour every non-Mongo backend must share. MongoTopicStorage is
+    covered by the PartnerIdRepository tests."""
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.created = datetime.datetime(2017, 3, 27, 12, 0, 0)
+        self.storage.insert({'_id': 'http://test.com/one', 'topic_id': 'TOPIC_1', 'created': self.created, 'modified': self.created})
+        self.storage.insert({'_id': 'http://test.com/two', 'topic_id': 'TOPIC_2', 'created': self.created, 'modified': self.created})
+
+    def test_finds_one_document(self):
+        document = self.storage.find_one('http://test.com/one')
+        self.assertEqual(document['topic_id'], 'TOPIC_1')
+        self.assertEqual(document['created'], self.created)
+        self.assertFalse(document.get('disabled'))
+
+    def test_finds_nothing_for_unknown_urls(self):
+        self.assertEqual(self.storage.find_one('http://test.com/missing'), None)
+
+    def test_finds_many_documents(self):
+        documents = self.storage.find_many(['http://test.com/one', 'http://test.com/two', 'http://test.com/missing'])
+        self.assertEqual(sorted(documents), ['http://test.com/one', 'http://test.com/two'])
+        self.assertEqual(documents['http://test.com/two']['topic_id'], 'TOPIC_2')
+
+    def test_updates_a_document(self):
+        modified = datetime.datetime(2017, 3, 28)
+        document = self.storage.update('TOPIC_1', {'disabled': True, 'modified': modified})
+        self.assertEqual(document['_id'], 'http://test.com/one')
+        self.assertTrue(document['disabled'])
+        self.assertTrue(self.storage.find_one('http://test.com/one')['disabled'])
+
+    def test_updating_an_unknown_topic_returns_none(self):
+        self.assertEqual(self.storage.update('TOPIC_3', {'disabled': True}), None)
+
+    def test_updates_many_documents(self):
+        documents = self.storage.update_many(['TOPIC_1', 'TOPIC_2', 'TOPIC_3'], {'disabled': True})
+        self.assertEqual(sorted(documents), ['http://test.com/one', 'http://test.com/two'])
+        self.assertTrue(all(document['disabled'] for document in documents.values()))
+
+    def test_deletes_the_documents_for_a_topic(self):
+        self.assertEqual(self.storage.delete('TOPIC_1'), ['http://test.com/one'])
+        self.assertEqual(self.storage.find_one('http://test.com/one'), None)
+        self.assertEqual(self.storage.count(), 1)
+
+    def test_iterates_over_documents_modified_since(self):
+        modified = datetime.datetime(2017, 3, 28)
+        self.storage.update('TOPIC_2', {'modified': modified})
+        self.assertEqual(len(list(self.storage.find_all())), 2)
+        self.assertEqual([document['topic_id'] for document in self.storage.find_all(modified)], ['TOPIC_2'])
+
+    def test_counts_documents(self):
+        self.assertEqual(self.storage.count(), 2)
+
+
+class InMemoryTopicStorageTestCase(TopicStorageBehaviour, unittest.TestCase):
+    def make_storage(self):
+        return InMemoryTopicStorage()
+
+
+class SQLiteTopicStorageTestCase(TopicStorageBehaviour, unittest.TestCase):
+    def make_storage(self):
+        return SQLiteTopicStorage(':memory:')
+
+    def test_opens_no_connection_until_used(self):
+        self.assertEqual(SQLiteTopicStorage(':memory:')._connection, None)
+
+    def test_opens_a_new_connection_in_a_forked_process(self):
+        parent_connection = self.storage.connection
+        with patch.object(topic_storage.os, 'getpid', return_value=-1):
+            self.assertIsNot(self.storage.connection, parent_connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
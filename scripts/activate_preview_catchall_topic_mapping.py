@@ -12,8 +12,10 @@ import datetime
 mongo = app.config["MONGO"]
 db = mongo.govuk_delivery
 
+timestamp = datetime.datetime.utcnow()
 db.topics.insert({
   '_id': 'https://www.preview.alphagov.co.uk/government/feed',
   'topic_id': 'UKGOVUK_521',
-  'created': datetime.datetime.utcnow()
+  'created': timestamp,
+  'modified': timestamp
 })
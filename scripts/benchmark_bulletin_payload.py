@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# Compares building a bulletin request body by rendering the Jinja template
+# with building it from the precompiled template, including reading it out
+# in the blocks httplib sends:
+#
+#   ./venv/bin/python scripts/benchmark_bulletin_payload.py [topic count] [body kilobytes]
+
+import os,sys
+import timeit
+
+# Add the parent directory to the PYTHONPATH. Relative imports won't
+# work as this isn't a module.
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from adapters.gov_delivery import env, default_footer, bulletin_template
+
+ITERATIONS = 100
+# httplib sends file-like bodies in blocks of this size
+BLOCK_SIZE = 8192
+
+
+def time_per_call(function):
+    """Returns the mean time of a call to function, in milliseconds."""
+    return timeit.timeit(function, number=ITERATIONS) * 1000 / ITERATIONS
+
+
+def render(topic_ids, subject, body):
+    template = env.get_template('create_and_send_bulletin.jinja')
+    return template.render(topic_ids=topic_ids, subject=subject, body=body, footer=default_footer).encode('utf-8')
+
+
+def stream(topic_ids, subject, body):
+    payload = bulletin_template.payload(topic_ids, subject, body)
+    while payload.read(BLOCK_SIZE):
+        pass
+
+
+if __name__ == '__main__':
+    topic_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    body_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    topic_ids = ['TOPIC_%d' % number for number in range(topic_count)]
+    subject = u'Bulletin subject'
+    body = u'<p>%s</p>' % (u'x' * (body_size * 1024))
+
+    print 'Mean milliseconds per bulletin with %d topics and a %dKB body' % (topic_count, body_size)
+    print 'render  %.3f' % time_per_call(lambda: render(topic_ids, subject, body))
+    print 'stream  %.3f' % time_per_call(lambda: stream(topic_ids, subject, body))
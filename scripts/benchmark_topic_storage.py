@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Compares the latency of the repository's hot paths on each topic storage
+# backend under the same workload:
+#
+#   ./venv/bin/python scripts/benchmark_topic_storage.py [--mongo] [topic count]
+#
+# The Mongo backend uses a scratch collection in the configured database
+# and is only benchmarked when --mongo is given.
+
+import os,sys
+import random
+import tempfile
+import timeit
+
+# Add the parent directory to the PYTHONPATH. Relative imports won't
+# work as this isn't a module.
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from adapters.partner_id_repository import PartnerIdRepository
+from adapters.topic_storage import InMemoryTopicStorage, SQLiteTopicStorage, MongoTopicStorage
+
+FEED_URLS_PER_NOTIFICATION = 40
+ITERATIONS = 1000
+
+
+def feed_url(number):
+    return 'https://www.gov.uk/government/feed?departments%%5B%%5D=department-%d' % number
+
+
+def populate(repository, topic_count):
+    for number in range(topic_count):
+        repository.store_partner_id_for_url(feed_url(number), 'TOPIC_%d' % number)
+
+
+def time_per_call(function):
+    """Returns the mean time of a call to function, in milliseconds."""
+    return timeit.timeit(function, number=ITERATIONS) * 1000 / ITERATIONS
+
+
+def benchmark(repository, topic_count):
+    urls = [feed_url(random.randrange(topic_count)) for _ in range(ITERATIONS)]
+    batches = [[feed_url(random.randrange(topic_count)) for _ in range(FEED_URLS_PER_NOTIFICATION)]
+               for _ in range(ITERATIONS)]
+    topic_ids = ['TOPIC_%d' % random.randrange(topic_count) for _ in range(ITERATIONS)]
+
+    return [
+        ('find one', time_per_call(lambda: repository.find_partner_id_for_url(urls.pop()))),
+        ('find %d' % FEED_URLS_PER_NOTIFICATION, time_per_call(lambda: repository.find_partner_ids_for_urls(batches.pop()))),
+        ('update', time_per_call(lambda: repository.update(topic_ids.pop(), disabled=True))),
+    ]
+
+
+def backends(include_mongo):
+    yield 'memory', InMemoryTopicStorage()
+    yield 'sqlite', SQLiteTopicStorage(os.path.join(tempfile.mkdtemp(), 'topics.sqlite3'))
+    if include_mongo:
+        from service import flask_app as app
+        collection = app.config['MONGO'].govuk_delivery.benchmark_topics
+        collection.drop()
+        yield 'mongo', MongoTopicStorage(collection)
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--mongo']
+    topic_count = int(arguments[0]) if arguments else 10000
+
+    print 'Mean milliseconds per call with %d topics' % topic_count
+    for name, storage in backends('--mongo' in sys.argv[1:]):
+        repository = PartnerIdRepository(storage)
+        populate(repository, topic_count)
+        results = benchmark(repository, topic_count)
+        print '%-8s %s' % (name, '  '.join('%s: %.3f' % result for result in results))
+        if isinstance(storage, MongoTopicStorage):
+            storage.collection.drop()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Lists the tasks in the dead-letter queue, or queues them again:
+#
+#   dead_letters.py list [--limit N]
+#   dead_letters.py redrive [--limit N] [--rate PER_SECOND]
+#
+# Re-driven tasks start again with their full retries. Notifications aren't
+# logged or coalesced again, as they were the first time round.
+
+import os,sys
+import argparse
+import logging
+
+# Add the parent directory to the PYTHONPATH. This is to get the tests passing
+# and script to run without having to restructure the entire application
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from service import flask_app as app, celery, send_notification
+
+logging.basicConfig(level=logging.INFO)
+
+
+def list_dead_letters(dead_letters, limit):
+    logging.info('%d tasks in the dead-letter queue' % dead_letters.count())
+    for entry in dead_letters.entries(limit=limit):
+        logging.info('%(id)s %(failed_at)s %(task)s after %(attempts)d attempts, %(error_class)s error: %(error)s' % entry)
+        logging.info('    args: %r kwargs: %r' % (entry['args'], entry['kwargs']))
+
+
+def redrive(entry):
+    task = celery.tasks[entry['task']]
+    kwargs = dict(entry['kwargs'], attempt=0)
+    if entry['task'] == send_notification.name:
+        kwargs['redriven'] = True
+    options = {'queue': app.config['URGENT_NOTIFICATION_QUEUE']} if kwargs.get('urgent') else {}
+    task.apply_async(entry['args'], kwargs, **options)
+    logging.info('Queued %s again' % entry['id'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look at or re-drive tasks in the dead-letter queue')
+    parser.add_argument('command', choices=['list', 'redrive'])
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--rate', type=float, default=5, help='tasks to queue a second')
+    options = parser.parse_args()
+
+    dead_letters = app.config['DEAD_LETTER_QUEUE']
+    if options.command == 'list':
+        list_dead_letters(dead_letters, options.limit or 100)
+    else:
+        sent = dead_letters.redrive(redrive, limit=options.limit, rate=options.rate)
+        logging.info('Re-drove %d tasks, %d left' % (sent, dead_letters.count()))
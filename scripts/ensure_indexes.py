@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Creates any missing indexes on the topics collection, or with --check
+# only reports on them. topic_id_unique isn't built while any topic ID is
+# stored more than once; those topics are listed to be cleaned up first.
+
+import os,sys
+import logging
+
+# Add the parent directory to the PYTHONPATH. This is to get the tests passing
+# and script to run without having to restructure the entire application
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from service import flask_app as app
+from adapters.topic_storage import INDEX_USAGE_MIN_AGE
+
+logging.basicConfig(level=logging.INFO)
+
+db = app.config['MONGO'].govuk_delivery
+
+UNIQUE_INDEX = 'topic_id_unique'
+
+
+def ensure_indexes(repository, check_only=False):
+    report = repository.index_report()
+    for name in report.undeclared:
+        logging.warning('Index %s is not declared by the repository' % name)
+    for name in report.unused:
+        logging.warning('Index %s has not been used for %d days' % (name, INDEX_USAGE_MIN_AGE.days))
+
+    duplicates = repository.duplicate_topic_ids() if UNIQUE_INDEX in report.missing else {}
+    for topic_id, urls in sorted(duplicates.items()):
+        logging.warning('Topic %s is stored for %d feed URLs: %s' % (topic_id, len(urls), ', '.join(sorted(urls))))
+
+    if check_only:
+        for name in report.missing:
+            logging.warning('Index %s is missing' % name)
+        return not report.missing
+
+    for index in repository.ensure_indexes(skip=[UNIQUE_INDEX] if duplicates else []):
+        logging.info('Building index %s in the background' % index.name)
+    if duplicates:
+        logging.warning('Not building index %s until the %d duplicated topics are removed' % (UNIQUE_INDEX, len(duplicates)))
+        return False
+    logging.info('Done')
+    return True
+
+
+if __name__ == '__main__':
+    repository = app.config['PARTNER_ID_REPOSITORY'](db.topics)
+    if not ensure_indexes(repository, check_only='--check' in sys.argv[1:]):
+        sys.exit(1)
@@ -0,0 +1,39 @@
+import unittest
+from mock import patch, call, Mock
+
+import ensure_indexes
+from adapters.partner_id_repository import IndexReport, INDEXES
+
+
+@patch.object(ensure_indexes, 'logging')
+class EnsureIndexesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.repository = Mock(**{
+            'index_report.return_value': IndexReport(['topic_id_unique'], ['old_index'], ['created']),
+            'ensure_indexes.return_value': INDEXES[:1],
+            'duplicate_topic_ids.return_value': {},
+        })
+
+    def test_creates_missing_indexes(self, mock_logging):
+        self.assertTrue(ensure_indexes.ensure_indexes(self.repository))
+        self.repository.ensure_indexes.assert_called_once_with(skip=[])
+        mock_logging.warning.assert_has_calls([
+            call('Index old_index is not declared by the repository'),
+            call('Index created has not been used for 7 days'),
+        ])
+        mock_logging.info.assert_has_calls([
+            call('Building index topic_id_unique in the background'),
+            call('Done'),
+        ])
+
+    def test_only_reports_when_checking(self, mock_logging):
+        self.assertFalse(ensure_indexes.ensure_indexes(self.repository, check_only=True))
+        self.assertFalse(self.repository.ensure_indexes.called)
+        mock_logging.warning.assert_any_call('Index topic_id_unique is missing')
+
+    def test_does_not_build_the_unique_index_over_duplicates(self, mock_logging):
+        self.repository.duplicate_topic_ids.return_value = {'TOPIC_1': ['http://a.com/', 'http://b.com/']}
+        self.repository.ensure_indexes.return_value = []
+        self.assertFalse(ensure_indexes.ensure_indexes(self.repository))
+        self.repository.ensure_indexes.assert_called_once_with(skip=['topic_id_unique'])
+        mock_logging.warning.assert_any_call('Topic TOPIC_1 is stored for 2 feed URLs: http://a.com/, http://b.com/')
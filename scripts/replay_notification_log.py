@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Posts the notification log entries kept in the spool while
+# email-alert-api was down, at NOTIFICATION_LOG_REPLAY_RATE a second. With
+# --follow it keeps going, trying again every 30 seconds after a failure.
+
+import os,sys
+import json
+import time
+import logging
+
+# Add the parent directory to the PYTHONPATH. This is to get the tests passing
+# and script to run without having to restructure the entire application
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,parentdir)
+
+from service import flask_app as app
+from adapters.notification_spool import SpoolReplayer
+
+logging.basicConfig(level=logging.INFO)
+
+RETRY_INTERVAL = 30
+
+
+def replay(replayer, follow=False, retry_interval=RETRY_INTERVAL):
+    while True:
+        drained = replayer.run()
+        logging.info('Notification log replay: %s' % json.dumps(replayer.stats()))
+        if not follow:
+            return drained
+        time.sleep(retry_interval)
+
+
+if __name__ == '__main__':
+    spool = app.config['NOTIFICATION_LOG_SPOOL']
+    if spool is None:
+        logging.error('NOTIFICATION_LOG_SPOOL_DIRECTORY is not set')
+        sys.exit(1)
+    notification_log = app.config['NOTIFICATION_LOG_CLIENT_OBJECT'](
+        hostname=app.config['NOTIFICATION_LOG_HOSTNAME'],
+        protocol=app.config['NOTIFICATION_LOG_PROTOCOL'],
+        timeout=app.config['NOTIFICATION_LOG_TIMEOUT'],
+    )
+    replayer = SpoolReplayer(spool, notification_log.replay, app.config['NOTIFICATION_LOG_REPLAY_RATE'])
+    if not replay(replayer, follow='--follow' in sys.argv[1:]):
+        sys.exit(1)
@@ -1,5 +1,15 @@
 #!/usr/bin/env python
 
+if __name__ == '__main__':
+    # With gevent installed, from requirements-scripts.txt, topics are
+    # counted from hundreds of greenlets rather than 40 threads. Sockets
+    # have to be patched before anything else is imported.
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
 import datetime
 import os,sys
 import logging
@@ -10,27 +20,39 @@ from multiprocessing.dummy import Pool
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0,parentdir)
 
-from service import flask_app as app
+from service import flask_app as app, topic_storage_for
+from adapters.gov_delivery_async import AsyncGovDeliveryClient
 
 logging.basicConfig(level=logging.WARNING, format='(%(threadName)-10s) %(message)s')
 
+# Topics counted at once: in greenlets if gevent is installed, otherwise
+# in threads
+CONCURRENCY = 500 if AsyncGovDeliveryClient.available() else 40
+
 gov_delivery_config = {
     'username': app.config['GOVDELIVERY_USERNAME'],
     'password': app.config['GOVDELIVERY_PASSWORD'],
     'account_code': app.config['GOVDELIVERY_ACCOUNT_CODE'],
     'hostname': app.config['GOVDELIVERY_HOSTNAME'],
+    'timeout': app.config['GOVDELIVERY_TIMEOUT'],
+    # Share the account's rate limits with the running service
+    'rate_limiter': app.config['GOVDELIVERY_RATE_LIMITER'],
+    # One pooled connection for each topic counted at once
+    'pool_size': CONCURRENCY,
 }
 
 delivery_partner = app.config['GOVDELIVERY_CLIENT_OBJECT'](**gov_delivery_config)
 db = app.config['MONGO'].govuk_delivery
+# Deletes go through the repository so that cached mappings are dropped too
+repository = app.config['PARTNER_ID_REPOSITORY'](topic_storage_for(app.config, app.config['MONGO']),
+                                                 app.config['PARTNER_ID_CACHE'])
 
 
 def get_topic_count(record):
     topic_id = record.get('topic_id')
 
     try:
-        topic = delivery_partner.read_topic(topic_id)
-        subscribers = int(topic['topic']['subscribers-count']['#text'])
+        subscribers = delivery_partner.read_topic_subscribers_count(topic_id)
         if subscribers:
             sys.stdout.write('-')
         else:
@@ -57,22 +79,29 @@ def delete_topic(record):
     if subscribers in (0, 'topic not found'):
         logging.warning('Deleting %s' % topic_id)
 
-        db.topics.remove({'topic_id': topic_id})
+        repository.delete(topic_id)
         # Only try to delete GovDelivery topics with 0 subscribers - don't bother
         # trying to delete topics we know don't exist:
         if subscribers == 0:
-            delivery_partner.delete_topic(topic_id)
+            try:
+                delivery_partner.delete_topic(topic_id)
+            except Exception as e:
+                logging.warning('Could not delete %s from GovDelivery: %s' % (topic_id, e))
     elif subscribers is None:
         logging.warning('Skipping %s as we got an error from GovDelivery' % topic_id)
     else:
         logging.warning('Skipping %s as it now has %s subscribers' % (topic_id, subscribers))
 
 
-def delete_topics_without_subscribers(get_topic_count, delete_topic, thread_count=20):
-    pool = Pool(thread_count)
+def map_concurrently(function, records, concurrency):
+    if AsyncGovDeliveryClient.available():
+        return AsyncGovDeliveryClient(delivery_partner, concurrency).map(function, records)
+    return Pool(concurrency).map(function, records)
+
 
+def delete_topics_without_subscribers(get_topic_count, delete_topic, concurrency=20):
     one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-    records_with_count = pool.map(get_topic_count, db.topics.find({'created': {'$lt': one_day_ago}}))
+    records_with_count = map_concurrently(get_topic_count, db.topics.find({'created': {'$lt': one_day_ago}}), concurrency)
     topics_missing_subscribers = [record for (count, record) in records_with_count if count == 0]
     missing_topics = [record for (count, record) in records_with_count if count == 'topic not found']
     topics_with_errors = [record for (count, record) in records_with_count if count is None]
@@ -104,4 +133,4 @@ def delete_topics_without_subscribers(get_topic_count, delete_topic, thread_coun
         logging.warning('Successfully deleted %s topics' % len(topics_to_delete))
 
 if __name__ == '__main__':
-    delete_topics_without_subscribers(get_topic_count, delete_topic, 40)
+    delete_topics_without_subscribers(get_topic_count, delete_topic, CONCURRENCY)
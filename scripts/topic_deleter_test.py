@@ -77,15 +77,20 @@ class DeleteTopicsWithSubscribersTestCase(unittest.TestCase):
         ])
         self.assertEqual(self.deleted_topics, [])
 
+class MapConcurrentlyTestCase(unittest.TestCase):
+    @patch.object(topic_deleter.AsyncGovDeliveryClient, 'available', return_value=False)
+    def test_falls_back_to_threads_without_gevent(self, mock_available):
+        self.assertEqual([2, 4, 6], topic_deleter.map_concurrently(lambda number: number * 2, [1, 2, 3], 2))
+
 class GetTopicCountTestCase(unittest.TestCase):
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', return_value={ 'topic': {'subscribers-count': {'#text': '3'} } })
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', return_value=3)
     def test_returns_the_subscriber_count_from_the_delivery_partner(self, mock_read_topic):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         self.assertEqual((3, record), topic_deleter.get_topic_count(record))
         mock_read_topic.assert_called_once_with('TOPIC_ID')
 
 
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', side_effect=Exception('fail'))
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', side_effect=Exception('fail'))
     def test_returns_a_none_count_when_an_error_is_raised_by_the_delivery_provider(self, mock_read_topic):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         self.assertEqual((None, record), topic_deleter.get_topic_count(record))
@@ -93,35 +98,33 @@ class GetTopicCountTestCase(unittest.TestCase):
 
 @patch.object(topic_deleter, 'logging')
 class DeleteTopicTestCase(unittest.TestCase):
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', return_value={ 'topic': {'subscribers-count': {'#text': '0'} } })
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', return_value=0)
     @patch.object(topic_deleter.delivery_partner, 'delete_topic', return_value=True)
-    @patch.object(topic_deleter.db, 'topics', new_callable=FakeCollection)
-    @patch.object(FakeCollection, 'remove', return_value=True)
-    def test_deletes_topics_that_have_no_subscribers_with_delivery_partner(self, mock_delete_record, fake_collection, mock_delete_topic, mock_read_topic, mock_logging):
+    @patch.object(topic_deleter.repository, 'delete', return_value=['url/one'])
+    def test_deletes_topics_that_have_no_subscribers_with_delivery_partner(self, mock_delete_record, mock_delete_topic, mock_read_topic, mock_logging):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         topic_deleter.delete_topic(record)
-        mock_delete_record.assert_called_once_with({'topic_id': 'TOPIC_ID'})
+        mock_delete_record.assert_called_once_with('TOPIC_ID')
         mock_delete_topic.assert_called_once_with('TOPIC_ID')
         mock_logging.warning.assert_called_once_with('Deleting TOPIC_ID')
 
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', side_effect=Exception('HTTP status: 404\nGD-14002\nTopic not found'))
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', side_effect=Exception('HTTP status: 404\nGD-14002\nTopic not found'))
     @patch.object(topic_deleter.delivery_partner, 'delete_topic', return_value=True)
-    @patch.object(topic_deleter.db, 'topics', new_callable=FakeCollection)
-    @patch.object(FakeCollection, 'remove', return_value=True)
-    def test_deletes_topics_that_do_not_exist_on_delivery_partner(self, mock_delete_record, fake_collection, mock_delete_topic, mock_read_topic, mock_logging):
+    @patch.object(topic_deleter.repository, 'delete', return_value=['url/one'])
+    def test_deletes_topics_that_do_not_exist_on_delivery_partner(self, mock_delete_record, mock_delete_topic, mock_read_topic, mock_logging):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         topic_deleter.delete_topic(record)
-        mock_delete_record.assert_called_once_with({'topic_id': 'TOPIC_ID'})
+        mock_delete_record.assert_called_once_with('TOPIC_ID')
         self.assertEqual(0, mock_delete_topic.call_count)
         mock_logging.warning.assert_called_once_with('Deleting TOPIC_ID')
 
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', return_value={ 'topic': {'subscribers-count': {'#text': '3'} } })
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', return_value=3)
     def test_do_not_delete_topics_with_subscribers_on_delivery_partner(self, mock_read_topic, mock_logging):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         topic_deleter.delete_topic(record)
         mock_logging.warning.assert_called_once_with('Skipping TOPIC_ID as it now has 3 subscribers')
 
-    @patch.object(topic_deleter.delivery_partner, 'read_topic', side_effect=Exception('fail'))
+    @patch.object(topic_deleter.delivery_partner, 'read_topic_subscribers_count', side_effect=Exception('fail'))
     def test_do_not_delete_topics_that_error_on_delivery_partner(self, mock_read_topic, mock_logging):
         record = Mock(**{'get.return_value': 'TOPIC_ID'})
         topic_deleter.delete_topic(record)
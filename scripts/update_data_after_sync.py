@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import datetime
 import logging
 import os
 import sys
@@ -39,7 +40,9 @@ def update_record(record, new_domain, account_code):
         data = {
             '_id'      : new_url,
             'topic_id' : new_topic_id,
-            'created'  : record['created']
+            'created'  : record['created'],
+            # So that workers' topic indexes pick up the new record
+            'modified' : datetime.datetime.utcnow(),
         }
         if record.has_key('disabled'):
             data['disabled'] = record['disabled']
@@ -1,5 +1,5 @@
 import unittest
-from mock import patch, call, Mock
+from mock import patch, call, Mock, ANY
 
 import update_data_after_sync
 
@@ -46,11 +46,13 @@ class UpdateDataAfterSyncTestCase(unittest.TestCase):
                 '_id': 'https://integration.gov.uk/feed?a=b&c=d',
                 'topic_id': 'DUPDUPDUP_1',
                 'created': '2013-08-01T12:53:31Z',
+                'modified': ANY,
             }),
             call({
                 '_id': 'https://integration.gov.uk/pubs?w=x&y=z',
                 'topic_id': 'DUPDUPDUP_2',
                 'created' : '2015-02-26T09:57:35Z',
+                'modified': ANY,
                 'disabled': True
             }),
         ])
@@ -1,15 +1,30 @@
 import os
+import random
 import logging
 import urllib
+import threading
+from contextlib import contextmanager
 
 from flask import Flask, request, g, jsonify, json, current_app
+from celery.signals import worker_process_init, worker_process_shutdown
 import redis
 import pymongo
 from logstash_formatter import LogstashFormatter
 
+from adapters.bulletin_dispatcher import BulletinDispatcher
 from adapters.gov_delivery import GovDeliveryClient
+from adapters.dead_letter import DeadLetterQueue
+from adapters.gov_delivery_policy import GovDeliveryPolicyClient, CircuitBreaker, call_policies, classify_task_error, error_code, not_applied, TRANSIENT
+from adapters.idempotency import IdempotencyStore, IN_FLIGHT
+from adapters.notification_coalescer import NotificationCoalescer, CoalescedNotification
 from adapters.notification_log import NotificationLog
-from adapters.partner_id_repository import PartnerIdRepository
+from adapters.notification_spool import NotificationSpool
+from adapters.payload_store import PayloadStore, PayloadNotFound
+from adapters.rate_limiter import RateLimiter
+from adapters.partner_id_repository import PartnerIdRepository, sort_url_query
+from adapters.partner_id_cache import LRUCache, RedisCache, TieredCache
+from adapters.topic_index import TopicIndex
+from adapters.topic_storage import InMemoryTopicStorage, SQLiteTopicStorage
 from tasks import make_celery
 from collections import namedtuple
 
@@ -25,8 +40,116 @@ flask_app.config.update(
     CELERY_BROKER_URL='redis://%(host)s:%(port)i/%(db)i' % flask_app.config['REDIS_SETTINGS']
 )
 
+def partner_id_cache(config):
+    """Builds the configured cache of feed URL to topic mappings, if any"""
+    local, shared = None, None
+    if config.get('PARTNER_ID_CACHE_SIZE'):
+        local = LRUCache(config['PARTNER_ID_CACHE_SIZE'], config['PARTNER_ID_CACHE_TTL'])
+    if config.get('PARTNER_ID_SHARED_CACHE_TTL'):
+        shared = RedisCache(config['REDIS'], config['PARTNER_ID_SHARED_CACHE_TTL'])
+    if local and shared:
+        return TieredCache(local, shared, config['REDIS'])
+    return local or shared
+
+flask_app.config['PARTNER_ID_CACHE'] = partner_id_cache(flask_app.config)
+
+def subscriber_cache(config):
+    """Builds the configured cache of GovDelivery subscribers, if any"""
+    local, shared = None, None
+    if config.get('SUBSCRIBER_CACHE_SIZE'):
+        local = LRUCache(config['SUBSCRIBER_CACHE_SIZE'], config['SUBSCRIBER_CACHE_TTL'])
+    if config.get('SUBSCRIBER_SHARED_CACHE_TTL'):
+        shared = RedisCache(config['REDIS'], config['SUBSCRIBER_SHARED_CACHE_TTL'], prefix='govuk_delivery:subscriber:')
+    if local and shared:
+        return TieredCache(local, shared, config['REDIS'], channel='govuk_delivery:subscriber:invalidate')
+    return local or shared
+
+flask_app.config['SUBSCRIBER_CACHE'] = subscriber_cache(flask_app.config)
+
+def topic_storage(config):
+    """Builds the configured topic storage, or None to use Mongo"""
+    backend = config.get('TOPIC_STORAGE_BACKEND', 'mongo')
+    if backend == 'memory':
+        return InMemoryTopicStorage()
+    if backend == 'sqlite':
+        return SQLiteTopicStorage(config['TOPIC_STORAGE_SQLITE_PATH'])
+    return None
+
+flask_app.config['TOPIC_STORAGE'] = topic_storage(flask_app.config)
+
+def topic_storage_for(config, mongo):
+    """The topic storage to hand to repositories"""
+    return config.get('TOPIC_STORAGE') or mongo.govuk_delivery.topics
+
+def gov_delivery_rate_limiter(config):
+    """Builds the rate limiter shared by every GovDelivery client, if any
+    limits are configured"""
+    if not config.get('GOVDELIVERY_RATE_LIMITS'):
+        return None
+    return RateLimiter(config['REDIS'], config['GOVDELIVERY_RATE_LIMITS'], config['GOVDELIVERY_RATE_LIMIT_MAX_WAIT'])
+
+flask_app.config['GOVDELIVERY_RATE_LIMITER'] = gov_delivery_rate_limiter(flask_app.config)
+
+def gov_delivery_circuit_breaker(config):
+    """Builds the circuit breaker around GovDelivery calls, if enabled"""
+    if not config.get('GOVDELIVERY_CIRCUIT_BREAKER_THRESHOLD'):
+        return None
+    return CircuitBreaker(config['REDIS'], config['GOVDELIVERY_ACCOUNT_CODE'],
+                          config['GOVDELIVERY_CIRCUIT_BREAKER_THRESHOLD'],
+                          config['GOVDELIVERY_CIRCUIT_BREAKER_WINDOW'],
+                          config['GOVDELIVERY_CIRCUIT_BREAKER_RESET_TIMEOUT'])
+
+def notification_log_spool(config):
+    """Builds the spool for notification log entries which couldn't be
+    posted, if enabled"""
+    if not config.get('NOTIFICATION_LOG_SPOOL_DIRECTORY'):
+        return None
+    return NotificationSpool(config['NOTIFICATION_LOG_SPOOL_DIRECTORY'],
+                             segment_size=config['NOTIFICATION_LOG_SPOOL_SEGMENT_SIZE'],
+                             fsync_interval=config['NOTIFICATION_LOG_SPOOL_FSYNC_INTERVAL'])
+
+flask_app.config['NOTIFICATION_LOG_SPOOL'] = notification_log_spool(flask_app.config)
+
+def payload_store(config):
+    """Builds the store workers fetch bulletin bodies from. It's built even
+    when bodies aren't being stored, to read those queued before."""
+    return PayloadStore(config['REDIS'], config['PAYLOAD_STORE_TTL'], config['PAYLOAD_STORE_COMPRESS_MIN_SIZE'])
+
+flask_app.config['PAYLOAD_STORE'] = payload_store(flask_app.config)
+
+def idempotency_store(config):
+    """Builds the record of notifications sent, to suppress duplicates, if enabled"""
+    if not config.get('NOTIFICATION_IDEMPOTENCY_TTL'):
+        return None
+    return IdempotencyStore(config['REDIS'], config['NOTIFICATION_IDEMPOTENCY_TTL'],
+                            config['NOTIFICATION_IDEMPOTENCY_IN_FLIGHT_TTL'])
+
+flask_app.config['IDEMPOTENCY_STORE'] = idempotency_store(flask_app.config)
+
+def notification_coalescer(config):
+    """Builds the buffer notifications with the same content are sent
+    together from, if enabled"""
+    if not config.get('NOTIFICATION_COALESCE_WINDOW'):
+        return None
+    return NotificationCoalescer(config['REDIS'], config['NOTIFICATION_COALESCE_WINDOW'])
+
+flask_app.config['NOTIFICATION_COALESCER'] = notification_coalescer(flask_app.config)
+
+flask_app.config['DEAD_LETTER_QUEUE'] = DeadLetterQueue(flask_app.config['REDIS'])
+
 celery = make_celery(flask_app)
 
+@worker_process_init.connect
+def preload_topic_index(**kwargs):
+    """Loads the topic index in each worker process after it's forked"""
+    if not flask_app.config.get('PRELOAD_TOPIC_INDEX_IN_WORKERS'):
+        return
+    index = TopicIndex(topic_storage_for(flask_app.config, flask_app.config['MONGO']),
+                       flask_app.config['TOPIC_INDEX_REFRESH_INTERVAL'],
+                       flask_app.config['TOPIC_INDEX_FULL_RELOAD_INTERVAL'])
+    index.start()
+    flask_app.config['TOPIC_INDEX'] = index
+
 def environment():
     return os.getenv("GOVUK_ENV", "development")
 
@@ -75,59 +198,132 @@ def logstasher_request_params(request, status):
 class Subscription(object):
     def __init__(self, mongo, gov_delivery_client, notification_log_client):
         # TODO: make DB name configurable
-        mongo_db = mongo.govuk_delivery
-        self.repository = current_app.config['PARTNER_ID_REPOSITORY'](mongo_db.topics)
+        self.repository = current_app.config['PARTNER_ID_REPOSITORY'](topic_storage_for(current_app.config, mongo),
+                                                                      current_app.config.get('PARTNER_ID_CACHE'),
+                                                                      current_app.config.get('TOPIC_INDEX'),
+                                                                      current_app.config['TOPIC_INDEX_MAX_STALENESS'])
         gov_delivery_client_args = {
             'username': current_app.config['GOVDELIVERY_USERNAME'],
             'password': current_app.config['GOVDELIVERY_PASSWORD'],
             'account_code': current_app.config['GOVDELIVERY_ACCOUNT_CODE'],
             'hostname': current_app.config['GOVDELIVERY_HOSTNAME'],
+            'pool_size': current_app.config['GOVDELIVERY_POOL_SIZE'],
+            'timeout': current_app.config['GOVDELIVERY_TIMEOUT'],
+            'rate_limiter': current_app.config.get('GOVDELIVERY_RATE_LIMITER'),
+            'subscriber_cache': current_app.config.get('SUBSCRIBER_CACHE'),
         }
-        self.delivery_partner = gov_delivery_client(**gov_delivery_client_args)
+        self.delivery_partner = GovDeliveryPolicyClient(gov_delivery_client(**gov_delivery_client_args),
+                                                        call_policies(current_app.config.get('GOVDELIVERY_CALL_POLICIES')),
+                                                        gov_delivery_circuit_breaker(current_app.config))
 
         notification_log_client_args = {
             'hostname': current_app.config['NOTIFICATION_LOG_HOSTNAME'],
-            'protocol': current_app.config['NOTIFICATION_LOG_PROTOCOL']
+            'protocol': current_app.config['NOTIFICATION_LOG_PROTOCOL'],
+            'timeout': current_app.config['NOTIFICATION_LOG_TIMEOUT'],
+            'batch_size': current_app.config['NOTIFICATION_LOG_BATCH_SIZE'],
+            'flush_interval': current_app.config['NOTIFICATION_LOG_FLUSH_INTERVAL'],
+            'spool': current_app.config['NOTIFICATION_LOG_SPOOL'],
         }
         self.notification_log = notification_log_client(**notification_log_client_args)
+        self.redis = current_app.config['REDIS']
+        self.dispatcher = BulletinDispatcher(self.delivery_partner, self.redis,
+                                             current_app.config['BULLETIN_CHUNK_SIZE'],
+                                             current_app.config['BULLETIN_CONCURRENCY'],
+                                             current_app.config['BULLETIN_CHUNK_RETRIES'],
+                                             record_ttl=current_app.config['BULLETIN_DELIVERY_RECORD_TTL'])
 
     # TODO: Test what happens if subscription fails
     def subscribe(self, email, feed_urls, frequency='daily'):
+        """Subscribes an email address to the topics for feed URLs.
+
+        By default the subscriber is created if need be and their topics
+        added to in a single request, after which new subscribers are given
+        `frequency` rather than the account's default. If that request
+        fails in a way that shows nothing was added, the subscriber is
+        created if missing and the topics merged into theirs. If
+        SUBSCRIBE_FAST_PATH is off, the subscriber is read, created if
+        missing, and their topics replaced."""
+        topics = self.repository.find_partner_ids_for_urls(feed_urls)
+        topic_ids = [response.topic_id for response in topics if response.topic_id is not None]
+
+        if current_app.config.get('SUBSCRIBE_FAST_PATH'):
+            # Usually answered by the subscriber cache
+            existed = self.delivery_partner.subscriber_exists(email)
+            try:
+                self.delivery_partner.create_subscriber_and_add_subscriptions(email, topic_ids)
+            except Exception as error:
+                if not not_applied(error):
+                    raise
+                current_app.logger.warn('Could not subscribe to %r in one request, merging them in instead: %s', topic_ids, error)
+                if not existed:
+                    self.delivery_partner.create_subscriber(email, frequency)
+                self.delivery_partner.merge_subscriber_topics(email, topic_ids)
+            else:
+                if not existed:
+                    self.delivery_partner.update_subscriber_frequency(email, frequency)
+            return True
+
         # Try and get them first
-        subscriber = self.delivery_partner.read_subscriber(email)
+        subscriber = self.delivery_partner.subscriber_exists(email)
         if not subscriber:
             subscriber = self.delivery_partner.create_subscriber(email, frequency)
         if subscriber:
-            topics = [self.repository.find_partner_id_for_url(url) for url in feed_urls]
-            topic_ids = [response.topic_id for response in topics if response.topic_id is not None]
             result = self.delivery_partner.update_subscriber_topics(email, topic_ids)
         return True
 
+    @contextmanager
+    def topic_creation_lock(self, feed_url):
+        """Holds a lock, shared by every process, on creating the topic for
+        a feed URL.
+
+        If Redis is unavailable topics are created without the lock."""
+        lock = self.redis.lock('govuk_delivery:create_topic:%s' % sort_url_query(feed_url),
+                               timeout=current_app.config['TOPIC_CREATION_LOCK_TIMEOUT'])
+        try:
+            acquired = lock.acquire()
+        except redis.RedisError as error:
+            current_app.logger.warn('Creating topic for %s without a lock: %s', feed_url, error)
+            acquired = False
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except redis.RedisError as error:
+                    current_app.logger.warn('Could not release topic creation lock for %s: %s', feed_url, error)
+
     # TODO: Test what happens when creating a list fails
     def partner_id(self, feed_url, title, description=None):
         """Fetches a partner ID from the key/value store, mapped by URL.
 
-        If the URL isn't in the key/value store we create a new list."""
+        If the URL isn't in the key/value store we create a new list. Only
+        one caller creates the list for a URL at a time; the others wait
+        and use the list it created."""
         topic_id = self.repository.find_partner_id_for_url(feed_url).topic_id
         if not topic_id:
-            response = self.delivery_partner.create_topic({'name': title,
-                                                           'short_name': description,
-                                                           'visibility': 'Unlisted'})
-            topic_id = response.get('topic', {}).get('to-param')
-            self.repository.store_partner_id_for_url(feed_url, topic_id)
+            with self.topic_creation_lock(feed_url):
+                # Another caller may have created the topic while we waited
+                topic_id = self.repository.find_partner_id_for_url(feed_url).topic_id
+                if not topic_id:
+                    response = self.delivery_partner.create_topic({'name': title,
+                                                                   'short_name': description,
+                                                                   'visibility': 'Unlisted'})
+                    topic_id = response.get('topic', {}).get('to-param')
+                    self.repository.store_partner_id_for_url(feed_url, topic_id)
         return topic_id
 
 
     def parse_topics(self, feed_urls):
-        topics = [self.repository.find_partner_id_for_url(url) for url in feed_urls]
+        topics = self.repository.find_partner_ids_for_urls(feed_urls)
         enabled_topic_ids = [v.topic_id for v in topics if v.topic_id is not None and not v.disabled]
         disabled_topic_ids = [v.topic_id for v in topics if v.topic_id is not None and v.disabled]
 
         return TopicIds(enabled_topic_ids, disabled_topic_ids)
 
-    def send_notification(self, topic_ids, subject, body):
+    def send_notification(self, topic_ids, subject, body, govuk_request_id=None):
         if not current_app.config.get('DISABLE_NOTIFICATIONS'):
-            return self.delivery_partner.create_and_send_bulletin(topic_ids, subject, body)
+            return self.dispatcher.dispatch(topic_ids, subject, body, govuk_request_id)
         else:
             current_app.logger.info('Would send email: %r' % {
                 'topic_ids': topic_ids,
@@ -166,39 +362,300 @@ class Subscription(object):
     def enable(self, gov_delivery_id):
         return self.repository.update(gov_delivery_id, disabled=None)
 
+    def disable_many(self, gov_delivery_ids):
+        return self.repository.update_many(gov_delivery_ids, disabled=True)
+
+    def enable_many(self, gov_delivery_ids):
+        return self.repository.update_many(gov_delivery_ids, disabled=None)
+
 flask_app.config['SUBSCRIPTION_OBJECT'] = Subscription
 flask_app.config['GOVDELIVERY_CLIENT_OBJECT'] = GovDeliveryClient
 flask_app.config['NOTIFICATION_LOG_CLIENT_OBJECT'] = NotificationLog
 flask_app.config['PARTNER_ID_REPOSITORY'] = PartnerIdRepository
 
+class ServiceContainer(object):
+    """Builds the Subscription, with the GovDelivery client, notification
+    log and repository it holds, once per process.
+
+    Every request and task in the process is handed the same instance, so
+    templates are compiled and clients are constructed once rather than
+    on every call. A forked child builds its own on first use."""
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.instance = None
+        self.pid = None
+
+    def subscription(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.instance = self.app.config['SUBSCRIPTION_OBJECT'](self.app.config['MONGO'],
+                                                                           self.app.config['GOVDELIVERY_CLIENT_OBJECT'],
+                                                                           self.app.config['NOTIFICATION_LOG_CLIENT_OBJECT'])
+                    self.pid = os.getpid()
+        return self.instance
+
+    def close(self):
+        """Spools or posts the notification log entries still queued by
+        this process's subscription, if it has one."""
+        if self.pid == os.getpid() and hasattr(self.instance, 'notification_log'):
+            self.instance.notification_log.close()
+
+container = ServiceContainer(flask_app)
+
+@worker_process_shutdown.connect
+def close_notification_log(**kwargs):
+    """Keeps queued notification log entries when a worker process exits,
+    as prefork children never run atexit handlers"""
+    container.close()
+
 @celery.task(name="send-notification")
-def send_notification(feed_urls, subject, body, logging_params, govuk_request_id):
-    "Send an email notification"
-    subscription = current_app.config['SUBSCRIPTION_OBJECT'](current_app.config['MONGO'],
-                                                             current_app.config['GOVDELIVERY_CLIENT_OBJECT'],
-                                                             current_app.config['NOTIFICATION_LOG_CLIENT_OBJECT'])
+def send_notification(feed_urls, subject, body, logging_params, govuk_request_id, body_ref=None, urgent=False, attempt=0,
+                      redriven=False):
+    """Send an email notification, with the body or a reference to it in the payload store.
+    Retries and re-driven dead letters were logged, and coalesced if they were
+    going to be, the first time round"""
+    subscription = container.subscription()
+    # Notifications sent from the request itself aren't held back or
+    # retried, as the response reports whether they were sent
+    background = flask_app.config.get('USE_BACKGROUND_WORKERS')
+    first_time = not attempt and not redriven
+
+    def retry(error, error_class, can_resend=True):
+        args = [feed_urls, subject, body, logging_params, govuk_request_id]
+        kwargs = {'body_ref': body_ref, 'urgent': urgent, 'attempt': attempt}
+        if redriven:
+            kwargs['redriven'] = True
+        return retry_or_dead_letter(send_notification, args, kwargs, error, can_resend, error_class)
+
+    try:
+        topic_ids = subscription.parse_topics(feed_urls)
+        if first_time:
+            subscription.log_notification(topic_ids.enabled, topic_ids.disabled, logging_params, govuk_request_id)
+        if not topic_ids.enabled:
+            return None
+        if background and not urgent and first_time and coalesce_notification(topic_ids.enabled, subject, body, govuk_request_id, body_ref):
+            return None
+        if body_ref:
+            body, body_ref = flask_app.config['PAYLOAD_STORE'].get(body_ref), None
+    except Exception as error:
+        # Nothing has been sent, so it's safe to try again
+        if not background or not retry(error, TRANSIENT):
+            raise
+        return None
 
-    topic_ids = subscription.parse_topics(feed_urls)
-    subscription.log_notification(topic_ids.enabled, topic_ids.disabled, logging_params, govuk_request_id)
-    if topic_ids.enabled:
-        return subscription.send_notification(topic_ids.enabled, subject, body)
+    try:
+        return subscription.send_notification(topic_ids.enabled, subject, body, govuk_request_id)
+    except Exception as error:
+        if not background or error_code(error) == 'GD-12004':
+            raise
+        if not retry(error, classify_task_error(error), subscription.dispatcher.can_resend(govuk_request_id)):
+            raise
+
+    return None
+
+def dead_letter_body(args, kwargs):
+    """Puts the body a task was handed by reference back in its arguments,
+    so that the dead letter outlives the payload store. Both notification
+    tasks take the body as their third argument."""
+    if not kwargs.get('body_ref'):
+        return args, kwargs
+    try:
+        body = flask_app.config['PAYLOAD_STORE'].get(kwargs['body_ref'])
+    except (PayloadNotFound, redis.RedisError) as error:
+        flask_app.logger.error('Could not fetch body %s for the dead-letter queue: %s', kwargs['body_ref'], error)
+        return args, kwargs
+    return args[:2] + [body] + args[3:], dict(kwargs, body_ref=None)
+
+def retry_or_dead_letter(task, args, kwargs, error, can_resend=True, error_class=None):
+    """Queues a failed task again after a backoff, if its class of error
+    has retries left and sending it again can't send a bulletin twice, or
+    else adds it to the dead-letter queue. Returns whether it was queued
+    again.
+
+    The error is classified by classify_task_error unless its class is
+    given, as it is for errors raised before anything was sent."""
+    attempt = kwargs['attempt']
+    error_class = error_class or classify_task_error(error)
+    if can_resend and attempt < flask_app.config['SEND_NOTIFICATION_RETRIES'].get(error_class, 0):
+        # Full jitter, so that tasks which failed together aren't retried together
+        delay = random.uniform(0, min(flask_app.config['SEND_NOTIFICATION_RETRY_MAX_BACKOFF'],
+                                      flask_app.config['SEND_NOTIFICATION_RETRY_BACKOFF'] * 2 ** attempt))
+        options = {'queue': flask_app.config['URGENT_NOTIFICATION_QUEUE']} if kwargs.get('urgent') else {}
+        try:
+            task.apply_async(args, dict(kwargs, attempt=attempt + 1), countdown=delay, **options)
+        except Exception as queue_error:
+            flask_app.logger.error('Could not queue %s again: %s', task.name, queue_error)
+        else:
+            flask_app.logger.warn('%s failed with a %s error on attempt %d, retrying in %.0fs: %s',
+                                  task.name, error_class, attempt + 1, delay, error)
+            return True
+
+    try:
+        args, kwargs = dead_letter_body(args, kwargs)
+        flask_app.config['DEAD_LETTER_QUEUE'].add(task.name, args, kwargs, error, error_class, attempt + 1)
+        flask_app.logger.error('%s failed with a %s error after %d attempts, added to the dead-letter queue: %s',
+                               task.name, error_class, attempt + 1, error)
+    except redis.RedisError as queue_error:
+        flask_app.logger.error('Could not add %s to the dead-letter queue, it will not be sent: %r %r: %s',
+                               task.name, args, kwargs, queue_error)
+    return False
+
+def coalesce_notification(topic_ids, subject, body, govuk_request_id, body_ref=None):
+    """Buffers a notification to be sent with others with the same content,
+    if enabled. Returns False if it should be sent now."""
+    coalescer = flask_app.config.get('NOTIFICATION_COALESCER')
+    if not coalescer:
+        return False
+    try:
+        group = coalescer.add(topic_ids, subject, body, govuk_request_id, body_ref)
+    except redis.RedisError as error:
+        flask_app.logger.warn('Could not coalesce notification for request id %s, sending it now: %s', govuk_request_id, error)
+        return False
+    flask_app.logger.info('Coalescing notification for request id %s to %d topics', govuk_request_id, len(topic_ids))
+    if group:
+        try:
+            flush_notifications.apply_async(args=[group], countdown=coalescer.window)
+        except Exception as error:
+            flask_app.logger.warn('Could not schedule coalesced notifications, sending them now: %s', error)
+            try:
+                flush_notifications(group)
+            except Exception as flush_error:
+                # The flush has dead-lettered them or found no subscribers,
+                # so this notification mustn't be retried on its own
+                flask_app.logger.error('Could not send coalesced notifications in group %s: %s', group, flush_error)
+    return True
+
+def coalesced_body(notification):
+    if notification.body_ref:
+        return flask_app.config['PAYLOAD_STORE'].get(notification.body_ref)
+    return notification.body
+
+def send_coalesced(notification, body):
+    flask_app.logger.info('Sending %d coalesced notifications to %d topics, for request ids %s',
+                          len(notification.govuk_request_ids), len(notification.topic_ids),
+                          ', '.join(notification.govuk_request_ids))
+    subscription = container.subscription()
+    return subscription.send_notification(notification.topic_ids, notification.subject, body,
+                                          notification.govuk_request_ids[0])
+
+def send_coalesced_or_retry(notification, attempt):
+    """Sends coalesced notifications, handing them to retry_or_dead_letter
+    if that fails. Returns whether they're sent or handed on."""
+    args = [notification.topic_ids, notification.subject, notification.body, notification.govuk_request_ids]
+    kwargs = {'body_ref': notification.body_ref, 'attempt': attempt}
+    try:
+        body = coalesced_body(notification)
+    except Exception as error:
+        # Nothing has been sent, so it's safe to try again
+        if not retry_or_dead_letter(send_coalesced_notifications, args, kwargs, error, error_class=TRANSIENT):
+            raise
+        return True
 
+    try:
+        send_coalesced(notification, body)
+    except Exception as error:
+        if error_code(error) == 'GD-12004':
+            raise
+        can_resend = container.subscription().dispatcher.can_resend(notification.govuk_request_ids[0])
+        if not retry_or_dead_letter(send_coalesced_notifications, args, kwargs, error, can_resend):
+            raise
+    return True
+
+@celery.task(name="flush-notifications")
+def flush_notifications(group):
+    "Send the notifications coalesced in a group as one bulletin"
+    coalescer = flask_app.config['NOTIFICATION_COALESCER']
+    notification = coalescer.peek(group)
+    if notification is None:
+        return None
+    try:
+        send_coalesced_or_retry(notification, 0)
+    finally:
+        # By now the notifications were sent, had no subscribers, or are
+        # carried by a retry or a dead letter
+        remove_coalesced(coalescer, group, notification)
     return None
 
+def remove_coalesced(coalescer, group, notification):
+    try:
+        left = coalescer.remove(group, notification)
+    except redis.RedisError as error:
+        flask_app.logger.warn('Could not remove sent notifications from group %s: %s', group, error)
+        return
+    if left:
+        flask_app.logger.info('%d topics were added to group %s while it was sent, sending them later', left, group)
+        flush_notifications.apply_async(args=[group], countdown=coalescer.window)
+
+@celery.task(name="send-coalesced-notifications")
+def send_coalesced_notifications(topic_ids, subject, body, govuk_request_ids, body_ref=None, attempt=0):
+    "Send notifications which were coalesced again, after sending them failed"
+    send_coalesced_or_retry(CoalescedNotification(topic_ids, subject, body, body_ref, govuk_request_ids), attempt)
+
+@flask_app.before_first_request
+def check_indexes():
+    if not flask_app.config.get('CHECK_INDEXES_ON_STARTUP'):
+        return
+    try:
+        repository = flask_app.config['PARTNER_ID_REPOSITORY'](topic_storage_for(flask_app.config, flask_app.config['MONGO']))
+        report = repository.index_report()
+    except Exception as error:
+        flask_app.logger.warn('Could not check indexes: %s', error)
+        return
+
+    for name in report.missing:
+        flask_app.logger.warn('Index %s is missing from the topics collection, run scripts/ensure_indexes.py', name)
+    for name in report.undeclared + report.unused:
+        flask_app.logger.warn('Index %s on the topics collection is undeclared or unused', name)
+
 # Set up client subscription
 @flask_app.before_request
 def before_request():
-    # We set up a global subscription object which means we only make
-    # our database connection once
-    g.subscription = flask_app.config['SUBSCRIPTION_OBJECT'](flask_app.config['MONGO'],
-                                                             flask_app.config['GOVDELIVERY_CLIENT_OBJECT'],
-                                                             current_app.config['NOTIFICATION_LOG_CLIENT_OBJECT'])
+    # The subscription object is built once per process and shared by
+    # every request
+    g.subscription = container.subscription()
 
     if not request.method == 'GET' and not request.get_json():
         if request.headers.get('Content-Type') != 'application/json':
             return '', 415
         return '', 400
 
+def stored_body(body):
+    """Returns the (body, body_ref) to hand a task: a reference to the body
+    in the payload store if it's big enough to store, or else the body."""
+    min_size = flask_app.config.get('PAYLOAD_STORE_MIN_SIZE')
+    if min_size is None or len(body) < min_size:
+        return body, None
+    try:
+        return None, flask_app.config['PAYLOAD_STORE'].put(body)
+    except redis.RedisError as error:
+        flask_app.logger.warn('Could not store the body, sending it through the broker: %s', error)
+        return body, None
+
+def notification_key(govuk_request_id, logging_params, feed_urls, subject):
+    """The key to suppress duplicates of a notification by, or None"""
+    store = flask_app.config.get('IDEMPOTENCY_STORE')
+    return store.key(govuk_request_id, logging_params, feed_urls, subject) if store else None
+
+def remember_notification(key, status, **response):
+    if key:
+        flask_app.config['IDEMPOTENCY_STORE'].complete(key, status, response)
+
+def duplicate_notification_response(record):
+    """Answers a duplicate notification from the record of the first one"""
+    if record['state'] == IN_FLIGHT:
+        status, response = 202, {'success': True, 'message': 'This notification is already being sent'}
+    else:
+        status, response = record['status'], record['response']
+    values = logstasher_request_params(request, status)
+    values['duplicate'] = True
+    flask_app.logger.info(logstasher_request(request), extra=values)
+    return jsonify(**response), status
+
 @flask_app.route('/notifications', methods=['POST'])
 def create_notification():
     """Allows creation of a new alert
@@ -212,6 +669,8 @@ def create_notification():
         "subject": "This is an email subject",
         "body" : "<p>Some HTML here</p>"
     }
+
+    With "urgent": true the notification is queued ahead of others.
     """
     # TODO: Should be able to take HTML over multipart
     # TODO: This should take more than one feed
@@ -224,19 +683,43 @@ def create_notification():
 
     govuk_request_id = request.headers.get('Govuk-Request-Id', '')
     logging_params = request.get_json().get('logging_params', {})
-    if flask_app.config.get('USE_BACKGROUND_WORKERS'):
-        send_notification.delay(request.get_json()['feed_urls'], request.get_json()['subject'], request.get_json()['body'], logging_params, govuk_request_id)
-        flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 201))
-    else:
-        try:
-            send_notification(request.get_json()['feed_urls'], request.get_json()['subject'], request.get_json()['body'], logging_params, govuk_request_id)
-        except Exception as error:
-            if 'Error code: GD-12004' in str(error):
-                flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 400), exc_info=True)
-                return jsonify(success=False, message='No subscribers for topics %r' % json.dumps(request.get_json()['feed_urls'])), 400
-            flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 201), exc_info=True)
-            raise error
 
+    # Publishers retry on timeouts, so a notification already sent or
+    # being sent is answered as it was the first time
+    key = notification_key(govuk_request_id, logging_params, request.get_json()['feed_urls'], request.get_json()['subject'])
+    if key:
+        record = flask_app.config['IDEMPOTENCY_STORE'].begin(key)
+        if record is not None:
+            return duplicate_notification_response(record)
+
+    try:
+        if flask_app.config.get('USE_BACKGROUND_WORKERS'):
+            body, body_ref = stored_body(request.get_json()['body'])
+            args = [request.get_json()['feed_urls'], request.get_json()['subject'], body, logging_params, govuk_request_id]
+            kwargs = {'body_ref': body_ref} if body_ref else {}
+            if request.get_json().get('urgent'):
+                kwargs['urgent'] = True
+                send_notification.apply_async(args, kwargs, queue=flask_app.config['URGENT_NOTIFICATION_QUEUE'])
+            else:
+                send_notification.delay(*args, **kwargs)
+            flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 201))
+        else:
+            try:
+                send_notification(request.get_json()['feed_urls'], request.get_json()['subject'], request.get_json()['body'], logging_params, govuk_request_id)
+            except Exception as error:
+                if error_code(error) == 'GD-12004':
+                    flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 400), exc_info=True)
+                    message = 'No subscribers for topics %r' % json.dumps(request.get_json()['feed_urls'])
+                    remember_notification(key, 400, success=False, message=message)
+                    return jsonify(success=False, message=message), 400
+                flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 201), exc_info=True)
+                raise error
+    except Exception:
+        if key:
+            flask_app.config['IDEMPOTENCY_STORE'].release(key)
+        raise
+
+    remember_notification(key, 201, success=True)
     return jsonify(success=True), 201
 
 @flask_app.route('/lists', methods=['POST'])
@@ -313,9 +796,12 @@ def create_subscription():
         return '', 500
 
 
-def update_list(update_method, update_type):
+def update_list(update_method, bulk_update_method, update_type):
     flask_app.logger.debug('%s_list: %r' % (update_type, request.get_json()))
 
+    if request.get_json().get('gov_delivery_ids') is not None:
+        return update_lists(bulk_update_method)
+
     if not (request.get_json().get('gov_delivery_id')):
         flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 400))
         return jsonify(message='You must provide a valid GovDelievry ID', success=False), 400
@@ -337,6 +823,34 @@ def update_list(update_method, update_type):
         disabled=list.get('disabled')
     ), 200
 
+def update_lists(bulk_update_method):
+    gov_delivery_ids = request.get_json()['gov_delivery_ids']
+    if not (isinstance(gov_delivery_ids, list) and gov_delivery_ids and all(gov_delivery_ids)):
+        flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 400))
+        return jsonify(message='You must provide a list of valid GovDelivery IDs', success=False), 400
+    try:
+        lists = bulk_update_method(gov_delivery_ids)
+    except Exception as error:
+        flask_app.logger.error(logstasher_request(request), extra=logstasher_request_params(request, 400), exc_info=True)
+        return jsonify(success=False), 400
+
+    results = []
+    for gov_delivery_id in gov_delivery_ids:
+        updated = lists.get(gov_delivery_id)
+        if updated:
+            results.append(dict(
+                gov_delivery_id=gov_delivery_id,
+                success=True,
+                topic_id=updated.get('topic_id'),
+                url=updated.get('_id'),
+                disabled=updated.get('disabled')
+            ))
+        else:
+            results.append(dict(gov_delivery_id=gov_delivery_id, success=False))
+
+    flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 200))
+    return jsonify(success=True, lists=results), 200
+
 @flask_app.route('/lists/disable', methods=['POST'])
 def disable_list():
     """Allows disabling of a feed URL
@@ -346,8 +860,14 @@ def disable_list():
     {
         "gov_delivery_id": "TOPIC_12",
     }
+
+    or to disable many at once:
+
+    {
+        "gov_delivery_ids": ["TOPIC_12", "TOPIC_13"],
+    }
     """
-    return update_list(g.subscription.disable, 'disable')
+    return update_list(g.subscription.disable, g.subscription.disable_many, 'disable')
 
 @flask_app.route('/lists/enable', methods=['POST'])
 def enable_list():
@@ -358,13 +878,39 @@ def enable_list():
     {
         "gov_delivery_id": "TOPIC_12",
     }
+
+    or to enable many at once:
+
+    {
+        "gov_delivery_ids": ["TOPIC_12", "TOPIC_13"],
+    }
     """
-    return update_list(g.subscription.enable, 'enable')
+    return update_list(g.subscription.enable, g.subscription.enable_many, 'enable')
 
 @flask_app.route('/_status')
 def health_check():
     flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 200))
     return jsonify(status='ok', message='workers available')
 
+@flask_app.route('/_metrics')
+def metrics():
+    """Reports counters for this process's caches and rate limiter"""
+    values = {}
+    if flask_app.config.get('PARTNER_ID_CACHE'):
+        values['partner_id_cache'] = flask_app.config['PARTNER_ID_CACHE'].stats()
+    if flask_app.config.get('SUBSCRIBER_CACHE'):
+        values['subscriber_cache'] = flask_app.config['SUBSCRIBER_CACHE'].stats()
+    if flask_app.config.get('GOVDELIVERY_RATE_LIMITER'):
+        values['govdelivery_rate_limiter'] = flask_app.config['GOVDELIVERY_RATE_LIMITER'].stats(flask_app.config['GOVDELIVERY_ACCOUNT_CODE'])
+    if flask_app.config.get('PAYLOAD_STORE_MIN_SIZE') is not None:
+        values['payload_store'] = flask_app.config['PAYLOAD_STORE'].stats()
+    if flask_app.config.get('IDEMPOTENCY_STORE'):
+        values['idempotency_store'] = flask_app.config['IDEMPOTENCY_STORE'].stats()
+    if flask_app.config.get('NOTIFICATION_LOG_SPOOL'):
+        values['notification_log_spool'] = flask_app.config['NOTIFICATION_LOG_SPOOL'].stats()
+
+    flask_app.logger.info(logstasher_request(request), extra=logstasher_request_params(request, 200))
+    return jsonify(**values)
+
 if __name__ == '__main__':
     flask_app.run(port=3042, debug=True)
@@ -3,11 +3,13 @@ import logging
 import urllib
 from collections import namedtuple
 
+import redis
 from flask import json
-from mock import patch
+from mock import patch, Mock
 
 import service
 from adapters.partner_id_repository import FindResponse
+from adapters.fake_redis import FakeRedis, real_redis
 
 class FakeGovDeliveryClient(object):
     def __init__(self, *args, **kwargs):
@@ -16,6 +18,24 @@ class FakeGovDeliveryClient(object):
     def subscribe(self, *args, **kwargs):
         return
 
+    def subscriber_exists(self, *args, **kwargs):
+        return
+
+    def create_subscriber(self, *args, **kwargs):
+        return
+
+    def update_subscriber_topics(self, *args, **kwargs):
+        return
+
+    def merge_subscriber_topics(self, *args, **kwargs):
+        return
+
+    def update_subscriber_frequency(self, *args, **kwargs):
+        return
+
+    def create_subscriber_and_add_subscriptions(self, *args, **kwargs):
+        return
+
     def create_topic(self, *args, **kwargs):
         return
 
@@ -53,6 +73,9 @@ class FakePartnerIdRepository(object):
     def find_partner_id_for_url(self, *args, **kwargs):
         return FindResponse(None, None)
 
+    def find_partner_ids_for_urls(self, feed_urls):
+        return [self.find_partner_id_for_url(url) for url in feed_urls]
+
     def store_partner_id_for_url(self, feed_url, list_id):
         return None
 
@@ -72,6 +95,9 @@ class GenericFlaskTestCase(unittest.TestCase):
         logger.disabled = True
         self.flask_app = service.flask_app
         self.app = service.flask_app.test_client()
+        # Tests patch the configured classes, so build a new subscription
+        # object for each one
+        service.container.reset()
 
     def post_json_to_app(self, route, data, headers={}):
         data = json.dumps(data)
@@ -91,6 +117,46 @@ class BasicServiceTestCase(GenericFlaskTestCase):
         assert response.status_code == 200
 
 
+    def test_metrics_are_reachable(self):
+        response = self.app.get('/_metrics')
+        assert response.status_code == 200
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_CACHE': service.LRUCache(10, 60)})
+    def test_metrics_include_partner_id_cache_stats(self):
+        response = self.app.get('/_metrics')
+        body = json.loads(response.data)
+        self.assertEqual(body['partner_id_cache']['max_size'], 10)
+
+    def test_metrics_include_rate_limiter_stats(self):
+        limiter = service.RateLimiter(Mock(**{'hget.return_value': '3.5'}), {'bulletin': (2, 10)})
+        with patch.dict(service.flask_app.config, {'GOVDELIVERY_RATE_LIMITER': limiter}):
+            response = self.app.get('/_metrics')
+        body = json.loads(response.data)
+        self.assertEqual(body['govdelivery_rate_limiter']['bulletin']['rate'], 2)
+        self.assertEqual(body['govdelivery_rate_limiter']['bulletin']['tokens'], 3.5)
+
+
+class ServiceContainerTestCase(GenericFlaskTestCase):
+    @patch.dict(service.flask_app.config, {'SUBSCRIPTION_OBJECT': FakeSubscription})
+    def test_builds_one_subscription_per_process(self):
+        subscription = service.container.subscription()
+        self.assertIsInstance(subscription, FakeSubscription)
+        self.assertIs(service.container.subscription(), subscription)
+
+    @patch.dict(service.flask_app.config, {'SUBSCRIPTION_OBJECT': FakeSubscription})
+    def test_rebuilds_subscription_after_fork(self):
+        subscription = service.container.subscription()
+        with patch.object(service.os, 'getpid', return_value=-1):
+            self.assertIsNot(service.container.subscription(), subscription)
+
+    @patch.dict(service.flask_app.config, {'SUBSCRIPTION_OBJECT': FakeSubscription})
+    def test_closes_the_notification_log_when_a_worker_exits(self):
+        subscription = service.container.subscription()
+        subscription.notification_log = Mock()
+        service.close_notification_log()
+        subscription.notification_log.close.assert_called_once_with()
+
+
 class SubscriptionServiceTestCase(GenericFlaskTestCase):
     def test_rejects_non_json_requests(self):
         response = self.app.post('/subscriptions')
@@ -146,6 +212,71 @@ class SubscriptionServiceTestCase(GenericFlaskTestCase):
         mock_subscription.assert_called_once_with('me@example.com',
                                                   ['http://example.com'])
 
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                           'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', return_value=FindResponse('TOPIC_1', False))
+    @patch.object(FakeGovDeliveryClient, 'subscriber_exists', return_value=True)
+    @patch.object(FakeGovDeliveryClient, 'update_subscriber_frequency')
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber_and_add_subscriptions')
+    def test_subscribes_in_one_request(self, mock_add_subscriptions, mock_update_frequency, mock_subscriber_exists, mock_repository):
+        response = self.post_json_to_app('/subscriptions', {'email': 'me@example.com',
+                                                            'feed_urls': ['http://example.com']})
+        assert response.status_code == 201
+        mock_add_subscriptions.assert_called_once_with('me@example.com', ['TOPIC_1'])
+        assert not mock_update_frequency.called
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                           'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', return_value=FindResponse('TOPIC_1', False))
+    @patch.object(FakeGovDeliveryClient, 'subscriber_exists', return_value=False)
+    @patch.object(FakeGovDeliveryClient, 'update_subscriber_frequency')
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber_and_add_subscriptions')
+    def test_new_subscribers_keep_the_requested_frequency(self, mock_add_subscriptions, mock_update_frequency, mock_subscriber_exists, mock_repository):
+        self.post_json_to_app('/subscriptions', {'email': 'me@example.com',
+                                                 'feed_urls': ['http://example.com']})
+        mock_update_frequency.assert_called_once_with('me@example.com', 'daily')
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                           'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', return_value=FindResponse('TOPIC_1', False))
+    @patch.object(FakeGovDeliveryClient, 'subscriber_exists', return_value=True)
+    @patch.object(FakeGovDeliveryClient, 'update_subscriber_topics')
+    @patch.object(FakeGovDeliveryClient, 'merge_subscriber_topics')
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber_and_add_subscriptions', side_effect=Exception('HTTP status: 400\nGD-15001\nInvalid'))
+    def test_falls_back_to_merging_topics(self, mock_add_subscriptions, mock_merge_topics, mock_update_topics, mock_subscriber_exists, mock_repository):
+        response = self.post_json_to_app('/subscriptions', {'email': 'me@example.com',
+                                                            'feed_urls': ['http://example.com']})
+        assert response.status_code == 201
+        mock_merge_topics.assert_called_once_with('me@example.com', ['TOPIC_1'])
+        assert not mock_update_topics.called
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                           'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', return_value=FindResponse('TOPIC_1', False))
+    @patch.object(FakeGovDeliveryClient, 'subscriber_exists', return_value=True)
+    @patch.object(FakeGovDeliveryClient, 'merge_subscriber_topics')
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber_and_add_subscriptions', side_effect=Exception('HTTP status: 503\nGD-00001\nUnavailable'))
+    @patch.object(service.GovDeliveryPolicyClient, 'sleep')
+    def test_does_not_fall_back_if_the_topics_may_have_been_added(self, sleep, mock_add_subscriptions, mock_merge_topics, mock_subscriber_exists, mock_repository):
+        with self.assertRaises(Exception):
+            self.post_json_to_app('/subscriptions', {'email': 'me@example.com',
+                                                     'feed_urls': ['http://example.com']})
+        assert not mock_merge_topics.called
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                           'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient,
+                                           'SUBSCRIBE_FAST_PATH': False})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', return_value=FindResponse('TOPIC_1', False))
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber', return_value={'subscriber': {}})
+    @patch.object(FakeGovDeliveryClient, 'update_subscriber_topics')
+    @patch.object(FakeGovDeliveryClient, 'create_subscriber_and_add_subscriptions')
+    def test_fast_path_can_be_turned_off(self, mock_add_subscriptions, mock_update_topics, mock_create_subscriber, mock_repository):
+        response = self.post_json_to_app('/subscriptions', {'email': 'me@example.com',
+                                                            'feed_urls': ['http://example.com']})
+        assert not mock_add_subscriptions.called
+        mock_create_subscriber.assert_called_once_with('me@example.com', 'daily')
+        mock_update_topics.assert_called_once_with('me@example.com', ['TOPIC_1'])
+
 class ListServiceTestCase(GenericFlaskTestCase):
     def test_rejects_non_json_requests(self):
         response = self.app.post('/lists')
@@ -233,6 +364,38 @@ class ListServiceTestCase(GenericFlaskTestCase):
         body = json.loads(response.data)
         self.assertEqual(body, {'success': True, 'partner_id': 'TOPIC_12345'})
 
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                     'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient,
+                                     'REDIS': FakeRedis()})
+    @patch.object(FakeGovDeliveryClient, 'create_topic', return_value={'topic': {'to-param': 'TOPIC_12345'}})
+    def test_creates_topic_while_holding_a_lock_on_the_url(self, mock_client):
+        data = json.dumps({'title': 'A title',
+                           'feed_url': 'http://example.com/feed?b=1&a=2'})
+        response = self.app.post('/lists',
+                                 content_type='application/json',
+                                 data=data)
+
+        name, lock = self.flask_app.config['REDIS'].locks[0]
+        self.assertEqual(name, 'govuk_delivery:create_topic:http://example.com/feed?a=2&b=1')
+        assert lock.acquired
+        assert lock.released
+        assert mock_client.called
+
+    @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
+                                     'GOVDELIVERY_CLIENT_OBJECT': FakeGovDeliveryClient,
+                                     'REDIS': FakeRedis()})
+    @patch.object(FakePartnerIdRepository, 'find_partner_id_for_url', side_effect=[FindResponse(None, None), FindResponse('TOPIC_123', False)])
+    @patch.object(FakeGovDeliveryClient, 'create_topic')
+    def test_uses_topic_created_while_waiting_for_the_lock(self, mock_client, mock_repository):
+        data = json.dumps({'title': 'A title',
+                           'feed_url': 'http://example.com/feed'})
+        response = self.app.post('/lists',
+                                 content_type='application/json',
+                                 data=data)
+
+        assert not mock_client.called
+        self.assertEqual(json.loads(response.data), {'success': True, 'partner_id': 'TOPIC_123'})
+
 # stop logging being posted to running server during tests - without this the errors are
 # swallowed silently when the service isn't running.
 @patch.dict(service.flask_app.config, {'NOTIFICATION_LOG_CLIENT_OBJECT': FakeNotificationLog})
@@ -252,7 +415,8 @@ class NotificationTestCase(GenericFlaskTestCase):
         mock_parser.assert_called_once_with(['http://example.com/feed'])
         mock_notification.assert_called_once_with(['TOPIC_ABC'],
                                                   'My subject',
-                                                  '<p>Body</p>')
+                                                  '<p>Body</p>',
+                                                  '')
 
 
     @patch.dict(service.flask_app.config, {'PARTNER_ID_REPOSITORY': FakePartnerIdRepository,
@@ -488,6 +652,283 @@ class DelayedSubscriptionServiceTestCase(GenericFlaskTestCase):
 
         assert not notifier.called
 
+    @patch.dict(service.flask_app.config, {'USE_BACKGROUND_WORKERS': True})
+    @patch.object(service.send_notification, 'apply_async')
+    def test_urgent_notifications_use_the_urgent_queue(self, notifier):
+        data = json.dumps({'feed_urls': ['http://example.com/feed'],
+                           'subject': "My subject",
+                           'body': '<p>Body</p>',
+                           'urgent': True})
+
+        self.app.post('/notifications', content_type='application/json', data=data)
+
+        notifier.assert_called_once_with([['http://example.com/feed'], 'My subject', '<p>Body</p>', {}, ''],
+                                         {'urgent': True}, queue='notifications.urgent')
+
+    @patch.object(service.send_notification, 'delay')
+    def test_large_bodies_are_sent_by_reference(self, notifier):
+        store = Mock(**{'put.return_value': 'sha256:abc'})
+        data = json.dumps({'feed_urls': ['http://example.com/feed'],
+                           'subject': "My subject",
+                           'body': '<p>Body</p>',
+                           'logging_params': {}})
+
+        with patch.dict(service.flask_app.config, {'USE_BACKGROUND_WORKERS': True,
+                                                   'PAYLOAD_STORE_MIN_SIZE': 5,
+                                                   'PAYLOAD_STORE': store}):
+            self.app.post('/notifications', content_type='application/json', data=data)
+
+        store.put.assert_called_once_with('<p>Body</p>')
+        notifier.assert_called_once_with(['http://example.com/feed'], 'My subject', None, {}, '',
+                                         body_ref='sha256:abc')
+
+    @patch.object(service.container, 'subscription')
+    def test_workers_fetch_bodies_sent_by_reference(self, subscription):
+        subscription.return_value.parse_topics.return_value = service.TopicIds(['TOPIC_1'], [])
+        store = Mock(**{'get.return_value': '<p>Body</p>'})
+
+        with patch.dict(service.flask_app.config, {'PAYLOAD_STORE': store}):
+            service.send_notification(['http://example.com/feed'], 'My subject', None, {}, '',
+                                      body_ref='sha256:abc')
+
+        store.get.assert_called_once_with('sha256:abc')
+        subscription.return_value.send_notification.assert_called_once_with(['TOPIC_1'], 'My subject', '<p>Body</p>', '')
+
+class IdempotentNotificationTestCase(GenericFlaskTestCase):
+    def setUp(self):
+        super(IdempotentNotificationTestCase, self).setUp()
+        self.redis = real_redis()
+        self.store = service.IdempotencyStore(self.redis, 3600)
+        self.data = {'feed_urls': ['http://example.com/feed'],
+                     'subject': 'My subject',
+                     'body': '<p>Body</p>',
+                     'logging_params': {'content_id': 'abc', 'public_updated_at': '2017-02-28'}}
+
+    def post_twice(self):
+        with patch.dict(service.flask_app.config, {'IDEMPOTENCY_STORE': self.store}):
+            first = self.post_json_to_app('/notifications', self.data, {'Govuk-Request-Id': '1'})
+            second = self.post_json_to_app('/notifications', self.data, {'Govuk-Request-Id': '2'})
+        return first, second
+
+    @patch.object(service, 'send_notification')
+    def test_duplicates_are_not_sent(self, notifier):
+        first, second = self.post_twice()
+        self.assertEqual(1, notifier.call_count)
+        self.assertEqual((201, 201), (first.status_code, second.status_code))
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+
+    @patch.object(service, 'send_notification', side_effect=Exception('HTTP status: 400\nGD-12004\nNo subscribers'))
+    def test_duplicates_get_the_first_response(self, notifier):
+        first, second = self.post_twice()
+        self.assertEqual(1, notifier.call_count)
+        self.assertEqual((400, 400), (first.status_code, second.status_code))
+
+    @patch.object(service, 'send_notification', side_effect=[Exception('GovDelivery is down'), None])
+    def test_failed_notifications_can_be_sent_again(self, notifier):
+        with patch.dict(service.flask_app.config, {'IDEMPOTENCY_STORE': self.store}):
+            self.assertRaises(Exception, self.post_json_to_app, '/notifications', self.data)
+            response = self.post_json_to_app('/notifications', self.data)
+        self.assertEqual(2, notifier.call_count)
+        self.assertEqual(201, response.status_code)
+
+    @patch.dict(service.flask_app.config, {'USE_BACKGROUND_WORKERS': True})
+    @patch.object(service.send_notification, 'delay')
+    def test_duplicates_are_not_queued(self, notifier):
+        self.post_twice()
+        self.assertEqual(1, notifier.call_count)
+
+class CoalescedNotificationTestCase(GenericFlaskTestCase):
+    def setUp(self):
+        super(CoalescedNotificationTestCase, self).setUp()
+        self.coalescer = Mock(window=5)
+
+    @patch.object(service.container, 'subscription')
+    @patch.object(service.flush_notifications, 'apply_async')
+    def test_workers_coalesce_notifications(self, flush, subscription):
+        subscription.return_value.parse_topics.return_value = service.TopicIds(['TOPIC_1'], [])
+        self.coalescer.add.return_value = 'group'
+
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': self.coalescer,
+                                                   'USE_BACKGROUND_WORKERS': True}):
+            service.send_notification(['http://example.com/feed'], 'My subject', '<p>Body</p>', {}, '1')
+
+        self.coalescer.add.assert_called_once_with(['TOPIC_1'], 'My subject', '<p>Body</p>', '1', None)
+        flush.assert_called_once_with(args=['group'], countdown=5)
+        subscription.return_value.log_notification.assert_called_once_with(['TOPIC_1'], [], {}, '1')
+        assert not subscription.return_value.send_notification.called
+
+    @patch.object(service.container, 'subscription')
+    def test_notifications_sent_without_workers_are_not_coalesced(self, subscription):
+        subscription.return_value.parse_topics.return_value = service.TopicIds(['TOPIC_1'], [])
+
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': self.coalescer}):
+            service.send_notification(['http://example.com/feed'], 'My subject', '<p>Body</p>', {}, '1')
+
+        assert not self.coalescer.add.called
+        subscription.return_value.send_notification.assert_called_once_with(['TOPIC_1'], 'My subject', '<p>Body</p>', '1')
+
+    def flush(self, subscription, **config):
+        notification = service.CoalescedNotification(['TOPIC_1', 'TOPIC_2'], 'My subject', '<p>Body</p>', None, ['1', '2'])
+        self.coalescer.peek.return_value = notification
+        self.coalescer.remove.return_value = 0
+        with patch.dict(service.flask_app.config, dict(config, NOTIFICATION_COALESCER=self.coalescer)):
+            service.flush_notifications('group')
+        return notification
+
+    @patch.object(service.container, 'subscription')
+    def test_coalesced_notifications_are_sent_as_one_bulletin(self, subscription):
+        notification = self.flush(subscription)
+        subscription.return_value.send_notification.assert_called_once_with(['TOPIC_1', 'TOPIC_2'], 'My subject', '<p>Body</p>', '1')
+        self.coalescer.remove.assert_called_once_with('group', notification)
+
+    @patch.object(service.container, 'subscription')
+    @patch.object(service.send_coalesced_notifications, 'apply_async')
+    def test_coalesced_notifications_which_fail_are_retried(self, queue, subscription):
+        subscription.return_value.send_notification.side_effect = Exception('HTTP status: 429\nGD-00001\nToo many requests')
+        notification = self.flush(subscription, SEND_NOTIFICATION_RETRIES={'transient': 2})
+        args, kwargs = queue.call_args
+        self.assertEqual(([['TOPIC_1', 'TOPIC_2'], 'My subject', '<p>Body</p>', ['1', '2']],
+                          {'body_ref': None, 'attempt': 1}), args)
+        self.coalescer.remove.assert_called_once_with('group', notification)
+
+    @patch.object(service.container, 'subscription')
+    @patch.object(service.send_coalesced_notifications, 'apply_async')
+    def test_coalesced_notifications_whose_body_is_missing_are_retried(self, queue, subscription):
+        store = Mock(**{'get.side_effect': service.PayloadNotFound('sha256:abc')})
+        self.coalescer.peek.return_value = service.CoalescedNotification(['TOPIC_1'], 'My subject', None, 'sha256:abc', ['1'])
+        self.coalescer.remove.return_value = 0
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': self.coalescer, 'PAYLOAD_STORE': store,
+                                                   'SEND_NOTIFICATION_RETRIES': {'transient': 2}}):
+            service.flush_notifications('group')
+        self.assertEqual({'body_ref': 'sha256:abc', 'attempt': 1}, queue.call_args[0][1])
+        assert not subscription.return_value.send_notification.called
+
+    @patch.object(service.container, 'subscription')
+    @patch.object(service.flush_notifications, 'apply_async', side_effect=Exception('broker is down'))
+    def test_failures_flushing_straight_away_are_not_retried_by_the_notification(self, flush, subscription):
+        subscription.return_value.parse_topics.return_value = service.TopicIds(['TOPIC_1'], [])
+        self.coalescer.add.return_value = 'group'
+        self.coalescer.peek.side_effect = redis.ConnectionError('down')
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': self.coalescer,
+                                                   'USE_BACKGROUND_WORKERS': True}):
+            with patch.object(service.send_notification, 'apply_async') as queue:
+                service.send_notification(['http://example.com/feed'], 'My subject', '<p>Body</p>', {}, '1')
+        assert not queue.called
+        assert not subscription.return_value.send_notification.called
+
+    @patch.object(service.container, 'subscription')
+    @patch.object(service.flush_notifications, 'apply_async')
+    def test_notifications_added_while_sending_are_flushed_later(self, flush, subscription):
+        self.coalescer.remove.return_value = 1
+        notification = service.CoalescedNotification(['TOPIC_1'], 'My subject', '<p>Body</p>', None, ['1'])
+        self.coalescer.peek.return_value = notification
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': self.coalescer}):
+            service.flush_notifications('group')
+        flush.assert_called_once_with(args=['group'], countdown=5)
+
+class SendNotificationRetryTestCase(GenericFlaskTestCase):
+    def setUp(self):
+        super(SendNotificationRetryTestCase, self).setUp()
+        self.dead_letters = Mock()
+        self.args = [['http://example.com/feed'], 'My subject', '<p>Body</p>', {}, '1']
+
+    def send(self, error, can_resend=True, **kwargs):
+        config = {'USE_BACKGROUND_WORKERS': True, 'DEAD_LETTER_QUEUE': self.dead_letters,
+                  'SEND_NOTIFICATION_RETRIES': {'transient': 2}}
+        with patch.object(service.container, 'subscription') as subscription:
+            subscription.return_value.parse_topics.return_value = service.TopicIds(['TOPIC_1'], [])
+            subscription.return_value.dispatcher.can_resend.return_value = can_resend
+            subscription.return_value.send_notification.side_effect = error
+            with patch.dict(service.flask_app.config, config):
+                service.send_notification(*self.args, **kwargs)
+        return subscription.return_value
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_transient_errors_are_retried_with_backoff(self, queue):
+        self.send(Exception('HTTP status: 429\nGD-00001\nToo many requests'), attempt=1)
+        args, kwargs = queue.call_args
+        self.assertEqual((self.args, {'body_ref': None, 'urgent': False, 'attempt': 2}), args)
+        self.assertTrue(0 <= kwargs['countdown'] <= 60)
+        assert not self.dead_letters.add.called
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_retries_are_not_logged_again(self, queue):
+        subscription = self.send(Exception('HTTP status: 429\nGD-00001\nToo many requests'), attempt=1)
+        assert not subscription.log_notification.called
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_tasks_out_of_retries_are_dead_lettered(self, queue):
+        error = Exception('HTTP status: 429\nGD-00001\nToo many requests')
+        self.assertRaises(Exception, self.send, error, attempt=2)
+        assert not queue.called
+        self.dead_letters.add.assert_called_once_with('send-notification', self.args,
+                                                      {'body_ref': None, 'urgent': False, 'attempt': 2},
+                                                      error, 'transient', 3)
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_bulletins_which_may_have_been_sent_are_not_retried(self, queue):
+        self.assertRaises(Exception, self.send, Exception('HTTP status: 503\nGD-00001\nUnavailable'))
+        assert not queue.called
+        self.assertEqual('permanent', self.dead_letters.add.call_args[0][4])
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_bulletins_are_not_retried_unless_they_can_be_resent(self, queue):
+        self.assertRaises(Exception, self.send, Exception('HTTP status: 429\nGD-00001\nToo many requests'), can_resend=False)
+        assert not queue.called
+        self.assertEqual(1, self.dead_letters.add.call_count)
+
+    def test_dead_letters_keep_bodies_sent_by_reference(self):
+        store = Mock(**{'get.return_value': '<p>Body</p>'})
+        self.args[2] = None
+        with patch.dict(service.flask_app.config, {'PAYLOAD_STORE': store, 'DEAD_LETTER_QUEUE': self.dead_letters}):
+            service.retry_or_dead_letter(service.send_notification, self.args, {'body_ref': 'sha256:abc', 'attempt': 0},
+                                         Exception('HTTP status: 400\nGD-00002\nBad request'))
+        store.get.assert_called_once_with('sha256:abc')
+        args, kwargs = self.dead_letters.add.call_args[0][1:3]
+        self.assertEqual(('<p>Body</p>', None), (args[2], kwargs['body_ref']))
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_permanent_errors_are_dead_lettered_straight_away(self, queue):
+        self.assertRaises(Exception, self.send, Exception('HTTP status: 400\nGD-00002\nBad request'))
+        assert not queue.called
+        self.assertEqual(1, self.dead_letters.add.call_count)
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_errors_before_sending_are_retried_as_transient(self, queue):
+        error = Exception('could not connect to mongo')
+        with patch.object(service.container, 'subscription') as subscription:
+            subscription.return_value.parse_topics.side_effect = error
+            subscription.return_value.dispatcher.can_resend.return_value = False
+            with patch.dict(service.flask_app.config, {'USE_BACKGROUND_WORKERS': True, 'DEAD_LETTER_QUEUE': self.dead_letters,
+                                                       'SEND_NOTIFICATION_RETRIES': {'transient': 2}}):
+                service.send_notification(*self.args)
+        self.assertEqual({'body_ref': None, 'urgent': False, 'attempt': 1}, queue.call_args[0][1])
+        assert not subscription.return_value.send_notification.called
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_missing_bodies_are_retried_as_transient(self, queue):
+        store = Mock(**{'get.side_effect': service.PayloadNotFound('sha256:abc')})
+        with patch.dict(service.flask_app.config, {'PAYLOAD_STORE': store}):
+            subscription = self.send(None, body_ref='sha256:abc')
+        self.assertEqual(1, queue.call_count)
+        assert not subscription.send_notification.called
+        assert not self.dead_letters.add.called
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_redriven_notifications_are_not_logged_or_coalesced_again(self, queue):
+        coalescer = Mock(window=5)
+        with patch.dict(service.flask_app.config, {'NOTIFICATION_COALESCER': coalescer}):
+            subscription = self.send(Exception('HTTP status: 429\nGD-00001\nToo many requests'), redriven=True)
+        assert not subscription.log_notification.called
+        assert not coalescer.add.called
+        self.assertEqual({'body_ref': None, 'urgent': False, 'attempt': 1, 'redriven': True}, queue.call_args[0][1])
+
+    @patch.object(service.send_notification, 'apply_async')
+    def test_topics_without_subscribers_are_not_dead_lettered(self, queue):
+        self.assertRaises(Exception, self.send, Exception('HTTP status: 400\nGD-12004\nNo subscribers'))
+        assert not queue.called
+        assert not self.dead_letters.add.called
+
 class DisableListTestCase(GenericFlaskTestCase):
     def setUp(self):
         super(DisableListTestCase, self).setUp()
@@ -544,6 +985,45 @@ class DisableListTestCase(GenericFlaskTestCase):
 
         self.assertEqual(response.status_code, 404)
 
+    def test_disable_many_gov_delivery_ids(self):
+        self.db.insert({
+            '_id': 'http://www.test.com/',
+            'topic_id': 'TOPIC_6666666',
+            'created': '2017-03-27'
+        })
+        data = json.dumps({ 'gov_delivery_ids': ['TOPIC_6666666', 'TOPIC_7777777'] })
+
+        response = self.app.post('/lists/disable',
+                                 content_type='application/json',
+                                 data=data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {
+          'success': True,
+          'lists': [
+            {
+              'gov_delivery_id': 'TOPIC_6666666',
+              'url': 'http://www.test.com/',
+              'topic_id': 'TOPIC_6666666',
+              'disabled': True,
+              'success': True
+            },
+            {
+              'gov_delivery_id': 'TOPIC_7777777',
+              'success': False
+            }
+          ]
+        })
+
+    def test_disable_many_requires_a_list_of_ids(self):
+        data = json.dumps({ 'gov_delivery_ids': 'TOPIC_6666666' })
+
+        response = self.app.post('/lists/disable',
+                                 content_type='application/json',
+                                 data=data)
+
+        self.assertEqual(response.status_code, 400)
+
 class EnableListTestCase(GenericFlaskTestCase):
     def setUp(self):
         super(EnableListTestCase, self).setUp()
@@ -601,6 +1081,28 @@ class EnableListTestCase(GenericFlaskTestCase):
 
         self.assertEqual(response.status_code, 404)
 
+    def test_enable_many_gov_delivery_ids(self):
+        self.db.insert({
+            '_id': 'http://www.test.com/',
+            'topic_id': 'TOPIC_6666666',
+            'created': '2017-03-27',
+            'disabled': True
+        })
+        data = json.dumps({ 'gov_delivery_ids': ['TOPIC_6666666'] })
+
+        response = self.app.post('/lists/enable',
+                                 content_type='application/json',
+                                 data=data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['lists'], [{
+          'gov_delivery_id': 'TOPIC_6666666',
+          'url': 'http://www.test.com/',
+          'topic_id': 'TOPIC_6666666',
+          'disabled': None,
+          'success': True
+        }])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -9,9 +9,46 @@ GOVDELIVERY_PASSWORD = 'password'
 GOVDELIVERY_ACCOUNT_CODE = 'UKGOVUKDUP'
 GOVDELIVERY_HOSTNAME = 'stage-api.govdelivery.com'
 GOVDELIVERY_SIGNUP_FORM = 'https://stage-public.govdelivery.com/accounts/UKGOVUKDUP/subscriber/new?topic_id=%s'
+# Connections kept open to GovDelivery by each process, and the timeout in
+# seconds for connecting and for each read.
+GOVDELIVERY_POOL_SIZE = 10
+GOVDELIVERY_TIMEOUT = 30
+# Retries after transient errors for each GovDelivery client method, as
+# fields to change on the defaults in adapters/gov_delivery_policy.py:
+# {'read_subscriber': {'retries': 3, 'backoff': 0.5, 'max_backoff': 5}}
+GOVDELIVERY_CALL_POLICIES = {}
+# Fail GovDelivery calls straight away, in every process, for
+# GOVDELIVERY_CIRCUIT_BREAKER_RESET_TIMEOUT seconds after this many
+# transient errors within GOVDELIVERY_CIRCUIT_BREAKER_WINDOW seconds.
+# A threshold of 0 disables the circuit breaker.
+GOVDELIVERY_CIRCUIT_BREAKER_THRESHOLD = 0
+GOVDELIVERY_CIRCUIT_BREAKER_WINDOW = 60
+GOVDELIVERY_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+# Rate limits on GovDelivery calls, shared by every process through Redis,
+# for each class of call: 'bulletin', 'subscriber' and 'topic'. Each is a
+# (calls per second, burst) pair, like {'bulletin': (2, 10)}; classes
+# without a limit aren't limited. Callers wait up to
+# GOVDELIVERY_RATE_LIMIT_MAX_WAIT seconds before giving up.
+GOVDELIVERY_RATE_LIMITS = {}
+GOVDELIVERY_RATE_LIMIT_MAX_WAIT = 30
 
 NOTIFICATION_LOG_HOSTNAME = 'email-alert-api.dev.gov.uk'
 NOTIFICATION_LOG_PROTOCOL = 'http'
+# Seconds to wait for email-alert-api to respond. Log entries are posted
+# before each email is sent unless NOTIFICATION_LOG_BATCH_SIZE is set, when
+# they're queued and posted in the background, that many at a time and at
+# least every NOTIFICATION_LOG_FLUSH_INTERVAL seconds. Queued entries are
+# lost if the process dies, so set NOTIFICATION_LOG_SPOOL_DIRECTORY too.
+NOTIFICATION_LOG_TIMEOUT = 5
+NOTIFICATION_LOG_BATCH_SIZE = 0
+NOTIFICATION_LOG_FLUSH_INTERVAL = 0.5
+# Directory to keep notification log entries which couldn't be posted in,
+# until scripts/replay_notification_log.py posts them. None to drop them.
+NOTIFICATION_LOG_SPOOL_DIRECTORY = None
+NOTIFICATION_LOG_SPOOL_SEGMENT_SIZE = 1024 * 1024
+NOTIFICATION_LOG_SPOOL_FSYNC_INTERVAL = 1
+# Entries replayed a second
+NOTIFICATION_LOG_REPLAY_RATE = 10
 
 REDIS_SETTINGS = {
     'host': 'localhost',
@@ -24,6 +61,117 @@ MONGODB_SETTINGS = {
     'port': 27017
 }
 
+# Where feed URL to topic mappings are stored: 'mongo', 'sqlite' (in the
+# file at TOPIC_STORAGE_SQLITE_PATH) or 'memory'. Only Mongo is shared
+# between processes; the others are for load testing and benchmarks.
+TOPIC_STORAGE_BACKEND = 'mongo'
+TOPIC_STORAGE_SQLITE_PATH = 'topics.sqlite3'
+
+# In-process cache of feed URL to topic mappings, sized in entries and
+# expired after a number of seconds. A size of 0 disables the cache.
+PARTNER_ID_CACHE_SIZE = 0
+PARTNER_ID_CACHE_TTL = 300
+
+# Cache of feed URL to topic mappings in Redis, shared by every web and
+# worker process. Set a TTL in seconds to enable it.
+PARTNER_ID_SHARED_CACHE_TTL = 0
+
+# Cache of which GovDelivery subscribers exist and their topics, keyed by
+# a hash of their email address, to save reading them again during bursts
+# of signups. Sized and expired like the partner ID caches above; a size
+# and shared TTL of 0 disable it.
+SUBSCRIBER_CACHE_SIZE = 0
+SUBSCRIBER_CACHE_TTL = 30
+SUBSCRIBER_SHARED_CACHE_TTL = 0
+
+# Load the whole topics collection into memory in each Celery worker
+# process, so feed URLs are resolved without querying Mongo. The index is
+# refreshed every TOPIC_INDEX_REFRESH_INTERVAL seconds and reloaded in full
+# every TOPIC_INDEX_FULL_RELOAD_INTERVAL seconds. Lookups go back to Mongo
+# for URLs it doesn't know, and for every URL if it hasn't been refreshed
+# for TOPIC_INDEX_MAX_STALENESS seconds. The
+# index only exists in workers, so its size and staleness are logged by them
+# each time it's loaded rather than reported by /_metrics.
+PRELOAD_TOPIC_INDEX_IN_WORKERS = False
+TOPIC_INDEX_REFRESH_INTERVAL = 30
+TOPIC_INDEX_FULL_RELOAD_INTERVAL = 3600
+TOPIC_INDEX_MAX_STALENESS = 300
+
+# Log missing or unused indexes on the topics collection when each web
+# process starts. Run scripts/ensure_indexes.py to create them.
+CHECK_INDEXES_ON_STARTUP = True
+
+# Longest time, in seconds, that a process holds the lock on creating the
+# topic for a feed URL before others may create it too.
+TOPIC_CREATION_LOCK_TIMEOUT = 60
+
+# Subscribe people in one request to GovDelivery, which adds to their
+# topics, rather than three which replace them. New subscribers then get a
+# second request setting their frequency to daily.
+SUBSCRIBE_FAST_PATH = True
+
+# Bulletins are sent to at most BULLETIN_CHUNK_SIZE topics per request,
+# BULLETIN_CONCURRENCY requests at a time. Chunking is off by default:
+# GovDelivery only takes out duplicate subscribers within a single bulletin,
+# so anyone subscribed to topics in two chunks gets the email twice. Chunks
+# which fail in a way that proves nothing was sent, a refused connection or a
+# 429, are sent again up to BULLETIN_CHUNK_RETRIES times.
+BULLETIN_CHUNK_SIZE = None
+BULLETIN_CONCURRENCY = 4
+BULLETIN_CHUNK_RETRIES = 2
+# Seconds to keep the topics each GOV.UK request's bulletin was delivered
+# to in Redis when it's sent in chunks, so they're skipped if the same
+# bulletin is sent again. 0 disables this, and with it retries of bulletins
+# sent in more than one chunk; it must outlast the retries below.
+BULLETIN_DELIVERY_RECORD_TTL = 24 * 60 * 60
+# Bulletin bodies of at least this many characters are kept in Redis for
+# PAYLOAD_STORE_TTL seconds and handed to workers by reference, rather than
+# sent through the Celery broker. Stored bodies of at least
+# PAYLOAD_STORE_COMPRESS_MIN_SIZE bytes are compressed. None sends every
+# body through the broker.
+PAYLOAD_STORE_MIN_SIZE = None
+PAYLOAD_STORE_TTL = 24 * 60 * 60
+PAYLOAD_STORE_COMPRESS_MIN_SIZE = 1024
+# Seconds to remember each notification sent, by content ID and update
+# time or GOV.UK request ID, so that one POSTed again isn't sent twice. A
+# notification counts as being sent for at most
+# NOTIFICATION_IDEMPOTENCY_IN_FLIGHT_TTL seconds. 0 disables this.
+NOTIFICATION_IDEMPOTENCY_TTL = 0
+NOTIFICATION_IDEMPOTENCY_IN_FLIGHT_TTL = 300
+# Seconds workers hold notifications back for, so that those with the same
+# subject and body are sent as one bulletin to all of their topics. 0 sends
+# each one straight away.
+NOTIFICATION_COALESCE_WINDOW = 0
+
+# Celery queues, so that each class of work can be scaled with its own
+# workers; see the Procfile. Tasks are routed by the start of their name,
+# and any others go to the default queue. Notifications POSTed with
+# "urgent": true go to URGENT_NOTIFICATION_QUEUE.
+CELERY_DEFAULT_QUEUE = 'celery'
+URGENT_NOTIFICATION_QUEUE = 'notifications.urgent'
+TASK_QUEUES = [
+    ('send-notification', 'notifications'),
+    ('flush-notifications', 'notifications'),
+    ('send-coalesced-notifications', 'notifications'),
+    ('topic-', 'subscriptions'),
+    ('subscription-', 'subscriptions'),
+    ('maintenance-', 'maintenance'),
+]
+# Sending a bulletin can take a while, so workers take one task at a time
+# rather than hold back others queued behind it
+CELERYD_PREFETCH_MULTIPLIER = 1
+# Times a queued send-notification task, or coalesced notifications which
+# couldn't be sent, are tried again for each class of error: GovDelivery
+# errors proving the bulletin wasn't sent, calls held back by the rate
+# limiter or circuit breaker, and any others, which includes those where
+# the bulletin may have been sent. Retries back off exponentially from
+# SEND_NOTIFICATION_RETRY_BACKOFF seconds up to
+# SEND_NOTIFICATION_RETRY_MAX_BACKOFF. Tasks which run out of retries are
+# kept in the dead-letter queue; see scripts/dead_letters.py.
+SEND_NOTIFICATION_RETRIES = {'transient': 5, 'deferred': 10, 'permanent': 0}
+SEND_NOTIFICATION_RETRY_BACKOFF = 30
+SEND_NOTIFICATION_RETRY_MAX_BACKOFF = 600
+
 LIST_TITLE_FORMAT = '%s'
 
 USE_BACKGROUND_WORKERS = False
@@ -1,10 +1,38 @@
 # Celery task definitions
 
 from celery import Celery
+from kombu import Exchange, Queue
+
+class TaskRouter(object):
+    """Routes each task to a queue by the start of its name, using a list
+    of (prefix, queue) pairs. Tasks which match none go to the default
+    queue."""
+    def __init__(self, routes):
+        self.routes = routes
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        for prefix, queue in self.routes:
+            if task.startswith(prefix):
+                return {'queue': queue}
+        return None
+
+def task_queues(config):
+    """Every queue tasks can be sent to, in the order they're declared"""
+    names = [config['CELERY_DEFAULT_QUEUE'], config['URGENT_NOTIFICATION_QUEUE']]
+    names.extend(queue for prefix, queue in config['TASK_QUEUES'])
+    queues = []
+    for name in names:
+        if name not in [queue.name for queue in queues]:
+            queues.append(Queue(name, Exchange(name), routing_key=name))
+    return queues
 
 def make_celery(app):
     celery = Celery('govuk_delivery', broker=app.config['CELERY_BROKER_URL'])
     celery.conf.update(app.config)
+    celery.conf.update(
+        CELERY_QUEUES=task_queues(app.config),
+        CELERY_ROUTES=(TaskRouter(app.config['TASK_QUEUES']),),
+    )
 
     TaskBase = celery.Task
 
@@ -0,0 +1,28 @@
+import unittest
+
+from tasks import TaskRouter, task_queues
+
+
+class TaskRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = TaskRouter([('send-notification', 'notifications'), ('topic-', 'subscriptions')])
+
+    def test_tasks_are_routed_by_name(self):
+        self.assertEqual({'queue': 'notifications'}, self.router.route_for_task('send-notification'))
+        self.assertEqual({'queue': 'subscriptions'}, self.router.route_for_task('topic-create'))
+
+    def test_other_tasks_go_to_the_default_queue(self):
+        self.assertEqual(None, self.router.route_for_task('update-lists'))
+
+
+class TaskQueuesTestCase(unittest.TestCase):
+    def test_every_queue_is_declared_once(self):
+        queues = task_queues({'CELERY_DEFAULT_QUEUE': 'celery',
+                              'URGENT_NOTIFICATION_QUEUE': 'notifications.urgent',
+                              'TASK_QUEUES': [('send-', 'notifications'), ('flush-', 'notifications')]})
+        self.assertEqual(['celery', 'notifications.urgent', 'notifications'], [queue.name for queue in queues])
+        self.assertEqual('notifications', queues[2].routing_key)
+
+
+if __name__ == '__main__':
+    unittest.main()